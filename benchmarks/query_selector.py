@@ -0,0 +1,66 @@
+"""
+compares querySelectorAll against naive tree walks on a document with 100k elements.
+
+run with: ``PYTHONPATH=./src python benchmarks/query_selector.py``
+"""
+import time
+from domsync import Document
+
+
+def build(n_rows=20000, n_cols=4):
+    doc = Document('domsync_root_id')
+    table = doc.createElement('table', id='t')
+    doc.getRootElement().appendChild(table)
+    for r in range(n_rows):
+        tr = doc.createElement('tr', id=f't.tr.{r}', attributes={'class': 'row selected' if r % 1000 == 0 else 'row'})
+        table.appendChild(tr)
+        for c in range(n_cols):
+            tr.appendChild(doc.createElement('td', id=f't.td.{r}.{c}', attributes={'class': 'num'} if c == 2 else None))
+    doc.render_js_updates()
+    return doc
+
+
+def walk(el):
+    stack = list(reversed(list(el.children)))
+    while stack:
+        el = stack.pop()
+        yield el
+        stack.extend(reversed(list(el.children)))
+
+
+def naive_selected_nums(doc):
+    # tr.selected > td.num
+    return [el for el in walk(doc.getRootElement()) if el.tagName == 'td' and 'num' in el.getAttribute('class', '').split()
+            and 'selected' in el.parentElement.getAttribute('class', '').split()]
+
+
+def naive_id_prefix(doc, prefix):
+    return [el for el in walk(doc.getRootElement()) if el.id.startswith(prefix)]
+
+
+def timeit(f, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        res = f()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1e3, res
+
+
+def main():
+    doc = build()
+    print(f"{len(doc['elements_by_id'])} elements")
+    for name, naive, query in [
+        ('tr.selected > td.num', lambda: naive_selected_nums(doc), lambda: doc.querySelectorAll('tr.selected > td.num')),
+        ('[id="t.tr.500"] td', lambda: [el for el in walk(doc.getRootElement()) if el.parentElement.id == 't.tr.500'], lambda: doc.querySelectorAll('[id="t.tr.500"] td')),
+        ('tr.selected', lambda: [el for el in walk(doc.getRootElement()) if 'selected' in el.getAttribute('class', '').split()], lambda: doc.querySelectorAll('tr.selected')),
+        ('[id^="t.td.7"] (no index applies)', lambda: naive_id_prefix(doc, 't.td.7'), lambda: doc.querySelectorAll('[id^="t.td.7"]')),
+    ]:
+        t_naive, res_naive = timeit(naive)
+        t_query, res_query = timeit(query)
+        assert [el.id for el in res_naive] == [el.id for el in res_query], name
+        print(f'{name:40s} naive walk: {t_naive:8.2f} ms  querySelectorAll: {t_query:8.2f} ms  ({len(res_query)} results)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+measures rendering the full snapshot of a document with 100k elements for late-joining clients: the first snapshot that fills the
+cache of rendered subtrees, the following snapshots of the unchanged document and the snapshot after a change of a single cell.
+
+run with: ``PYTHONPATH=./src python benchmarks/snapshot.py``
+"""
+import time
+from domsync import Document
+from domsync.protocol import decode_compact
+
+
+def build(n_rows=20000, n_cols=4):
+    doc = Document('domsync_root_id')
+    table = doc.createElement('table', id='t')
+    doc.getRootElement().appendChild(table)
+    for r in range(n_rows):
+        tr = doc.createElement('tr', id=f't.tr.{r}', attributes={'class': 'row'})
+        table.appendChild(tr)
+        for c in range(n_cols):
+            tr.appendChild(doc.createElement('td', id=f't.td.{r}.{c}', innerText=str(r * c)))
+    doc.render_js_updates()
+    return doc
+
+
+def timeit(f):
+    t0 = time.perf_counter()
+    res = f()
+    return (time.perf_counter() - t0) * 1e3, res
+
+
+def decode(protocol, chunks):
+    return ''.join(chunks) if protocol == 'js' else [op for chunk in chunks for op in decode_compact(chunk)]
+
+
+def main():
+    doc = build()
+    print(f"{len(doc['elements_by_id'])} elements")
+    for protocol in ['js', 'compact']:
+        t_cold, chunks = timeit(lambda: list(doc.render_full_chunks(protocol)))
+        t_warm, chunks_warm = timeit(lambda: list(doc.render_full_chunks(protocol)))
+        # the messages can be split at different places once the subtrees are cached
+        assert decode(protocol, chunks) == decode(protocol, chunks_warm)
+        doc.getElementById('t.td.10000.1').innerText = 'changed'
+        t_changed, _ = timeit(lambda: list(doc.render_full_chunks(protocol)))
+        print(f'{protocol:8s} first snapshot: {t_cold:8.2f} ms  unchanged: {t_warm:8.2f} ms  one cell changed: {t_changed:8.2f} ms'
+              f'  ({len(chunks)} messages, {sum(len(c) for c in chunks) / 1e6:.1f} MB)')
+
+
+if __name__ == '__main__':
+    main()
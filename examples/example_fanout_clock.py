@@ -0,0 +1,32 @@
+import asyncio
+from datetime import datetime
+from domsync.fanout import FanoutPublisher, start_workers
+
+async def update_clock(publisher):
+    """
+    the shared document lives in this process only, the worker processes just pass its updates on to their clients
+    """
+    document = publisher.get_shared_document()
+    root_element = document.getRootElement()
+    root_element.appendChild(document.createElement('div', innerText = 'The current time is:'))
+    div_time = document.createElement('div')
+    root_element.appendChild(div_time)
+
+    while True:
+        div_time.innerText = datetime.utcnow().isoformat()
+
+        # the updates are rendered once here and sent to every worker that has clients
+        await publisher.flush_all()
+
+        await asyncio.sleep(1)
+
+async def main():
+    publisher = FanoutPublisher('/tmp/domsync_fanout_clock.sock')
+    await publisher.serve()
+
+    # four processes accept the websocket connections on the same port
+    start_workers(4, publisher.path, 'localhost', 8888)
+    await update_clock(publisher)
+
+if __name__ == "__main__":
+    asyncio.run(main())
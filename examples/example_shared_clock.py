@@ -0,0 +1,35 @@
+import asyncio
+from datetime import datetime
+from domsync.domsync_server import DomsyncServer
+
+async def connection_handler(server, client):
+    """
+    every client that connects gets subscribed to the same shared document, a new client first receives a snapshot of its current state
+    """
+    await server.subscribe(client, 'clock')
+
+async def update_clock(server):
+    """
+    the shared document is built and updated once, no matter how many clients are watching it
+    """
+    document = server.get_shared_document('clock')
+    root_element = document.getRootElement()
+    root_element.appendChild(document.createElement('div', innerText = 'The current time is:'))
+    div_time = document.createElement('div')
+    root_element.appendChild(div_time)
+
+    while True:
+        div_time.innerText = datetime.utcnow().isoformat()
+
+        # the updates are rendered once and the same message is sent to every subscriber
+        await server.flush_shared('clock')
+
+        await asyncio.sleep(1)
+
+async def main():
+    server = DomsyncServer(connection_handler, 'localhost', 8888)
+    await server.serve()
+    await update_clock(server)
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
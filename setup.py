@@ -27,6 +27,7 @@ setup(
     license='BSD',
     packages=['domsync'],
     package_dir={'':'src'},
+    package_data={'domsync': ['domsync.js']},
     install_requires=[
         'websockets',
     ],
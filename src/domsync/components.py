@@ -18,7 +18,7 @@ class Component(dict):
         :param parent_el_or_id: an Element or an id of an Element in the Document under which the Component's root element shall be added
         :type parent_el_or_id: :class:`domsync.core._Element` or str
         """
-        assert type(parent_el) is _Element, [type(parent_el), parent_el]
+        assert isinstance(parent_el, _Element), [type(parent_el), parent_el]
         super(Component, self).__init__({
             'parent_el': parent_el,
         })
@@ -88,12 +88,20 @@ class TableComponent(Component):
         return self.table_el.id+'.td.'+row_id+'.'+col_id
 
     def addRow(self, row_id, values=None, sort_order=None):
-        "adds a row by keeping rows sorted by row_id"
+        "adds a row by keeping rows sorted by row_id, the row is built in a DocumentFragment so it's sent to the client in one operation"
         _row_id = self._row_id(row_id)
         if sort_order is not None:
             assert type(sort_order) in [int,float]
             self.sort_orders[_row_id] = sort_order
-        el_tr = self.getDocument().createElement('tr', id=_row_id)
+        fragment = self.getDocument().createDocumentFragment()
+        el_tr = fragment.createElement('tr', id=_row_id)
+        assert type(values) is not list or len(values) == len(self['columns'])
+        i = 0
+        for col_id in self['columns']:
+            value = None if values is None else values[i] if type(values) is list else values.get(col_id) if type(values) is dict else throw(type(values))
+            cell_id = self._cell_id(row_id, col_id)
+            el_tr.appendChild(fragment.createElement('td', id=cell_id, innerText=value))
+            i += 1
         table_el = self.table_el
         found = False
         for row_el in table_el.children:
@@ -128,13 +136,6 @@ class TableComponent(Component):
             table_el.insertBefore(el_tr, row_el)
         else:
             table_el.appendChild(el_tr)
-        assert type(values) is not list or len(values) == len(self['columns'])
-        i = 0
-        for col_id in self['columns']:
-            value = None if values is None else values[i] if type(values) is list else values.get(col_id) if type(values) is dict else throw(type(values))
-            cell_id = self._cell_id(row_id, col_id)
-            el_tr.appendChild(self.getDocument().createElement('td', id=cell_id, innerText=value))
-            i += 1
 
     def updateRow(self, row_id, values):
         assert type(values) is not list or len(values) == len(self['columns'])
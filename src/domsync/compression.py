@@ -0,0 +1,131 @@
+"""
+permessage-deflate websocket compression for :class:`domsync.domsync_server.DomsyncServer`.
+
+The updates sent by domsync are very repetitive (``__domsync__[...]``, ``.innerText = ``, the same ids over and over again) so they compress well,
+especially with a shared compression context across messages. Compressing tiny frames like a single ``innerText`` update saves next to nothing
+though while it still costs CPU on both ends, frames below ``min_size`` bytes are therefore sent uncompressed which permessage-deflate allows per message.
+
+:class:`CompressionStats` collects the number of frames, the bytes before and after compression and the time spent compressing,
+see :meth:`domsync.domsync_server.DomsyncServer.get_compression_stats`.
+"""
+import time
+from websockets import frames
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+
+
+class CompressionStats():
+    """
+    counters of the outgoing data frames of all connections of a server
+    """
+
+    def __init__(self):
+        self.frames = 0  # data frames sent
+        self.compressed_frames = 0  # data frames that were compressed
+        self.bytes_in = 0  # payload bytes before compression, all data frames
+        self.bytes_out = 0  # payload bytes after compression, all data frames
+        self.compressed_bytes_in = 0  # payload bytes before compression, compressed frames only
+        self.compressed_bytes_out = 0  # payload bytes after compression, compressed frames only
+        self.seconds = 0.0  # time spent compressing
+
+    def add(self, size_in, size_out, seconds, compressed):
+        self.frames += 1
+        self.bytes_in += size_in
+        self.bytes_out += size_out
+        if compressed:
+            self.compressed_frames += 1
+            self.compressed_bytes_in += size_in
+            self.compressed_bytes_out += size_out
+            self.seconds += seconds
+
+    def as_dict(self):
+        """
+        :returns: the counters along with the derived figures:
+                  ``ratio`` - bytes after / bytes before compression over all frames,
+                  ``compressed_ratio`` - the same over the compressed frames only,
+                  ``us_per_frame`` - microseconds spent compressing per compressed frame,
+                  ``us_per_kb`` - microseconds spent compressing per kilobyte of compressed payload
+        :rtype: dict
+        """
+        return {
+            'frames': self.frames,
+            'compressed_frames': self.compressed_frames,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'seconds': self.seconds,
+            'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 1.0,
+            'compressed_ratio': self.compressed_bytes_out / self.compressed_bytes_in if self.compressed_bytes_in else 1.0,
+            'us_per_frame': self.seconds * 1e6 / self.compressed_frames if self.compressed_frames else 0.0,
+            'us_per_kb': self.seconds * 1e6 * 1024 / self.compressed_bytes_in if self.compressed_bytes_in else 0.0,
+        }
+
+
+class _PerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate that leaves messages shorter than min_size uncompressed and records statistics
+    """
+
+    def __init__(self, remote_no_context_takeover, local_no_context_takeover, remote_max_window_bits, local_max_window_bits,
+                 compress_settings=None, min_size=0, stats=None):
+        super().__init__(remote_no_context_takeover, local_no_context_takeover, remote_max_window_bits, local_max_window_bits, compress_settings)
+        self.min_size = min_size
+        self.stats = stats
+        self.encode_cont_data = True  # whether the continuation frames of the current message are compressed
+
+    def encode(self, frame):
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is frames.OP_CONT:
+            if not self.encode_cont_data:
+                return frame
+        elif frame.fin and len(frame.data) < self.min_size:
+            # a whole message in a single small frame, the rsv1 bit stays unset which marks the message as uncompressed
+            self.encode_cont_data = False
+            if self.stats is not None:
+                self.stats.add(len(frame.data), len(frame.data), 0.0, False)
+            return frame
+        else:
+            self.encode_cont_data = True
+        t0 = time.perf_counter()
+        encoded = super().encode(frame)
+        if self.stats is not None:
+            self.stats.add(len(frame.data), len(encoded.data), time.perf_counter() - t0, True)
+        return encoded
+
+
+class _ServerPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, min_size, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+        self.stats = stats
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, ext = super().process_request_params(params, accepted_extensions)
+        ext = _PerMessageDeflate(ext.remote_no_context_takeover, ext.local_no_context_takeover, ext.remote_max_window_bits, ext.local_max_window_bits,
+                                 ext.compress_settings, min_size=self.min_size, stats=self.stats)
+        return response_params, ext
+
+
+def server_extensions(window_bits=12, memory_level=5, min_size=256, stats=None):
+    """
+    :param window_bits: base-two logarithm of the compression window of the server, 8 to 15. larger windows compress better and use more memory per connection
+    :type window_bits: int
+
+    :param memory_level: zlib memory level of the compressor, 1 to 9. higher levels are faster and compress better but use more memory per connection
+    :type memory_level: int
+
+    :param min_size: messages shorter than this many bytes are sent uncompressed
+    :type min_size: int
+
+    :param stats: optional, statistics to record the outgoing frames in
+    :type stats: :class:`CompressionStats`
+
+    :returns: the extension factories to pass to ``websockets.serve`` as ``extensions``
+    :rtype: list
+    """
+    assert 8 <= window_bits <= 15
+    assert 1 <= memory_level <= 9
+    assert min_size >= 0
+    return [_ServerPerMessageDeflateFactory(min_size, stats, server_max_window_bits=window_bits, client_max_window_bits=window_bits,
+                                            compress_settings={'memLevel': memory_level})]
+
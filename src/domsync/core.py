@@ -1,3 +1,13 @@
+import pickle
+import weakref
+import zlib
+from types import MappingProxyType
+from domsync.selector import select
+from domsync.protocol import (OP_INIT, OP_CREATE, OP_APPEND_CHILD, OP_INSERT_BEFORE, OP_REMOVE, OP_REPLACE_CHILDREN, OP_SET_ATTRIBUTE,
+                              OP_REMOVE_ATTRIBUTE, OP_ADD_EVENT_LISTENER, OP_SET_INNER_TEXT, OP_SET_VALUE, OP_INSERT_FRAGMENT)
+from domsync.protocol import render, get_protocol, str_is_safe, str_escape_for_js
+from domsync.serializer import serialize, replay_ops, state_ops
+
 # copied from https://way2tutorial.com/html/tag/index.php
 _valid_tags = ["a", "abbr", "address", "area", "b", "base", "bdo", "blockquote", "body", "br", "button", "caption", "cite", "code", "col", "colgroup", "dd", "del", "dfn", "div", "dl", "dt", "em", "fieldset", "form", "h1", "h2", "h3", "h4", "h5", "h6", "head", "hr", "html", "i", "iframe", "img", "input", "ins", "kbd", "label", "legend", "li", "link", "map", "menu", "meta", "noscript", "object", "ol", "optgroup", "option", "p", "param", "pre", "q", "s", "samp", "script", "select", "small", "span", "strong", "style", "sub", "sup", "table", "tbody", "td", "textarea", "tfoot", "th", "thead", "title", "tr", "u", "ul", "var"]
 
@@ -5,11 +15,78 @@ _valid_tags = ["a", "abbr", "address", "area", "b", "base", "bdo", "blockquote",
 _valid_events = ["abort", "afterprint", "animationend", "animationiteration", "animationstart", "beforeprint", "beforeunload", "blur", "canplay", "canplaythrough", "change", "click", "contextmenu", "copy", "cut", "dblclick", "drag", "dragend", "dragenter", "dragleave", "dragover", "dragstart", "drop", "durationchange", "ended", "error", "focus", "focusin", "focusout", "fullscreenchange", "fullscreenerror", "hashchange", "input", "invalid", "keydown", "keypress", "keyup", "load", "loadeddata", "loadedmetadata", "loadstart", "message", "mousedown", "mouseenter", "mouseleave", "mousemove", "mouseover", "mouseout", "mouseup", "mousewheel", "offline", "online", "open", "pagehide", "pageshow", "paste", "pause", "play", "playing", "popstate", "progress", "ratechange", "resize", "reset", "scroll", "search", "seeked", "seeking", "select", "show", "stalled", "storage", "submit", "suspend", "timeupdate", "toggle", "touchcancel", "touchend", "touchmove", "touchstart", "transitionend", "unload", "volumechange", "waiting", "wheel", ]
 
 
-class _Element(dict):  # _Element is private because we are only meant to create an instance through Document.createElement
+_no_attributes = MappingProxyType({})  # shared read-only attributes of elements without any attributes
+
+_element_ops = frozenset([OP_SET_ATTRIBUTE, OP_REMOVE_ATTRIBUTE, OP_ADD_EVENT_LISTENER, OP_SET_INNER_TEXT, OP_SET_VALUE])  # ops that only affect the element itself
+
+# the snapshot of an element whose subtree is part of the cached snapshot of an ancestor, the element has no cached snapshot of its own
+# but a change still has to drop the cached snapshot of the ancestor, see _Element._invalidate
+_COVERED = MappingProxyType({})
+
+_POS_GAP = 1 << 16  # gap between the position keys of consecutive children, leaves room for insertBefore without renumbering
+
+
+class _ChildList():
+    """
+    read-only, live view of the children of an element in order, analogous to the Javascript HTMLCollection returned by element.children.
+    children are stored as a doubly linked list of siblings so iteration is cheap but integer indexing walks the list.
+    """
+
+    __slots__ = ('_el',)
+
+    def __init__(self, el):
+        self._el = el
+
+    def __len__(self):
+        return self._el._nchildren
+
+    def __iter__(self):
+        child = self._el._first
+        while child is not None:
+            yield child
+            child = child._next
+
+    def __reversed__(self):
+        child = self._el._last
+        while child is not None:
+            yield child
+            child = child._prev
+
+    def __contains__(self, el):
+        return isinstance(el, _Element) and el._parent is self._el
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        n = self._el._nchildren
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('child index out of range')
+        if i < n // 2:
+            it = iter(self)
+        else:
+            it = reversed(self)
+            i = n - 1 - i
+        for _ in range(i):
+            next(it)
+        return next(it)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _Element():  # _Element is private because we are only meant to create an instance through Document.createElement
     """:class:`domsync.core._Element` is analogous to the Javascript Element which represents an individual HTML element.
     The name of the class starts with an underscore, expressing the fact that this class should not be instantiated by the user,
     instead all instances of this class are created by :meth:`domsync.Document.createElement`.
 
+    Elements use ``__slots__`` instead of a per-instance ``dict`` to keep the memory footprint of large documents small,
+    the ``attributes`` container is only allocated once the element gets its first attribute.
+    Children are kept in a doubly linked list of siblings, so ``appendChild``, ``insertBefore`` and ``remove`` don't depend on the number of siblings.
+    Each child also has an integer position key that increases along its siblings, which allows comparing the order of two siblings without scanning.
+    Elements also cache the rendered full snapshot of their subtree, see :meth:`domsync.Document.render_full_chunks`.
+
     :param document: document to create the element within
     :type document: :class:`domsync.Document`
 
@@ -25,57 +102,202 @@ class _Element(dict):  # _Element is private because we are only meant to create
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].innerText = `{innerText}`;
+          __domsync__[{self.handle}].innerText = `{innerText}`;
 
     * **value** - sets and gets the element's value, analogous to Javascript element.value. When used as a setter, generates the following Javascript code:
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].value = `{value}`;
+          __domsync__[{self.handle}].value = `{value}`;
 
     * **tagName** - gets the element's tagName, analogous to Javascript element.tagName
-    * **children** - gets the element's list of child elements, analogous to Javascript element.children
+    * **children** - gets a live read-only view of the element's child elements in order, analogous to Javascript element.children
     * **firstElementChild** - gets the element's first child element, analogous to Javascript element.firstElementChild
     * **lastElementChild** - gets the element's last child element, analogous to Javascript element.lastElementChild
+    * **nextElementSibling** - gets the element's next sibling element, analogous to Javascript element.nextElementSibling
+    * **previousElementSibling** - gets the element's previous sibling element, analogous to Javascript element.previousElementSibling
+    * **parentElement** - gets the element's parent element, analogous to Javascript element.parentElement
     * **attributes** - gets the element's dictionary of attributes
     * **id** - gets the element's id
 
+    In the generated Javascript code elements are not addressed by their id but by a small integer handle that the :class:`domsync.Document` assigns to
+    each element, which keeps the updates short even when ids are long. Handles of removed elements are reused for new elements after the next
+    ``render_js_updates``. Ids are still set as the id attribute of the elements in the Browser.
+
     """
 
-    def __init__(self, document, id, tagName):
+    __slots__ = ('_document', '_id', '_handle', '_tag', '_parent', '_first', '_last', '_prev', '_next', '_pos', '_nchildren', '_attributes', '_innerText', '_value',
+                 '_fragment', '_snapshot', '__weakref__')
+
+    def __init__(self, document, id, tagName, fragment=None):
         assert tagName in _valid_tags
-        super(_Element, self).__init__({
-            'document': document,
-            'id': id,
-            'tag': tagName,
-            'children': [],
-            'parent': None,
-            'attributes': {},
-            'innerText': None,
-            'value': None,
-        })
+        self._document = document
+        self._fragment = fragment  # the DocumentFragment the element was created in until it gets attached to the document, see DocumentFragment
+        self._id = id
+        self._handle = document._alloc_handle()
+        self._tag = tagName
+        self._parent = None
+        self._first = None  # first child
+        self._last = None  # last child
+        self._prev = None  # previous sibling
+        self._next = None  # next sibling
+        self._pos = 0  # position key among the siblings, see _link_before
+        self._nchildren = 0
+        self._attributes = None  # created on the first setAttribute
+        self._innerText = None
+        self._value = None
+        self._snapshot = None  # protocol name -> rendered full snapshot of the subtree, see Document.render_full_chunks
 
     def __repr__(self):
-        return repr({k: (v if k != 'document' else "Document_"+str(id(v))) for k, v in self.items()})
+        return '_Element(' + repr({
+            'document': "Document_"+str(id(self._document)),
+            'id': self._id,
+            'tag': self._tag,
+            'children': [el._id for el in self.children],
+            'parent': None if self._parent is None else self._parent._id,
+            'attributes': dict(self.attributes),
+            'innerText': self._innerText,
+            'value': self._value,
+        }) + ')'
 
     def __str__(self):
         return self.__repr__()
 
-    def _js_push(self, line):
-        self['document']._js_push(line)
+    def _push_op(self, op):
+        if self._fragment is None:  # elements of a DocumentFragment are sent to the client when they get attached to the document
+            self._invalidate()
+            ops = self._document['ops']
+            if not ops:
+                self._document._mark_dirty()
+            ops.append(op)
+
+    def _invalidate(self):
+        """
+        drops the cached snapshots of self and its ancestors. an element without a cached snapshot (None) never has an ancestor with one,
+        so the walk stops at the first element that has nothing cached. the elements within a cached subtree are marked with _COVERED.
+        """
+        el = self
+        while el is not None and el._snapshot is not None:
+            el._snapshot = None
+            el = el._parent
+
+    @property
+    def id(self):
+        # NOTE: this is not in JS, only for us for convenience. in JS should be self.getAttribute('id')
+        return self._id
+
+    @property
+    def tagName(self):
+        return self._tag
+
+    @property
+    def parentElement(self):
+        return self._parent
+
+    @property
+    def children(self):
+        return _ChildList(self)
+
+    @property
+    def firstElementChild(self):
+        return self._first
+
+    @property
+    def lastElementChild(self):
+        return self._last
+
+    @property
+    def nextElementSibling(self):
+        return self._next
+
+    @property
+    def previousElementSibling(self):
+        return self._prev
+
+    @property
+    def attributes(self):
+        return self._attributes if self._attributes is not None else _no_attributes
+
+    @property
+    def innerText(self):
+        return self._innerText
+
+    @innerText.setter
+    def innerText(self, text):
+        self._setInnerText(text)
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._setValue(value)
+
+    def _link_before(self, el_child, el_next):
+        """
+        links el_child into the list of children before el_next, or as the last child if el_next is None
+        """
+        prev = self._last if el_next is None else el_next._prev
+        el_child._parent = self
+        el_child._prev = prev
+        el_child._next = el_next
+        if prev is None:
+            self._first = el_child
+        else:
+            prev._next = el_child
+        if el_next is None:
+            self._last = el_child
+        else:
+            el_next._prev = el_child
+        self._nchildren += 1
+        if el_next is None:
+            el_child._pos = 0 if prev is None else prev._pos + _POS_GAP
+        else:
+            lo = el_next._pos - 2 * _POS_GAP if prev is None else prev._pos
+            pos = (lo + el_next._pos) // 2
+            if pos == lo:
+                # ran out of room between the two siblings, spread the position keys out again
+                self._renumber_children()
+            else:
+                el_child._pos = pos
+
+    def _unlink(self):
+        """
+        unlinks self from the list of children of its parent
+        """
+        parent = self._parent
+        if self._prev is None:
+            parent._first = self._next
+        else:
+            self._prev._next = self._next
+        if self._next is None:
+            parent._last = self._prev
+        else:
+            self._next._prev = self._prev
+        parent._nchildren -= 1
+        self._parent = self._prev = self._next = None
+
+    def _renumber_children(self):
+        pos = 0
+        child = self._first
+        while child is not None:
+            child._pos = pos
+            pos += _POS_GAP
+            child = child._next
 
     def getDocument(self):
         """
         :returns: the Document instance in which the Element lives
         :rtype: :class:`domsync.Document`
         """
-        return self['document']
+        return self._document
 
     def appendChild(self, el_child):
         """
         append a chld element to self
 
-        :param el_child: child element to append
+        :param el_child: child element to append, or a :class:`domsync.core.DocumentFragment` in which case all of its elements are appended
         :type el_child: :class:`domsync.core._Element`
 
         :returns: None
@@ -84,40 +306,83 @@ class _Element(dict):  # _Element is private because we are only meant to create
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].appendChild(__domsync__["{el_child.id}"]);
+          __domsync__[{self.handle}].appendChild(__domsync__[{el_child.handle}]);
+
+        Elements of a :class:`domsync.core.DocumentFragment` are sent as one operation containing the HTML of the whole subtree, see :class:`domsync.core.DocumentFragment`.
         """
-        assert isinstance(el_child, _Element)
-        assert not self.get('innerHTML_flag', False), "this element has some innerHTML, remove it first by self.innerHTML = "" before adding children"
-        assert el_child is self['document'].getElementById(el_child['id'])
-        assert el_child.parentElement is None, "child is already under a parent"
-        el_child['parent'] = self
-        self['children'].append(el_child)
-        self._js_push(f"""__domsync__["{self.id}"].appendChild(__domsync__["{el_child.id}"]);\n""")
+        self._insert(el_child, None)
 
     def insertBefore(self, el_child_to_insert, el_child_before):
         """
         inserts an element as a child before an existing child element
 
+        :param el_child_to_insert: element to insert, or a :class:`domsync.core.DocumentFragment` in which case all of its elements are inserted
+        :type el_child_to_insert: :class:`domsync.core._Element`
+
         :returns: None
 
         analogous to Javascript Element.insertBefore, generates the following Javascript code:
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].insertBefore(__domsync__["{el_child_to_insert.id}"], __domsync__["{el_child_before.id}"]);
-        """
-        assert isinstance(el_child_to_insert, _Element)
-        assert not self.get('innerHTML_flag', False), "this element has some innerHTML, remove it first by self.innerHTML = "" before adding children"
-        assert el_child_to_insert.parentElement is None, "child is already under a parent"
-        el_child_to_insert['parent'] = self
-        found = False
-        for i in range(len(self['children'])):
-            if self['children'][i] is el_child_before:
-                found = True
-                break
-        assert found
-        self['children'].insert(i, el_child_to_insert)
-        self._js_push(f"""__domsync__["{self.id}"].insertBefore(__domsync__["{el_child_to_insert.id}"], __domsync__["{el_child_before.id}"]);\n""")
+          __domsync__[{self.handle}].insertBefore(__domsync__[{el_child_to_insert.handle}], __domsync__[{el_child_before.handle}]);
+        """
+        assert isinstance(el_child_before, _Element) and el_child_before._parent is self
+        self._insert(el_child_to_insert, el_child_before)
+
+    def _insert(self, el_child, el_next):
+        """
+        links el_child (an element or a DocumentFragment) under self before el_next, or as the last child if el_next is None, and records the operation
+        """
+        if isinstance(el_child, DocumentFragment):
+            assert el_child._document is self._document
+            elements = list(el_child._children.values())
+            el_child._children.clear()
+        else:
+            assert isinstance(el_child, _Element)
+            assert el_child is self._document.getElementById(el_child._id)
+            assert el_child._parent is None, "child is already under a parent"
+            assert el_child is not self
+            elements = [el_child]
+        for el in elements:
+            if self._fragment is not None:
+                assert el._fragment is self._fragment, "only elements of the same DocumentFragment can be appended to an element of a DocumentFragment"
+            if el._fragment is not None:
+                el._fragment._children.pop(id(el), None)
+            self._link_before(el, el_next)
+        if self._fragment is not None or not elements:
+            return
+        if elements[0]._fragment is not None:
+            self._attach_fragment(elements, el_next)
+        elif el_next is None:
+            self._push_op((OP_APPEND_CHILD, self, el_child))
+        else:
+            self._push_op((OP_INSERT_BEFORE, self, el_child, el_next))
+
+    def _attach_fragment(self, elements, el_next):
+        """
+        records the operations that create the subtrees of elements built in a DocumentFragment under self on the client side,
+        as one OP_INSERT_FRAGMENT if the subtrees can be represented as HTML, otherwise one operation per element and property
+        """
+        document = self._document
+        self._invalidate()
+        serialized = serialize(elements, document['callbacks'])
+        if serialized is None:
+            ops = list(replay_ops(self, elements, el_next, document['callbacks']))
+        else:
+            html, subtree, ops = serialized
+            ops.insert(0, (OP_INSERT_FRAGMENT, self, el_next, html, tuple(subtree)))
+        stack = list(elements)
+        while stack:
+            el = stack.pop()
+            el._fragment = None
+            child = el._first
+            while child is not None:
+                stack.append(child)
+                child = child._next
+        if not document['ops']:
+            document._mark_dirty()
+        document['ops'].extend(ops)
 
     def remove(self):
         """
@@ -129,28 +394,118 @@ class _Element(dict):  # _Element is private because we are only meant to create
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].remove();
-        """
-        _id = self['id']
-        assert _id in self['document']['elements_by_id']
-        parent = self.parentElement
-        len_before = len(parent['children'])
-        parent['children'] = [el for el in parent['children'] if el['id'] != _id]
-        len_after = len(parent['children'])
-        assert len_after == len_before - 1, len_before
-        self._js_push(f"""__domsync__["{self.id}"].remove();\n""")
-
-        del self['document']['elements_by_id'][_id]
-        if _id in self['document']['callbacks']:
-            del self['document']['callbacks'][_id]
-        to_remove = [el['id'] for el in self['children']]
-        while len(to_remove):
-            _id = to_remove.pop(0)
-            element = self['document']['elements_by_id'][_id]
-            del self['document']['elements_by_id'][_id]
-            if _id in self['document']['callbacks']:
-                del self['document']['callbacks'][_id]
-            to_remove.extend([el['id'] for el in element['children']])
+          __domsync__[{self.handle}].remove();
+        """
+        assert self._id in self._document['elements_by_id']
+        assert self._parent is not None
+        self._invalidate()
+        self._unlink()
+        self._push_op((OP_REMOVE, self))
+        self._teardown()
+
+    def replaceChildren(self, *new_children):
+        """
+        replaces all children of the element with the given elements. The current children that are not among ``new_children`` are removed
+        along with all of their child elements recursively. Elements in ``new_children`` must either be current children of this element or not be under any parent.
+
+        :param new_children: the new child elements in order
+        :type new_children: :class:`domsync.core._Element`
+
+        :returns: None
+
+        analogous to Javascript Element.replaceChildren, generates one line of Javascript code regardless of the number of children:
+
+        .. code-block:: javascript
+
+          __domsync__[{self.handle}].replaceChildren(__domsync__[{new_children[0].handle}], __domsync__[{new_children[1].handle}], ...);
+        """
+        for el in new_children:
+            assert isinstance(el, _Element)
+            assert el is self._document.getElementById(el._id)
+            assert el._parent is None or el._parent is self, "child is already under a parent"
+            assert el is not self
+            assert el._fragment is self._fragment, "elements of a DocumentFragment can be attached with appendChild or insertBefore"
+        kept = {id(el) for el in new_children}
+        assert len(kept) == len(new_children), "duplicate child"
+        child = self._first
+        self._first = self._last = None
+        self._nchildren = 0
+        while child is not None:
+            next_child = child._next
+            child._parent = child._prev = child._next = None
+            if id(child) not in kept:
+                child._teardown()
+            child = next_child
+        for el in new_children:
+            self._link_before(el, None)
+        self._push_op((OP_REPLACE_CHILDREN, self, new_children))
+
+    def clearChildren(self):
+        """
+        removes all children of the element along with all of their child elements recursively.
+        This is not in Javascript, equivalent to calling ``replaceChildren`` without arguments, generates the following Javascript code:
+
+        .. code-block:: javascript
+
+          __domsync__[{self.handle}].replaceChildren();
+
+        :returns: None
+        """
+        self.replaceChildren()
+
+    def _teardown(self):
+        """
+        unregisters self and all descendants from the document in one pass over the subtree.
+        the subtree itself is left intact so references held to removed elements can still be inspected.
+        """
+        document = self._document
+        elements_by_id = document['elements_by_id']
+        elements_by_tag = document['elements_by_tag']
+        callbacks = document['callbacks']
+        released_handles = document['released_handles']
+        stack = [self]
+        while stack:
+            el = stack.pop()
+            del elements_by_id[el._id]
+            del elements_by_tag[el._tag][el._id]
+            released_handles.append(el._handle)
+            callbacks.pop(el._id, None)
+            el._snapshot = None
+            if el._attributes is not None and el._attributes.get('class'):
+                document._index_classes(el, el._attributes['class'], None)
+            child = el._first
+            while child is not None:
+                stack.append(child)
+                child = child._next
+
+    def querySelector(self, selectors):
+        """
+        returns the first descendant element in document order that matches the selectors, see :mod:`domsync.selector` for the supported syntax
+
+        :param selectors: one or more CSS selectors separated by commas
+        :type selectors: str
+
+        :returns: the first matching element or None if there is no match
+        :rtype: :class:`domsync.core._Element`
+
+        analogous to Javascript Element.querySelector, doesn't generate Javascript code.
+        """
+        res = select(self, selectors, first=True)
+        return res[0] if res else None
+
+    def querySelectorAll(self, selectors):
+        """
+        returns all descendant elements that match the selectors in document order, see :mod:`domsync.selector` for the supported syntax
+
+        :param selectors: one or more CSS selectors separated by commas
+        :type selectors: str
+
+        :returns: the matching elements
+        :rtype: list of :class:`domsync.core._Element`
+
+        analogous to Javascript Element.querySelectorAll, doesn't generate Javascript code.
+        """
+        return select(self, selectors)
 
     def getAttribute(self, attrib, default=None):
         """
@@ -166,7 +521,9 @@ class _Element(dict):  # _Element is private because we are only meant to create
         analogous to Javascript Element.getAttribute, doesn't generate Javascript code.
         """
         assert attrib != 'id' and type(attrib) is str
-        return self['attributes'].get(attrib, default)
+        if self._attributes is None:
+            return default
+        return self._attributes.get(attrib, default)
 
     def setAttribute(self, attrib, value):
         """
@@ -184,19 +541,20 @@ class _Element(dict):  # _Element is private because we are only meant to create
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].setAttribute("{attrib}","{value}");
+          __domsync__[{self.handle}].setAttribute("{attrib}","{value}");
         """
         assert str_is_safe(attrib)
         assert attrib != 'id' and type(attrib) is str and type(value) is str
         if attrib.startswith('on'):
             assert attrib[2:] not in _valid_events, "please use addEventListener to add an event"
-        if attrib.startswith('on'):
-            # https://stackoverflow.com/questions/97578/how-do-i-escape-a-string-inside-javascript-code-inside-an-onclick-handler
-            # need to escape quotes in code string
-            value = str_escape_for_js(value)
-        if self['attributes'].get(attrib) != value:
-            self['attributes'][attrib] = value
-            self._js_push(f"""__domsync__["{self.id}"].setAttribute("{attrib}","{value}");\n""")
+        if self._attributes is None:
+            self._attributes = {}
+        old_value = self._attributes.get(attrib)
+        if old_value != value:
+            if attrib == 'class':
+                self._document._index_classes(self, old_value, value)
+            self._attributes[attrib] = value
+            self._push_op((OP_SET_ATTRIBUTE, self, attrib, value))
 
     def removeAttribute(self, attrib):
         """
@@ -211,13 +569,15 @@ class _Element(dict):  # _Element is private because we are only meant to create
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].removeAttribute("{attrib}");
+          __domsync__[{self.handle}].removeAttribute("{attrib}");
         """
         assert attrib != 'id' and type(attrib) is str
-        del self['attributes'][attrib]
-        self._js_push(f"""__domsync__["{self.id}"].removeAttribute("{attrib}");\n""")
+        old_value = self._attributes.pop(attrib)
+        if attrib == 'class':
+            self._document._index_classes(self, old_value, None)
+        self._push_op((OP_REMOVE_ATTRIBUTE, self, attrib))
 
-    def addEventListener(self, event, callback, js_value_getter=None):
+    def addEventListener(self, event, callback, js_value_getter=None, throttle_ms=None, debounce_ms=None, latest_only=False):
         """
         adds an event listener to the element
 
@@ -229,6 +589,7 @@ class _Element(dict):  # _Element is private because we are only meant to create
                          | 'id': id of the element that the event happened on
                          | 'doc': :class:`domsync.Document` instance
                          | 'value': value returned as a result of evaluating js_value_getter (see below)
+                         | it can also be a coroutine function, see :class:`domsync.domsync_server.DomsyncServer`
         :type callback: Callable(dict)
 
         :param js_value_getter: | a javascript expression that is executed in the context of the event and the return value of which is retrned in the 'value' field of the event message.
@@ -237,100 +598,130 @@ class _Element(dict):  # _Element is private because we are only meant to create
                                 | In case of a 'click' event of a <button> there is no need to specify a js_value_getter because the click event doesn't carry any relevant value (apart form the fact that the event happened).
         :type js_value_getter: str
 
+        :param throttle_ms: optional, the client sends at most one event every ``throttle_ms`` milliseconds, the first one right away and the last one at the end of the period.
+        :type throttle_ms: int
+
+        :param debounce_ms: optional, the client sends the event only after no new event happened for ``debounce_ms`` milliseconds.
+        :type debounce_ms: int
+
+        :param latest_only: optional, the client sends at most one event per animation frame. default = False.
+        :type latest_only: bool
+
+        At most one of ``throttle_ms``, ``debounce_ms`` and ``latest_only`` can be used. They are meant for high-frequency events like 'input', 'mousemove', 'scroll' or 'wheel'
+        where only the latest value matters: ``js_value_getter`` is evaluated when the event is sent, not when it happened, and
+        :class:`domsync.domsync_server.DomsyncServer` also drops the events of such listeners that were superseded by a newer one while waiting to be handled.
+
         :returns: None
 
         analogous to Javascript addEventListener, generates the following Javascript code:
 
         .. code-block:: javascript
 
-          __domsync__["{self.id}"].addEventListener("{event}",function(){ws_send({"event":"{event}","id":"{self.id}","value":{js_value_getter}})});
+          __domsync__[{self.handle}].addEventListener("{event}",function(){ws_send({"event":"{event}","id":"{self.id}","value":{js_value_getter}})});
         """
         assert event in _valid_events
-        event_msg = {
-            'domsync': True,
-            'event': event,
-            'id': self['id'],
-            'value': js_value_getter,
-        }
-        import json
-        event_msg = json.dumps(event_msg)
-        if js_value_getter is not None:
-            event_msg = event_msg.replace('"'+js_value_getter+'"', js_value_getter)
-        callback_js = r"function(){ws_send("+event_msg+r")}"
-        self['document']._register_callback(self['id'], event, callback, js_value_getter)
-        self._js_push(f"""__domsync__["{self.id}"].addEventListener("{event}",{callback_js});\n""")
-
-    # def _setInnerHTML(self, innerHTML):
-    #     """
-    #     analogous to Javascript Element.innerHTML = innerHTML
-    #     """
-    #     assert type(innerHTML) is str
-    #     # NOTE: in our representation we store innerHTML in self['innerText']
-    #     #       also, we allow no innerHTML setting if the element has children
-    #     assert len(self['children']) == 0, "cannot have children if setting innerHTML"
-    #     if innerHTML != self['innerText']:
-    #         self['innerText'] = innerHTML
-    #         self['innerHTML_flag'] = True if len(innerHTML)>0 else False
-    #         self._js_push(f"""__domsync__["{self['id']}"].innerHTML = "{innerHTML}";\n""")
-
-    # def _getInnerHTML(self):
-    #     """
-    #     analogous to Javascript Element.innerHTML
-    #     """
-    #     assert self['innerHTML_flag'] == True, "can only access innerHTML if it was set with innerHTML"
-    #     return self['innerText']
+        assert (throttle_ms is not None) + (debounce_ms is not None) + bool(latest_only) <= 1, "use only one of throttle_ms, debounce_ms and latest_only"
+        if throttle_ms is not None:
+            assert throttle_ms > 0
+            rate = ('throttle', throttle_ms)
+        elif debounce_ms is not None:
+            assert debounce_ms > 0
+            rate = ('debounce', debounce_ms)
+        elif latest_only:
+            rate = ('frame', 0)
+        else:
+            rate = None
+        self._document._register_callback(self._id, event, callback, js_value_getter, rate)
+        self._push_op((OP_ADD_EVENT_LISTENER, self, event, js_value_getter, rate))
 
     def _setInnerText(self, text):
         """
         analogous to Javascript Element.innerText = text
         """
         assert type(text) is str, "we don't allow any other types than str to be stored in the DOM because we didn't want to make parsing/rendering/formatting part of the DOM, that should happen outside"
-        if text != self['innerText']:
-            self['innerText'] = text
-            self._js_push(f"""__domsync__["{self['id']}"].innerText = `{text}`;\n""")
+        if text != self._innerText:
+            self._innerText = text
+            self._push_op((OP_SET_INNER_TEXT, self, text))
 
     def _setValue(self, value):
         """
         analogous to Javascript Element.value = value
         """
         assert type(value) is str, "we don't allow any other types than str to be stored in the DOM because we didn't want to make parsing/rendering/formatting part of the DOM, that should happen outside"
-        if value != self['value']:
-            self['value'] = value
-            self._js_push(f"""__domsync__["{self['id']}"].value = `{value}`;\n""")
-
-    def __setattr__(self, name, value):
-        if name == 'innerText':
-            self._setInnerText(value)
-        # elif name == 'innerHTML':
-        #     self._setInnerHTML(value)
-        elif name == 'value':
-            self._setValue(value)
-        else:
-            raise Exception('unsupported attribute: ' + str(name) + ' of type ' + str(type(name)))
-
-    def __getattr__(self, name):
-        if name == 'innerText':
-            return self['innerText']
-        # elif name == 'innerHTML':
-        #     return self._getInnerHTML()
-        elif name == 'value':
-            return self['value']
-        elif name == 'tagName':
-            return self['tag']
-        elif name == 'children':
-            return self['children']
-        elif name == 'firstElementChild':
-            return self['children'][0]
-        elif name == 'lastElementChild':
-            return self['children'][-1]
-        elif name == 'attributes':
-            return self['attributes']
-        elif name == 'id':  # NOTE: this is not in JS, only for us for convenience. in JS should be self.getAttribute('id')
-            return self['id']
-        elif name == 'parentElement':
-            return self['parent']
-        else:
-            raise Exception('unsupported attribute: ' + str(name) + ' of type ' + str(type(name)))
+        if value != self._value:
+            self._value = value
+            self._push_op((OP_SET_VALUE, self, value))
+
+
+class DocumentFragment():
+    """:class:`domsync.core.DocumentFragment` is analogous to the Javascript DocumentFragment, a lightweight container for building a subtree of elements
+    before attaching it to the document. Instances are created by :meth:`domsync.Document.createDocumentFragment`.
+
+    Elements created with :meth:`domsync.core.DocumentFragment.createElement` live in the :class:`domsync.Document` like any other element,
+    but their changes don't generate Javascript code until they are attached to an element of the document with ``appendChild`` or ``insertBefore``,
+    either one by one or by passing the fragment itself which attaches all of its elements. At that point the whole subtree is sent to the client
+    as one operation containing its HTML, which the Browser parses in one go:
+
+    .. code-block:: javascript
+
+        (function(t){t.innerHTML="<tr id=\"row0\"><td id=\"cell0\">1</td></tr>";...;__domsync__[{parent.handle}].insertBefore(t.content,null);})(document.createElement("template"));
+
+    Event listeners, values and anything that can't be expressed in HTML follow as separate operations. Subtrees that the HTML parser would restructure,
+    like a ``<tr>`` directly under a ``<table>``, are sent as separate operations for each element instead.
+
+    :param document: document to create the fragment within
+    :type document: :class:`domsync.Document`
+    """
+
+    __slots__ = ('_document', '_children')
+
+    def __init__(self, document):
+        self._document = document
+        self._children = {}  # id(element) -> element, the top-level elements of the fragment in order
+
+    def __repr__(self):
+        return 'DocumentFragment(' + repr([el._id for el in self._children.values()]) + ')'
+
+    def getDocument(self):
+        """
+        :returns: the Document instance in which the DocumentFragment lives
+        :rtype: :class:`domsync.Document`
+        """
+        return self._document
+
+    @property
+    def children(self):
+        return list(self._children.values())
+
+    @property
+    def firstElementChild(self):
+        return next(iter(self._children.values()), None)
+
+    def createElement(self, tagName, id=None, innerText=None, value=None, attributes=None):
+        """
+        Creates a new element that belongs to the fragment, it takes the same arguments as :meth:`domsync.Document.createElement`.
+        The element can be appended to other elements of the fragment or to the fragment itself, doesn't generate Javascript code.
+
+        :return: the newly created element
+        :rtype: :class:`domsync.core._Element`
+        """
+        return self._document._createElement(tagName, id, innerText, value, attributes, fragment=self)
+
+    def appendChild(self, el_child):
+        """
+        appends an element created by this fragment to the top level of the fragment
+
+        :param el_child: element to append
+        :type el_child: :class:`domsync.core._Element`
+
+        :returns: None
+
+        analogous to Javascript DocumentFragment.appendChild, doesn't generate Javascript code.
+        """
+        assert isinstance(el_child, _Element)
+        assert el_child._fragment is self, "only elements created by the DocumentFragment can be appended to it"
+        assert el_child._parent is None, "child is already under a parent"
+        self._children[id(el_child)] = el_child
 
 
 class Document(dict):
@@ -346,28 +737,54 @@ class Document(dict):
     .. code-block:: javascript
 
         var __domsync__ = [];
-        __domsync__["{root_id}"] = document.getElementById("{root_id}");
+        __domsync__[0] = document.getElementById("{root_id}");
     """
 
     def __init__(self, root_id):
         """Constructor method
         """
         root_tag = 'div'  # doesn't matter what the tag of the root element actually is, we store it as div in our representatiopn just to have a valid tag
-        root_el = _Element(self, root_id, root_tag)
         super(Document, self).__init__({
-            'elements_by_id': {  # returns the element of an id
-                root_id: root_el,
-            },
-            'js_buffer': [],
+            'elements_by_id': {},  # returns the element of an id
+            'elements_by_tag': {},  # tag name -> {id -> element}
+            'elements_by_class': {},  # class name -> {id -> element}, maintained by setAttribute and removeAttribute
+            'ops': [],  # operations since the last render_js_updates, see OP_*
             'id_autoinc': 0,
             'root_id': root_id,
             'callbacks': {},
+            'handle_autoinc': 0,
+            'free_handles': [],  # handles of removed elements that can be reused
+            'released_handles': [],  # handles of elements removed since the last render, they become free after rendering
+            'on_dirty': None,  # called with the document when the first change is recorded after a render, see _mark_dirty
+            'ops_rendered': 0,  # number of operations recorded before the last render, see _op_total
+            'profiler': None,  # times the event listener callbacks if set, see domsync.profiler.CallbackProfiler
         })
-        self._js_push("var __domsync__ = [];\n")
-        self._js_push(f"""__domsync__["{root_id}"] = document.getElementById("{root_id}");\n""")
+        root_el = _Element(self, root_id, root_tag)
+        assert root_el._handle == 0
+        self['elements_by_id'][root_id] = root_el
+        self['elements_by_tag'][root_tag] = {root_id: root_el}
+        root_el._push_op((OP_INIT, root_el))
 
-    def _js_push(self, line):
-        self['js_buffer'].append(line)
+    def _mark_dirty(self):
+        """
+        called when the first operation is recorded since the last render, lets a server know which documents have updates to send
+        without checking every document
+        """
+        if self['on_dirty'] is not None:
+            self['on_dirty'](self)
+
+    def _op_total(self):
+        """
+        returns the number of operations recorded since the document was created
+        """
+        return self['ops_rendered'] + len(self['ops'])
+
+    def _alloc_handle(self):
+        if self['free_handles']:
+            return self['free_handles'].pop()
+        handle = self['handle_autoinc']
+        self['handle_autoinc'] += 1
+        return handle
 
     def _get_autoinc_id(self):
         _id = '__domsync_el_'+str(self['id_autoinc'])
@@ -407,22 +824,32 @@ class Document(dict):
         """
         Returns a list of elements with the specified class name
 
-        :param className: class name of the element
+        :param className: class name of the element, or several class names separated by whitespace in which case elements having all of the classes are returned
         :type className: str
 
         :return: the elements of the given class name
         :rtype: list of :class:`domsync.core._Element`
 
-        analogous to Javascript document.getElementsByClassName, doesn't generate Javascript code
+        analogous to Javascript document.getElementsByClassName, doesn't generate Javascript code.
+        The lookup uses an index of class names that is maintained as the ``class`` attributes of elements change, so it costs in proportion
+        to the number of elements having the class, not the size of the document.
         """
-        classNames = className.split(' ')
-        return [el for el in self['elements_by_id'].values() if el.getAttribute('class') in classNames]
+        classNames = className.split()
+        if len(classNames) == 0:
+            return []
+        index = self['elements_by_class']
+        candidates = [index.get(name) for name in classNames]
+        if None in candidates:
+            return []
+        candidates.sort(key=len)
+        smallest, others = candidates[0], candidates[1:]
+        return [el for _id, el in smallest.items() if all(_id in other for other in others)]
 
     def getElementsByTagName(self, tagName):
         """
         Returns a list of elements with the specified tag name
 
-        :param tagName: tag name of the element
+        :param tagName: tag name of the element, ``'*'`` or ``''`` returns all elements
         :type tagName: str
 
         :return: the elements of the given tag
@@ -430,7 +857,54 @@ class Document(dict):
 
         analogous to Javascript document.getElementsByTagName, doesn't generate Javascript code
         """
-        return [el for el in self['elements_by_id'].values() if (el.tagName == tagName or tagName == '')]
+        if tagName == '' or tagName == '*':
+            return list(self['elements_by_id'].values())
+        return list(self['elements_by_tag'].get(tagName, {}).values())
+
+    def querySelector(self, selectors):
+        """
+        returns the first element under the root element in document order that matches the selectors, see :mod:`domsync.selector` for the supported syntax.
+        The id, class name and tag name indexes of the document are used to narrow down the candidates before checking the rest of the selector.
+
+        :param selectors: one or more CSS selectors separated by commas
+        :type selectors: str
+
+        :return: the first matching element or None if there is no match
+        :rtype: :class:`domsync.core._Element`
+
+        analogous to Javascript document.querySelector, doesn't generate Javascript code
+        """
+        return self.getRootElement().querySelector(selectors)
+
+    def querySelectorAll(self, selectors):
+        """
+        returns all elements under the root element that match the selectors in document order, see :mod:`domsync.selector` for the supported syntax.
+        The id, class name and tag name indexes of the document are used to narrow down the candidates before checking the rest of the selector.
+
+        :param selectors: one or more CSS selectors separated by commas
+        :type selectors: str
+
+        :return: the matching elements
+        :rtype: list of :class:`domsync.core._Element`
+
+        analogous to Javascript document.querySelectorAll, doesn't generate Javascript code
+        """
+        return self.getRootElement().querySelectorAll(selectors)
+
+    def _index_classes(self, el, old_value, new_value):
+        """
+        updates the class name index when the class attribute of an element changes from old_value to new_value (either can be None)
+        """
+        index = self['elements_by_class']
+        old_names = set(old_value.split()) if old_value else set()
+        new_names = set(new_value.split()) if new_value else set()
+        for name in old_names - new_names:
+            elements = index[name]
+            del elements[el._id]
+            if len(elements) == 0:
+                del index[name]
+        for name in new_names - old_names:
+            index.setdefault(name, {})[el._id] = el
 
     def createElement(self, tagName, id=None, innerText=None, value=None, attributes=None):
         """
@@ -467,26 +941,40 @@ class Document(dict):
 
         .. code-block:: javascript
 
-            __domsync__["{id}"] = document.createElement("{tagName}");
-            __domsync__["{id}"].setAttribute("id","{id}"); // uses auto generated id if id was not provided
+            __domsync__[{handle}] = document.createElement("{tagName}");__domsync__[{handle}].setAttribute("id","{id}"); // uses auto generated id if id was not provided
 
             // if innerText was provided:
-            __domsync__["{id}"].innerText = `{innerText}`;
+            __domsync__[{handle}].innerText = `{innerText}`;
 
             // if value was provided:
-            __domsync__["{id}"].value = `{value}`;
+            __domsync__[{handle}].value = `{value}`;
 
             // if attributes was provided, for each attribute:
-            __domsync__["{id}"].setAttribute("{attrib0}","{value0}");
-            __domsync__["{id}"].setAttribute("{attrib1}","{value1}");
+            __domsync__[{handle}].setAttribute("{attrib0}","{value0}");
+            __domsync__[{handle}].setAttribute("{attrib1}","{value1}");
             // ...
         """
+        return self._createElement(tagName, id, innerText, value, attributes)
+
+    def createDocumentFragment(self):
+        """
+        Creates a new empty :class:`domsync.core.DocumentFragment` for building a subtree of elements that is sent to the client in one operation when attached.
+
+        :return: the new fragment
+        :rtype: :class:`domsync.core.DocumentFragment`
+
+        analogous to Javascript document.createDocumentFragment, doesn't generate Javascript code.
+        """
+        return DocumentFragment(self)
+
+    def _createElement(self, tagName, id, innerText, value, attributes, fragment=None):
         if id is None:
             id = self._get_autoinc_id()
         assert id not in self['elements_by_id']
-        el = _Element(self, id, tagName)
+        el = _Element(self, id, tagName, fragment)
         self['elements_by_id'][id] = el
-        self._js_push(f"""__domsync__["{el['id']}"] = document.createElement("{el['tag']}");__domsync__["{el['id']}"].setAttribute("id","{el['id']}");\n""")
+        self['elements_by_tag'].setdefault(tagName, {})[id] = el
+        el._push_op((OP_CREATE, el))
         if innerText is not None:
             assert type(innerText) is str
             el.innerText = innerText
@@ -504,12 +992,101 @@ class Document(dict):
         This is the method for generating the Javascript code updates that can be sent to the client.
         :class:`domsync.domsync_server.DomsyncServer` uses this behind the scenes, so you only need to deal with this function if you want to use your own server.
 
+        Changes are recorded as operations and coalesced here before being rendered, so the generated code only contains what is needed to get from the
+        state of the last call to the current state:
+
+        * of several ``innerText``, ``value`` or ``setAttribute``/``removeAttribute`` changes of the same element and property, only the last one is kept
+        * elements that were created and removed since the last call don't appear at all
+        * changes of elements that were removed since the last call are dropped
+
         :return: the Javascript code generated since the last call to this function.
         :rtype: str
         """
-        res = self['js_buffer']
-        self['js_buffer'] = []
-        return ''.join(res)
+        return self.render_updates('js')
+
+    def render_updates(self, protocol='js'):
+        """
+        Same as :meth:`render_js_updates` but renders the updates with the given wire protocol, see :mod:`domsync.protocol`.
+
+        :param protocol: ``'js'`` for Javascript code or ``'compact'`` for the compact opcode array applied by ``domsync.js``
+        :type protocol: str
+
+        :return: the message containing the updates since the last call, an empty string if there were no updates
+        :rtype: str
+        """
+        ops = self['ops']
+        self['ops'] = []
+        self['ops_rendered'] += len(ops)
+        res = render(self._coalesce(ops), protocol)
+        # handles of removed elements are only reused once no pending operation can refer to them anymore
+        self['free_handles'].extend(self['released_handles'])
+        self['released_handles'] = []
+        return res
+
+    def _coalesce(self, ops):
+        """
+        returns the subset of ops that is needed to get from the state before the first op to the state after the last op
+        """
+        elements_by_id = self['elements_by_id']
+        created = set()
+        pinned = []  # elements that are referred to by insertBefore, these need to exist on the client side even if they get removed later on
+        fragments = []
+        for op in ops:
+            if op[0] == OP_CREATE:
+                created.add(op[1])
+            elif op[0] == OP_INSERT_BEFORE:
+                pinned.append(op[3])
+            elif op[0] == OP_INSERT_FRAGMENT:
+                fragments.append(op)
+                if op[2] is not None:
+                    pinned.append(op[2])
+        # elements that were created and removed within ops never need to exist on the client side
+        cancelled = {el for el in created if elements_by_id.get(el._id) is not el}
+        for op in fragments:
+            # neither do the elements of a fragment attached to such an element
+            if op[1] in cancelled:
+                cancelled.update(op[4])
+        for el in pinned:
+            # a pinned element also needs the ancestors it was removed with
+            while el is not None:
+                cancelled.discard(el)
+                el = el._parent
+
+        res = []
+        last_writes = set()
+        for op in reversed(ops):
+            code = op[0]
+            el = op[1]
+            if code in _element_ops:
+                if elements_by_id.get(el._id) is not el:
+                    continue  # the element has been removed
+                if code == OP_SET_ATTRIBUTE or code == OP_REMOVE_ATTRIBUTE:
+                    key = (el, op[2])
+                elif code == OP_ADD_EVENT_LISTENER:
+                    key = None
+                else:
+                    key = (el, code)
+                if key is not None:
+                    if key in last_writes:
+                        continue
+                    last_writes.add(key)
+            elif code == OP_CREATE or code == OP_REMOVE:
+                if el in cancelled:
+                    continue
+            elif code == OP_APPEND_CHILD or code == OP_INSERT_BEFORE:
+                if el in cancelled or op[2] in cancelled:
+                    continue
+            elif code == OP_INSERT_FRAGMENT:
+                if el in cancelled:
+                    continue
+            elif code == OP_REPLACE_CHILDREN:
+                if el in cancelled:
+                    continue
+                if cancelled:
+                    op = (code, el, tuple(child for child in op[2] if child not in cancelled))
+            res.append(op)
+        res.reverse()
+        return res
 
     def render_js_full(self):
         """
@@ -522,25 +1099,94 @@ class Document(dict):
         for each client and send updates behind the scenes automatically anyways.
         You only need to deal with this method if you decide to use your own server.
 
+        For large documents prefer :meth:`render_full_chunks` which produces the same snapshot in bounded-size pieces.
+
         :return: Javascript code containnig the full current state of the document.
         :rtype: str
         """
-        assert self['js_buffer'] == [], 'can only call render_js_full right after render_js_updates'
-        new_doc = Document(self.getRootElement().id)
-        ids_to_copy = [el.id for el in self.getRootElement().children]
-        while len(ids_to_copy):
-            id = ids_to_copy.pop(0)
-            old_el = self.getElementById(id)
-            ids_to_copy.extend([el.id for el in old_el.children])
-            parent_id = old_el.parentElement.id
-            assert type(parent_id) is str
-            new_doc.createElement(old_el.tagName, id=old_el.id, innerText=old_el.innerText, value=old_el.value, attributes=old_el.attributes)
-            new_el = new_doc.getElementById(id)
-            for event, (callback, js_value_getter) in self['callbacks'].get(id, {}).items():
-                new_el.addEventListener(event, callback, js_value_getter)
-            new_parent = new_doc.getElementById(parent_id)
-            new_parent.appendChild(new_el)
-        return new_doc.render_js_updates()
+        return ''.join(self.render_full_chunks('js'))
+
+    def render_full_chunks(self, protocol='js', chunk_size=65536):
+        """
+        Generates the full snapshot of the current state of the :class:`domsync.Document` like :meth:`render_js_full`, but as a sequence of messages
+        of about ``chunk_size`` characters each which can be sent to the client one by one. The messages have to be applied by the client in order.
+        The tree is walked directly while the messages are being generated, nothing is built up front. The document must not be changed while the
+        messages are being generated.
+
+        The snapshot starts by removing everything under the root element on the client side, so it can also be used to bring a client with an outdated DOM up to date.
+        It can be rendered at any time. It reflects the current state including the changes that haven't been rendered by :meth:`render_updates` yet,
+        so a client that gets the snapshot must not get those updates.
+
+        The rendered snapshot of each of the largest subtrees that fit in one message is cached on its root element and reused by the next snapshot for as long as
+        nothing changes within the subtree. The smaller subtrees within them are not cached separately, so the cache holds about one copy of the snapshot.
+        A change drops the cached snapshot of the subtree that contains it only, so rendering the snapshot again for many clients of a mostly unchanged
+        document costs in proportion to the changed subtrees.
+
+        :param protocol: ``'js'`` for Javascript code or ``'compact'`` for the compact opcode array applied by ``domsync.js``
+        :type protocol: str
+
+        :param chunk_size: a message is completed once it reaches this many characters, it can be longer by at most ``chunk_size`` characters
+        :type chunk_size: int
+
+        :return: generator of the messages
+        :rtype: Iterator[str]
+        """
+        assert chunk_size > 0
+        return self._iter_full_chunks(get_protocol(protocol), chunk_size)
+
+    def _iter_full_chunks(self, protocol, chunk_size):
+        name = protocol.name
+        callbacks = self['callbacks']
+        root_el = self.getRootElement()
+        # the root element is cleared first so the snapshot can also be applied over an outdated DOM
+        pieces = [protocol.render_op((OP_INIT, root_el)), protocol.render_op((OP_REPLACE_CHILDREN, root_el, ()))]
+        size = len(pieces[0]) + len(pieces[1])
+        frames = []  # [element, index of its first piece in pieces] of the subtrees being rendered, the index is None once the subtree is split between messages
+        stack = list(reversed(root_el.children))
+        while stack:
+            el = stack.pop()
+            if el is None:
+                # end of the subtree of the innermost frame
+                el, start = frames.pop()
+                if start is not None:
+                    piece = protocol.join(pieces[start:])
+                    if len(piece) <= chunk_size:
+                        if type(el._snapshot) is not dict:
+                            el._snapshot = {}
+                        el._snapshot[name] = piece
+                        pieces[start:] = [piece]
+                        # only the largest subtrees that fit keep their snapshot, so the rendered text is cached once and not at every level
+                        child = el._first
+                        while child is not None:
+                            child._snapshot = _COVERED
+                            child = child._next
+                continue
+            piece = None if el._snapshot is None else el._snapshot.get(name)
+            if piece is not None:
+                pieces.append(piece)
+                size += len(piece)
+            else:
+                frames.append([el, len(pieces)])
+                for op in state_ops(el, callbacks):
+                    piece = protocol.render_op(op)
+                    pieces.append(piece)
+                    size += len(piece)
+                piece = protocol.render_op((OP_APPEND_CHILD, el._parent, el))
+                pieces.append(piece)
+                size += len(piece)
+                stack.append(None)
+                child = el._last
+                while child is not None:
+                    stack.append(child)
+                    child = child._prev
+            if size >= chunk_size:
+                yield protocol.frame(pieces)
+                pieces = []
+                size = 0
+                for frame in frames:
+                    frame[1] = None
+        if pieces:
+            yield protocol.frame(pieces)
 
     def handle_event(self, msg):
         """
@@ -558,27 +1204,313 @@ class Document(dict):
                     | 'value' associated with the event as defined when the event was added using the ``js_value_getter`` argument of :meth:`domsync.core._Element.addEventListener`
         :type msg: dict
 
-        :returns: whatever the callback function returns that was added using :meth:`domsync.core._Element.addEventListener`
+        :returns: whatever the callback function returns that was added using :meth:`domsync.core._Element.addEventListener`,
+                  for a coroutine function callback the coroutine which needs to be awaited
         """
         assert msg['domsync']
         if msg['event'] in self['callbacks'].get(msg['id'], {}):
             msg['doc'] = self
-            callback, js_value_getter = self['callbacks'][msg['id']][msg['event']]
+            callback, js_value_getter, rate = self['callbacks'][msg['id']][msg['event']]
+            if self['profiler'] is not None:
+                return self['profiler'].call(self, msg, callback)
             return callback(msg)
 
-    def _register_callback(self, id, event, callback, js_value_getter=None):
+    def _register_callback(self, id, event, callback, js_value_getter=None, rate=None):
         """
         use this function to register an event handler callback
         """
         assert id in self['elements_by_id']
         self['callbacks'].setdefault(id, {})
         assert event not in self['callbacks'][id]
-        self['callbacks'][id][event] = (callback, js_value_getter)
+        self['callbacks'][id][event] = (callback, js_value_getter, rate)
 
+    def clone(self):
+        """
+        Creates a copy of the document with the same elements, ids and handles, much faster than building the same tree with
+        :meth:`createElement` and ``appendChild`` because no operations are recorded. The copy reflects the current state including
+        the changes that haven't been rendered yet, and it doesn't have any updates to render itself: a client gets its content from a full
+        snapshot, see :meth:`render_full_chunks`.
+
+        The cached snapshots of the subtrees are shared with the copy until either document changes them, so the snapshots of many copies of
+        the same template document are rendered once. This makes a prebuilt template cheap to instantiate for each client,
+        see the ``template`` parameter of :class:`domsync.domsync_server.DomsyncServer`.
 
-def str_is_safe(s):
-    return '"' not in s and "'" not in s and "`" not in s
+        The event listeners are copied with the same callbacks. Listeners whose callbacks change the document they belong to should be added to the copy,
+        not to the template, because they would keep changing the template.
+
+        :return: the copy
+        :rtype: :class:`domsync.Document`
+        """
+        doc = self._copy(self['elements_by_id'].values())
+        elements_by_id = doc['elements_by_id']
+        doc['elements_by_tag'] = {tag: {id: elements_by_id[id] for id in elements} for tag, elements in self['elements_by_tag'].items()}
+        doc['elements_by_class'] = {name: {id: elements_by_id[id] for id in elements} for name, elements in self['elements_by_class'].items()}
+        return doc
+
+    def _detached_full_chunks(self, protocol, chunk_size):
+        """
+        like :meth:`render_full_chunks` but the snapshot is taken now and the messages are rendered from a copy of the document, so the document
+        can change while they are generated. used by :class:`domsync.domsync_server.DomsyncServer` to send the snapshot without blocking the event loop.
+
+        the subtrees that have their snapshot cached aren't copied. the elements that are copied are marked in the document and once the messages
+        are done, the snapshots cached on the copy are moved to the marked elements that haven't changed since, so the cache of the document is kept warm.
+        """
+        assert chunk_size > 0
+        protocol = get_protocol(protocol)
+        mark = MappingProxyType({})
+        copied = []
+        doc = self._copy([self.getRootElement()], protocol.name, mark, copied)
+        return doc._iter_detached_chunks(protocol, chunk_size, mark, copied)
+
+    def _iter_detached_chunks(self, protocol, chunk_size, mark, copied):
+        try:
+            yield from self._iter_full_chunks(protocol, chunk_size)
+        finally:
+            # also when the messages are abandoned half way, what is cached on the copy so far is valid
+            for el, copy in copied:
+                if el._snapshot is mark:
+                    el._snapshot = copy._snapshot
+
+    def _copy(self, tops, protocol=None, mark=None, copied=None):
+        """
+        copies the trees of the given elements into a new document, without the tag and class indexes. used by :meth:`clone`, the cached snapshots are shared.
+
+        with a protocol name, used by :meth:`_detached_full_chunks`: the elements that have their snapshot cached for the protocol are copied without their
+        subtree, and each element that is copied otherwise is appended to ``copied`` with its copy and marked by setting its ``_snapshot`` to ``mark``.
+        the mark holds no snapshot and a change replaces it by None like any cached snapshot.
+        """
+        doc = Document(self['root_id'])
+        doc['ops'] = []
+        doc['id_autoinc'] = self['id_autoinc']
+        doc['handle_autoinc'] = self['handle_autoinc']
+        # the copy has no pending updates, so the handles of the elements removed since the last render are free already
+        doc['free_handles'] = self['free_handles'] + self['released_handles']
+        elements_by_id = doc['elements_by_id']
+        root_el = elements_by_id[self['root_id']]
+        for top in tops:
+            if top._parent is not None:
+                continue
+            stack = [(top, None)]  # (element, copy of its parent)
+            while stack:
+                el, parent = stack.pop()
+                if el._fragment is not None:
+                    raise Exception('elements of a DocumentFragment can not be cloned, append the fragment first: ' + el._id)
+                if el._handle == 0:
+                    copy = root_el
+                else:
+                    copy = _Element.__new__(_Element)
+                    copy._document = doc
+                    copy._fragment = None
+                    copy._id = el._id
+                    copy._handle = el._handle
+                    copy._tag = el._tag
+                    elements_by_id[el._id] = copy
+                copy._pos = el._pos
+                copy._nchildren = el._nchildren
+                copy._attributes = None if el._attributes is None else el._attributes.copy()
+                copy._innerText = el._innerText
+                copy._value = el._value
+                copy._snapshot = el._snapshot  # only ever replaced by None on changes, cached snapshots are only added while it's valid
+                copy._parent = parent
+                copy._first = copy._last = copy._next = None
+                if parent is None:
+                    copy._prev = None
+                else:
+                    # the children are copied in order
+                    copy._prev = parent._last
+                    if parent._last is None:
+                        parent._first = copy
+                    else:
+                        parent._last._next = copy
+                    parent._last = copy
+                if protocol is not None:
+                    if el._snapshot is not None and protocol in el._snapshot:
+                        continue
+                    copy._snapshot = None
+                    el._snapshot = mark
+                    copied.append((el, copy))
+                child = el._last
+                while child is not None:
+                    stack.append((child, copy))
+                    child = child._prev
+        doc['callbacks'] = {id: dict(listeners) for id, listeners in self['callbacks'].items()}
+        return doc
+
+    def hibernate(self):
+        """
+        Releases the elements of an idle document to save memory: the tree is serialized into a compressed blob and the elements are dropped.
+        The document is rehydrated transparently as soon as it or any of its elements is used again, for example by an event or a change.
+        Elements that are still referenced from elsewhere, like the closures of event listener callbacks or components, are kept and
+        reused on rehydration so the references stay valid. The callbacks themselves are kept as they are.
+
+        :returns: True if the document got hibernated, False if it has updates that haven't been rendered yet or elements in a
+                  :class:`domsync.core.DocumentFragment`, those are not hibernated
+        :rtype: bool
+        """
+        if self.is_hibernated() or self['ops']:
+            return False
+        rows = []  # the elements in depth-first order
+        elements = []
+        for top in self['elements_by_id'].values():
+            if top._parent is not None:
+                continue
+            stack = [top]
+            while stack:
+                el = stack.pop()
+                if el._fragment is not None:
+                    return False
+                rows.append((el._id, el._tag, el._handle, el._attributes, el._innerText, el._value, el._nchildren))
+                elements.append(el)
+                child = el._last
+                while child is not None:
+                    stack.append(child)
+                    child = child._prev
+        blob = zlib.compress(pickle.dumps(rows, pickle.HIGHEST_PROTOCOL))
+        refs = []
+        for el in elements:
+            refs.append(weakref.ref(el))
+            el._parent = el._first = el._last = el._prev = el._next = None
+            el._attributes = el._innerText = el._value = el._snapshot = None
+            el.__class__ = _HibernatedElement
+        self['elements_by_id'] = self['elements_by_tag'] = self['elements_by_class'] = None
+        self['hibernated'] = (blob, refs)
+        self.__class__ = _HibernatedDocument
+        return True
+
+    def is_hibernated(self):
+        """
+        :returns: True if the document is hibernated, see :meth:`hibernate`
+        :rtype: bool
+        """
+        return False
+
+    def _wake(self):
+        pass
+
+
+class _HibernatedDocument(Document):
+    """
+    a hibernated Document, rehydrates itself when any of its fields is read or written. the cleared fields are never visible through the dict interface
+    """
+
+    def __getitem__(self, key):
+        self._wake()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._wake()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        self._wake()
+        return dict.__contains__(self, key)
+
+    def __len__(self):
+        self._wake()
+        return dict.__len__(self)
+
+    def __iter__(self):
+        self._wake()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._wake()
+        return dict.keys(self)
+
+    def values(self):
+        self._wake()
+        return dict.values(self)
+
+    def items(self):
+        self._wake()
+        return dict.items(self)
+
+    def copy(self):
+        self._wake()
+        return dict.copy(self)
+
+    def __repr__(self):
+        self._wake()
+        return dict.__repr__(self)
+
+    def __setitem__(self, key, value):
+        self._wake()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._wake()
+        dict.__delitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        self._wake()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        self._wake()
+        return dict.pop(self, key, *default)
+
+    def update(self, *args, **kwargs):
+        self._wake()
+        dict.update(self, *args, **kwargs)
+
+    def is_hibernated(self):
+        return True
+
+    def _wake(self):
+        self.__class__ = Document
+        blob, refs = self.pop('hibernated')
+        elements_by_id = self['elements_by_id'] = {}
+        elements_by_tag = self['elements_by_tag'] = {}
+        self['elements_by_class'] = {}
+        stack = []  # [element, number of its children still to come]
+        for (id, tag, handle, attributes, innerText, value, nchildren), ref in zip(pickle.loads(zlib.decompress(blob)), refs):
+            el = ref()
+            if el is None:
+                el = _Element.__new__(_Element)
+                el._document = self
+                el._fragment = None
+                el._id = id
+                el._handle = handle
+                el._tag = tag
+            else:
+                el.__class__ = _Element
+            el._first = el._last = el._prev = el._next = el._snapshot = None
+            el._nchildren = 0
+            el._pos = 0
+            el._attributes = attributes
+            el._innerText = innerText
+            el._value = value
+            while stack and stack[-1][1] == 0:
+                stack.pop()
+            if stack:
+                parent = stack[-1][0]
+                stack[-1][1] -= 1
+                el._parent = parent
+                el._prev = parent._last
+                if parent._last is None:
+                    parent._first = el
+                else:
+                    el._pos = parent._last._pos + _POS_GAP
+                    parent._last._next = el
+                parent._last = el
+                parent._nchildren += 1
+            else:
+                el._parent = None
+            if nchildren:
+                stack.append([el, nchildren])
+            elements_by_id[id] = el
+            elements_by_tag.setdefault(tag, {})[id] = el
+            if attributes is not None and 'class' in attributes:
+                self._index_classes(el, None, attributes['class'])
+
+
+class _HibernatedElement(_Element):
+    """
+    an element of a hibernated Document, rehydrates the document when any of its attributes is read
+    """
 
+    __slots__ = ()
 
-def str_escape_for_js(s):
-    return s.replace("'", r"\x27").replace('"', r"\x22")
+    def __getattribute__(self, name):
+        object.__getattribute__(self, '_document')._wake()
+        return object.__getattribute__(self, name)
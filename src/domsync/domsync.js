@@ -0,0 +1,131 @@
+// domsync client runtime for the compact protocol of DomsyncServer(..., protocol='compact').
+// messages are flat JSON arrays of opcodes followed by their arguments, see domsync/protocol.py, they are applied here without eval.
+//
+// usage:
+//   <script src="domsync.js"></script>
+//   <script>domsync.connect("ws://localhost:8888");</script>
+var domsync = (function () {
+  var els = [];  // element handle -> DOM element
+  var getters = {};  // js_value_getter source -> compiled function
+  var socket = null;
+  var session = null;  // session id sent by the server, used to resume after a reconnect
+  var seq = 0;  // sequence number of the last applied message, -1 while a snapshot is being applied
+
+  var batch = null;  // events waiting to be sent at the next animation frame
+  var leaving = false;  // set between pagehide and pageshow
+
+  // sends the waiting events, they are dropped if the connection isn't open
+  function flush() {
+    if (batch === null) { return; }
+    var data = JSON.stringify(batch.length === 1 ? batch[0] : batch);
+    batch = null;
+    if (socket !== null && socket.readyState === WebSocket.OPEN) { socket.send(data); }
+  }
+
+  // the events that happen within an animation frame are sent together in one message.
+  // animation frames don't run in hidden tabs and not after the page is left, then the events are sent right away
+  function send(msg) {
+    if (batch === null) {
+      batch = [];
+      if (!document.hidden && !leaving) { requestAnimationFrame(flush); }
+    }
+    batch.push(msg);
+    if (document.hidden || leaving) { flush(); }
+  }
+
+  document.addEventListener("visibilitychange", function () { if (document.hidden) { flush(); } });
+  addEventListener("beforeunload", flush);
+  addEventListener("pagehide", function () { leaving = true; flush(); });
+  addEventListener("pageshow", function () { leaving = false; });
+
+  function getter(src) {
+    if (!(src in getters)) { getters[src] = new Function("return (" + src + ");"); }
+    return getters[src];
+  }
+
+  // wrappers that limit the rate of the events of a listener, the value getter is evaluated when the event is sent
+  var limiters = {
+    "throttle": function (f, ms) {
+      var t = null, last = 0;
+      return function () {
+        var self = this, wait = ms - (Date.now() - last);
+        if (t !== null) { return; }
+        if (wait <= 0) { last = Date.now(); f.call(self); }
+        else { t = setTimeout(function () { t = null; last = Date.now(); f.call(self); }, wait); }
+      };
+    },
+    "debounce": function (f, ms) {
+      var t = null;
+      return function () {
+        var self = this;
+        clearTimeout(t);
+        t = setTimeout(function () { t = null; f.call(self); }, ms);
+      };
+    },
+    "frame": function (f) {
+      var p = false;
+      return function () {
+        var self = this;
+        if (p) { return; }
+        p = true;
+        // animation frames don't run in hidden tabs
+        (document.hidden ? setTimeout : requestAnimationFrame)(function () { p = false; f.call(self); });
+      };
+    }
+  };
+
+  function listener(handle, event, value_getter, rate) {
+    var get = value_getter === null ? null : getter(value_getter);
+    var id = els[handle].id;
+    var f = function () {
+      send({"domsync": true, "event": event, "id": id, "value": get === null ? null : get.call(this)});
+    };
+    return rate === null ? f : limiters[rate[0]](f, rate[1]);
+  }
+
+  function insertFragment(parent, before, html, handles) {
+    var t = document.createElement("template");
+    t.innerHTML = html;
+    var e = t.content.querySelectorAll("[id]");
+    for (var i = 0; i < e.length; i++) { els[handles[i]] = e[i]; }
+    parent.insertBefore(t.content, before === null ? null : els[before]);
+  }
+
+  function apply(items) {
+    var i = 0, n = items.length, op, el;
+    while (i < n) {
+      op = items[i];
+      el = els[items[i + 1]];
+      switch (op) {
+        case 0: els = []; els[items[i + 1]] = document.getElementById(items[i + 2]); i += 3; break;
+        case 1: el = document.createElement(items[i + 2]); el.setAttribute("id", items[i + 3]); els[items[i + 1]] = el; i += 4; break;
+        case 2: el.appendChild(els[items[i + 2]]); i += 3; break;
+        case 3: el.insertBefore(els[items[i + 2]], els[items[i + 3]]); i += 4; break;
+        case 4: el.remove(); i += 2; break;
+        case 5: el.replaceChildren.apply(el, items[i + 2].map(function (handle) { return els[handle]; })); i += 3; break;
+        case 6: el.setAttribute(items[i + 2], items[i + 3]); i += 4; break;
+        case 7: el.removeAttribute(items[i + 2]); i += 3; break;
+        case 8: el.addEventListener(items[i + 2], listener(items[i + 1], items[i + 2], items[i + 3], items[i + 4])); i += 5; break;
+        case 9: el.innerText = items[i + 2]; i += 3; break;
+        case 10: el.value = items[i + 2]; i += 3; break;
+        case 11: insertFragment(el, items[i + 2], items[i + 3], items[i + 4]); i += 5; break;
+        case 12: seq = items[i + 1]; i += 2; break;
+        case 13: session = items[i + 1]; i += 2; break;
+        default: throw new Error("domsync: unknown operation " + op);
+      }
+    }
+  }
+
+  // reconnect_ms: optional, reconnect this many milliseconds after the connection was lost, resuming the session if the server keeps them
+  function connect(url, reconnect_ms) {
+    var query = session === null ? "" : (url.indexOf("?") < 0 ? "?" : "&") + "session=" + encodeURIComponent(session) + "&seq=" + seq;
+    socket = new WebSocket(url + query);
+    socket.onmessage = function (event) { apply(JSON.parse(event.data)); };
+    if (reconnect_ms !== undefined) {
+      socket.onclose = function () { setTimeout(function () { connect(url, reconnect_ms); }, reconnect_ms); };
+    }
+    return socket;
+  }
+
+  return {connect: connect, apply: apply, send: send};
+})();
@@ -1,6 +1,60 @@
 import asyncio
+import inspect
+import itertools
 import json
+import time
+import uuid
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
 from domsync import Document
+from domsync.protocol import get_protocol
+from domsync.metrics import Metrics
+
+
+def _is_event(msg):
+    """
+    returns whether a decoded message is a domsync event whose id and event name can be looked up, other messages are ignored
+    """
+    return type(msg) is dict and bool(msg.get('domsync')) and type(msg.get('id')) is str and type(msg.get('event')) is str
+
+
+def _default_json_loads():
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        return json.loads
+
+
+class _Outbox():
+    """
+    messages waiting to be sent to a client, exists while the client has a writer task sending to it
+    """
+
+    __slots__ = ('messages', 'size', 'resync', 'task')
+
+    def __init__(self):
+        self.messages = deque()
+        self.size = 0  # total length of the messages
+        self.resync = None  # chunk size of the full snapshot to send instead of the messages, None if no snapshot is due
+        self.task = None
+
+
+class _Session():
+    """
+    the own document of a client along with the numbered messages recently sent for it, kept for a while after the client disconnected so it can resume
+    """
+
+    __slots__ = ('id', 'doc', 'seq', 'frames', 'client', 'aliases', 'expiry')
+
+    def __init__(self, doc, client, max_frames):
+        self.id = uuid.uuid4().hex
+        self.doc = doc
+        self.seq = 0  # sequence number of the last message
+        self.frames = deque(maxlen=max_frames)  # (sequence number, message) of the recent messages
+        self.client = client  # the connection of the client, None while it is disconnected
+        self.aliases = [client]  # the connection that was given to the connection_handler, followed by the latest one if the client resumed
+        self.expiry = None  # the scheduled removal of the session while it is disconnected
 
 
 class DomsyncServer():
@@ -12,6 +66,10 @@ class DomsyncServer():
     Any callback methods that were registered on the client's document with :meth:`domsync.core._Element.addEventListener` are also handled by the server: whenever
     those methods trigger ``ws_send`` on the client side, the message containig the event is received by the server and the corresponding Python callback function is triggered.
 
+    Instead of having a document of its own, a client can also be subscribed to a shared document with :meth:`subscribe`. A shared document is kept once in memory
+    no matter how many clients are subscribed to it, its updates are rendered once by :meth:`flush_shared` and the same message is sent to every subscriber.
+    This suits pages that show the same content to everybody, like a dashboard.
+
     :param connection_handler: is a callback function that is called each time a client connects to the server.
        It has two arguments: the first contains the DomsyncServer instance, the second contains the client websocket connection instance.
     :type connection_handler: Callable(:class:`domsync.domsync_server.DomsyncServer`, ``WebSocketServerProtocol``)
@@ -27,14 +85,163 @@ class DomsyncServer():
 
     :param root_id: optional, id of the element in the client-side HTML where domsync should be rendered. default = 'domsync_root_id'.
     :type root_id: str
+
+    :param protocol: optional, the wire protocol of the updates sent to the clients, see :mod:`domsync.protocol`. default = 'js'.
+       ``'js'`` sends Javascript code that is evaluated by the client (see ``examples/client.html``),
+       ``'compact'`` sends compact opcode arrays that are applied by the ``domsync.js`` client runtime (see ``examples/client_compact.html``).
+    :type protocol: str
+
+    :param compression: optional, whether to compress the messages with the permessage-deflate websocket extension if the Browser supports it, see :mod:`domsync.compression`.
+       Compression saves a lot of bandwidth on slow networks at the cost of CPU time on both ends, on a LAN it is often better turned off. default = True.
+    :type compression: bool
+
+    :param compression_window_bits: optional, base-two logarithm of the compression window, 8 to 15. default = 12.
+    :type compression_window_bits: int
+
+    :param compression_memory_level: optional, zlib memory level of the compressor, 1 to 9. default = 5.
+    :type compression_memory_level: int
+
+    :param compression_min_size: optional, messages shorter than this many bytes are sent uncompressed. default = 256.
+    :type compression_min_size: int
+
+    :param max_size: optional, maximum size of incoming messages in bytes, None for no limit. default = 2**20.
+    :type max_size: int
+
+    :param max_queue: optional, maximum number of incoming messages buffered per client, None for no limit. default = 32.
+    :type max_queue: int
+
+    :param write_limit: optional, high-water mark of the outgoing buffer in bytes, sending waits while the buffer is above it. default = 2**16.
+    :type write_limit: int
+
+    :param flush_rate: optional, turns on automatic flushing. None (default) means that updates are only sent by explicit calls to :meth:`flush`,
+       :meth:`flush_shared` or :meth:`flush_all` and after every event received from a client.
+       With a number, documents that changed are flushed automatically at most ``flush_rate`` times per second, all at the same time,
+       with 0 they are flushed once per iteration of the event loop, after all the changes made in that iteration.
+       Documents without changes are not touched at all. Events received from clients don't trigger a flush of their own then, their changes go out with the next automatic flush.
+    :type flush_rate: float
+
+    :param outbox_max_bytes: optional, the most characters of updates that are queued for a client that can't keep up. default = 2**22.
+    :type outbox_max_bytes: int
+
+    :param outbox_max_messages: optional, the most messages that are queued for a client that can't keep up. default = 1024.
+    :type outbox_max_messages: int
+
+    :param snapshot_chunk_size: optional, approximate size of the messages of full snapshots in characters. default = 65536.
+    :type snapshot_chunk_size: int
+
+    Sending never waits for a client: the messages of each client are queued and sent by a writer task of its own, so a slow client doesn't hold up
+    the task that changes the documents nor the other clients. When the updates queued for a client exceed ``outbox_max_bytes`` or ``outbox_max_messages``,
+    they are dropped and the client gets a full snapshot of its document instead once it has caught up with what was already being sent,
+    so a slow client costs bounded memory and eventually gets the current state.
+
+    :param executor: optional, the ``concurrent.futures`` thread or process pool that runs the work of the callbacks made with :meth:`offload`.
+       default = None which means the default thread pool of the event loop.
+    :type executor: ``concurrent.futures.Executor``
+
+    Event listener callbacks can be coroutine functions too (``async def``), they are awaited before the next event of the same client is handled,
+    so the events of a client are always handled one at a time in the order they were received, while the other clients are served in the meantime.
+    CPU-heavy work is best moved off the event loop with :meth:`offload`. Events of listeners that were added with ``throttle_ms``, ``debounce_ms`` or ``latest_only``
+    (see :meth:`domsync.core._Element.addEventListener`) are dropped when a newer event of the same element and event name has already been received,
+    so a server that falls behind only handles the latest value.
+
+    :param json_loads: optional, the function that decodes the event messages received from the clients. default = None which means ``orjson.loads``
+       if orjson is installed, ``json.loads`` otherwise. It must raise a ``ValueError`` for invalid JSON.
+    :type json_loads: Callable(str)
+
+    :param metrics_port: optional, port of a local HTTP endpoint that serves the metrics of the server in the Prometheus text format, see :mod:`domsync.metrics`.
+       default = None which means no endpoint, the metrics can still be read with :meth:`get_metrics`.
+    :type metrics_port: int
+
+    :param metrics_host: optional, host name the metrics endpoint listens on. default = '127.0.0.1'.
+    :type metrics_host: str
+
+    :param profiler: optional, times the event listener callbacks of all documents of the server and logs the slow ones, see :mod:`domsync.profiler`. default = None.
+    :type profiler: :class:`domsync.profiler.CallbackProfiler`
+
+    :param resume_grace: optional, seconds to keep the document of a client after it disconnected so the client can reconnect and resume where it left off.
+       default = None which means that the document is dropped when the client disconnects.
+    :type resume_grace: float
+
+    :param resume_frames: optional, the number of recent messages kept per document for resuming clients. default = 256.
+    :type resume_frames: int
+
+    :param hibernate_after: optional, seconds without events or updates after which the own document of a client is hibernated to save memory,
+       see :meth:`domsync.Document.hibernate`. The document is rehydrated transparently when it's used again. default = None which means never.
+    :type hibernate_after: float
+
+    :param template: optional, a prebuilt document that the own document of every client starts as, see :meth:`domsync.Document.clone`.
+       The ``connection_handler`` gets the copy and only needs to add what differs per client, like event listeners whose callbacks change the document of the client.
+       The client gets the copy as a full snapshot, which reuses the cached snapshots of the unchanged parts of the template. default = None which means an empty document.
+    :type template: :class:`domsync.Document`
+
+    With ``resume_grace`` every client gets a session id and every update message for its own document gets a sequence number, both are part of the messages.
+    A client that reconnects with ``?session=<session id>&seq=<last applied sequence number>`` in the URL within ``resume_grace`` seconds gets its document back
+    and only receives the messages it missed, or a snapshot if they are not kept anymore. The ``connection_handler`` isn't called again then, the client
+    object that was given to it keeps working with :meth:`flush`, :meth:`get_document` and :meth:`is_connected` for the reconnected client.
+    If the previous connection of the client is still open, it's closed and the new one takes over. A snapshot sets the sequence number to -1 in its first
+    message and to the actual one after its last message, so a client that lost the connection in the middle of a snapshot gets a new one when it reconnects.
+    See ``examples/client.html`` and ``domsync.js`` for clients that reconnect. Clients that are subscribed to a shared document are not kept, they subscribe again.
+
+    Clients can send several events in one message as a JSON array, ``domsync.js`` and ``examples/client.html`` send the events of an animation frame together like that.
+    The events of a message are handled in order and followed by a single :meth:`flush`.
     """
 
-    def __init__(self, connection_handler, host, port, verbose=True, root_id='domsync_root_id'):
+    def __init__(self, connection_handler, host, port, verbose=True, root_id='domsync_root_id', protocol='js',
+                 compression=True, compression_window_bits=12, compression_memory_level=5, compression_min_size=256,
+                 max_size=2**20, max_queue=32, write_limit=2**16, flush_rate=None,
+                 outbox_max_bytes=2**22, outbox_max_messages=1024, snapshot_chunk_size=65536, executor=None, json_loads=None,
+                 metrics_port=None, metrics_host='127.0.0.1', profiler=None, resume_grace=None, resume_frames=256,
+                 hibernate_after=None, template=None):
+        get_protocol(protocol)
         self.host = host
         self.port = port
         self.verbose = verbose
         self.root_id = root_id
+        self.protocol = protocol
+        self.compression = compression
+        self.compression_window_bits = compression_window_bits
+        self.compression_memory_level = compression_memory_level
+        self.compression_min_size = compression_min_size
+        self.compression_stats = None
+        self.max_size = max_size
+        self.max_queue = max_queue
+        self.write_limit = write_limit
+        assert flush_rate is None or flush_rate >= 0
+        self.flush_rate = flush_rate
+        self.dirty_clients = set()  # clients whose own document changed since the last automatic flush
+        self.dirty_shared = set()  # names of shared documents that changed since the last automatic flush
+        self._auto_flush_handle = None  # the scheduled automatic flush
+        self._last_auto_flush = float('-inf')  # event loop time of the last automatic flush
         self.clients = {}  # client websocket instance -> domsync Document
+        self.shared_documents = {}  # name -> shared domsync Document
+        self.subscribers = {}  # name of a shared document -> set of clients subscribed to it
+        self.client_shared = {}  # client -> name of the shared document it is subscribed to
+        self.outboxes = {}  # client -> _Outbox, only present while the client has a writer task
+        self.outbox_max_bytes = outbox_max_bytes
+        self.outbox_max_messages = outbox_max_messages
+        self.snapshot_chunk_size = snapshot_chunk_size
+        self.resync_count = 0  # number of times the queued updates of a client were dropped for a snapshot
+        self.executor = executor
+        self.coalesced_count = 0  # number of events of rate limited listeners that were dropped because a newer one was already received
+        self.json_loads = _default_json_loads() if json_loads is None else json_loads
+        self.metrics = Metrics()
+        self.client_metrics = {}  # client -> Metrics of the client, for connected clients
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_server = None
+        self.profiler = profiler
+        assert resume_grace is None or resume_grace >= 0
+        self.resume_grace = resume_grace
+        self.resume_frames = resume_frames
+        self.sessions = {}  # session id -> _Session
+        self.client_sessions = {}  # client -> _Session, for every connection of a session
+        assert hibernate_after is None or hibernate_after > 0
+        self.hibernate_after = hibernate_after
+        self.last_active = {}  # client -> event loop time of the last event or update of its own document
+        self.hibernate_count = 0  # number of times a document was hibernated
+        self._hibernate_handle = None  # the scheduled check for idle documents
+        assert template is None or template['root_id'] == root_id
+        self.template = template
         self.connection_handler = connection_handler
 
     async def serve(self):
@@ -44,7 +251,18 @@ class DomsyncServer():
         :returns: None
         """
         import websockets
-        self.server = await websockets.serve(self._on_ws_client_connect, self.host, self.port)
+        extensions = None
+        if self.compression:
+            from domsync.compression import CompressionStats, server_extensions
+            self.compression_stats = CompressionStats()
+            extensions = server_extensions(self.compression_window_bits, self.compression_memory_level, self.compression_min_size, self.compression_stats)
+        self.server = await websockets.serve(self._on_ws_client_connect, self.host, self.port, compression=None, extensions=extensions,
+                                             max_size=self.max_size, max_queue=self.max_queue, write_limit=self.write_limit)
+        if self.metrics_port is not None:
+            from domsync.metrics import serve_http
+            self.metrics_server = await serve_http(self.render_metrics, self.metrics_host, self.metrics_port)
+        if self.hibernate_after is not None:
+            self._hibernate_handle = asyncio.get_event_loop().call_later(self.hibernate_after / 2, self._hibernate_idle)
         if self.verbose:
             print(f'domsync server started on ws://{self.host}:{self.port}')
 
@@ -55,38 +273,195 @@ class DomsyncServer():
         :returns: None
         """
         assert self.server.is_serving()
+        if self._auto_flush_handle is not None:
+            self._auto_flush_handle.cancel()
+            self._auto_flush_handle = None
+        if self._hibernate_handle is not None:
+            self._hibernate_handle.cancel()
+            self._hibernate_handle = None
+        for session in list(self.sessions.values()):
+            if session.expiry is not None:
+                self._expire(session)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+            self.metrics_server = None
         self.server.close()
         await self.server.wait_closed()
         assert not self.server.is_serving()
 
-    async def _on_ws_client_connect(self, client, _path):
-        import websockets
+    async def _on_ws_client_connect(self, client, path):
         assert client not in self.clients
-        doc = Document(self.root_id)
-        self.clients[client] = doc
-
-        asyncio.create_task(self.connection_handler(self, client))
-
-        while True:
-            try:
-                msg = await client.recv()
-            except websockets.exceptions.ConnectionClosedOK:
-                break
-
-            try:
-                msg = json.loads(msg)
-            except json.decoder.JSONDecodeError:
-                continue
-
-            if msg.get('domsync'):
-                doc.handle_event(msg)
-                await self.flush(client)
-
-        del self.clients[client]
+        self.client_metrics[client] = Metrics()
+        self.last_active[client] = asyncio.get_event_loop().time()
+        query = parse_qs(urlsplit(path).query) if self.resume_grace is not None else {}
+        session = self.sessions.get(query.get('session', [None])[0])
+        if session is not None:
+            if session.client is not None:
+                # the client reconnected before its previous connection was noticed to be gone, the new connection takes over the session
+                asyncio.ensure_future(session.client.close())
+            self._resume(session, client, query.get('seq', [''])[0])
+        else:
+            if self.template is None:
+                doc = Document(self.root_id)
+            else:
+                # renders the snapshot of the template unless it's cached already, the copy shares the cached snapshots
+                for _ in self.template.render_full_chunks(self.protocol, self.snapshot_chunk_size):
+                    pass
+                doc = self.template.clone()
+            doc['profiler'] = self.profiler
+            self.clients[client] = doc
+            self._watch(doc, lambda doc: self._on_dirty(self.dirty_clients, client))
+            if self.resume_grace is not None:
+                session = _Session(doc, client, self.resume_frames)
+                self.sessions[session.id] = session
+                self.client_sessions[client] = session
+            if 'session' in query or self.template is not None:
+                # the page of a client whose session expired is rebuilt from scratch, a copy of the template is sent as a snapshot
+                self._resync(client, None)
+            elif self.resume_grace is not None:
+                protocol = get_protocol(self.protocol)
+                self._enqueue(client, [protocol.frame([protocol.render_session(session.id)])])
+
+            asyncio.create_task(self.connection_handler(self, client))
+
+        # events are received by a task of their own so the events of rate limited listeners that arrive while an earlier event is being handled can be dropped
+        events = asyncio.Queue(self.max_queue or 0)
+        latest = {}  # (id, event) -> the newest received event of a rate limited listener
+        receiver = asyncio.create_task(self._receive_events(client, events, latest))
+        session = self.client_sessions.get(client)
+        try:
+            while True:
+                batch = await events.get()
+                if batch is None:
+                    if receiver.done():
+                        receiver.result()  # re-raises the error that ended the receiver
+                    break
+                if session is not None and session.client is not client and client not in self.client_shared:
+                    break  # taken over by a newer connection of the client
+                self.last_active[client] = asyncio.get_event_loop().time()
+                for msg in batch:
+                    if session is not None and session.client is not client and client not in self.client_shared:
+                        break  # taken over while an earlier event was being handled
+                    key = (msg['id'], msg['event'])
+                    if key in latest:
+                        if latest[key] is not msg:
+                            self.coalesced_count += 1
+                            continue  # superseded by a newer event that is waiting in the queue
+                        del latest[key]
+                    t0 = time.perf_counter()
+                    result = self.clients[client].handle_event(msg)
+                    if inspect.isawaitable(result):
+                        await result
+                    seconds = time.perf_counter() - t0
+                    self.metrics.add_event(seconds)
+                    self.client_metrics[client].add_event(seconds)
+                if self.flush_rate is None and client in self.clients:
+                    await self.flush(client)
+        finally:
+            receiver.cancel()
+            self.outboxes.pop(client, None)
+            del self.client_metrics[client]
+            if session is None or client in self.client_shared:
+                self.last_active.pop(client, None)
+            if session is not None and client not in self.client_shared:
+                if session.client is client:
+                    # kept for resuming
+                    session.client = None
+                    session.expiry = asyncio.get_event_loop().call_later(self.resume_grace, self._expire, session)
+            else:
+                if client not in self.client_shared:
+                    self.clients[client]['on_dirty'] = None  # the shared documents are watched for their other subscribers
+                self._unsubscribe(client)
+                del self.clients[client]
+                self.dirty_clients.discard(client)
+                if session is not None:
+                    self._expire(session)
+
+    def _resume(self, session, client, seq):
+        """
+        continues the session on a new connection, sends the messages that the client missed or a snapshot if they are not kept anymore
+        """
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        previous = session.aliases[-1]
+        self.last_active.pop(previous, None)
+        if len(session.aliases) > 1:
+            # the previous connection is gone or being closed, the one that was given to the connection_handler is kept for the references to it
+            session.aliases.pop()
+            del self.clients[previous]
+            del self.client_sessions[previous]
+            self.dirty_clients.discard(previous)
+        session.client = client
+        session.aliases.append(client)
+        self.clients[client] = session.doc
+        self.client_sessions[client] = session
+        seq = int(seq) if seq.isdigit() else -1
+        if seq == session.seq:
+            return
+        missing = [msg for frame_seq, msg in session.frames if frame_seq > seq]
+        if 0 <= seq < session.seq and len(missing) == session.seq - seq:
+            self._enqueue(client, missing)
+        else:
+            self._resync(client, None)
+
+    def _expire(self, session):
+        """
+        drops a session and its document
+        """
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        session.doc['on_dirty'] = None
+        for client in session.aliases:
+            self.clients.pop(client, None)
+            self.client_sessions.pop(client, None)
+            self.dirty_clients.discard(client)
+            self.last_active.pop(client, None)
+        del self.sessions[session.id]
+
+    async def _receive_events(self, client, events, latest):
+        """
+        puts the event messages received from the client in the events queue as lists of the events in a websocket message, None when the connection is closed.
+        a message is either one event or a list of events that the client batched together
+        """
+        import websockets
+        try:
+            while True:
+                try:
+                    msg = await client.recv()
+                except websockets.exceptions.ConnectionClosed:
+                    break
+
+                try:
+                    msg = self.json_loads(msg)
+                except ValueError:
+                    continue
+
+                batch = [event for event in (msg if type(msg) is list else [msg]) if _is_event(event)]
+                if batch:
+                    if client not in self.clients:
+                        break  # taken over by a newer connection of the client
+                    callbacks = self.clients[client]['callbacks']
+                    for event in batch:
+                        listener = callbacks.get(event['id'], {}).get(event['event'])
+                        if listener is not None and listener[2] is not None:
+                            latest[(event['id'], event['event'])] = event
+                    await events.put(batch)
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            # the end of the events still has to reach the handler, which re-raises the error, the queued events are dropped to make room for it
+            while events.full():
+                events.get_nowait()
+            events.put_nowait(None)
+            raise
+        await events.put(None)
 
     def is_connected(self, client):
         """
-        returns whether the given client is still connected
+        returns whether the given client is still connected, or can still resume its session after it disconnected (see ``resume_grace``)
 
         :param client: a websocket client connection instance
         :type: client: ``WebSocketServerProtocol``
@@ -98,10 +473,16 @@ class DomsyncServer():
 
     def get_clients(self):
         """
-        :returns: list of connected clients
+        :returns: list of connected clients. A client that resumed its session (see ``resume_grace``) is listed once, by the client object that was given
+                  to the ``connection_handler``, clients that disconnected and can still resume are not listed.
         :rtype: list of ``WebSocketServerProtocol``
         """
-        return list(self.clients.keys())
+        res = []
+        for client in self.clients:
+            session = self.client_sessions.get(client)
+            if session is None or (session.aliases[0] is client and session.client is not None):
+                res.append(client)
+        return res
 
     def get_document(self, client):
         """
@@ -117,6 +498,76 @@ class DomsyncServer():
         """
         return self.clients[client]
 
+    def get_metrics(self, client=None):
+        """
+        returns the metrics of the server or of one client since it connected, see :meth:`domsync.metrics.Metrics.as_dict` for the fields.
+        Message sizes are in characters, times in seconds.
+
+        :param client: optional, the client to return the metrics of, None for the whole server
+        :type: client: ``WebSocketServerProtocol``
+
+        :returns: the metrics
+        :rtype: dict
+        """
+        return (self.metrics if client is None else self.client_metrics[client]).as_dict()
+
+    def render_metrics(self):
+        """
+        :returns: the metrics of the server and of every connected client in the Prometheus text format, the clients are labeled with their address
+        :rtype: str
+        """
+        from domsync.metrics import render_prometheus
+        client_metrics = {}
+        for client, metrics in self.client_metrics.items():
+            address = client.remote_address
+            client_metrics[str(id(client)) if address is None else f'{address[0]}:{address[1]}'] = metrics
+        return render_prometheus(self.metrics, client_metrics)
+
+    def get_compression_stats(self):
+        """
+        returns statistics of the compression of the messages sent to all clients since the server was started,
+        useful for tuning the compression settings, see :meth:`domsync.compression.CompressionStats.as_dict` for the fields
+
+        :returns: the statistics or None if compression is turned off
+        :rtype: dict
+        """
+        return None if self.compression_stats is None else self.compression_stats.as_dict()
+
+    def offload(self, work, then=None):
+        """
+        makes an event listener callback that runs ``work`` on the executor of the server instead of the event loop, for callbacks that do CPU-heavy work.
+
+        Documents are not thread safe so ``work`` must not touch them: it gets a copy of the event message without the ``'doc'`` field,
+        and its result is passed to ``then`` which is called on the event loop and is where the document can be updated.
+        With a process pool ``work`` needs to be picklable, for example a function defined at the top level of a module.
+
+        .. code-block:: python
+
+          def price(msg):
+              return expensive_pricing(msg['value'])
+
+          def show_price(msg, result):
+              msg['doc'].getElementById('price').innerText = result
+
+          el_input.addEventListener('input', server.offload(price, show_price), js_value_getter='this.value')
+
+        :param work: function that takes the event message and returns a result
+        :type work: Callable(dict)
+
+        :param then: optional, function that takes the event message and the result of ``work``, called on the event loop
+        :type then: Callable(dict, object)
+
+        :returns: a coroutine function to pass as the callback to :meth:`domsync.core._Element.addEventListener`
+        :rtype: Callable(dict)
+        """
+        async def callback(msg):
+            event = {key: value for key, value in msg.items() if key != 'doc'}
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, work, event)
+            if then is not None:
+                return then(msg, result)
+            return result
+        return callback
+
     async def flush(self, client):
         """
         sends the generated Javascript code updates to the client that happened due to manipulations to the client's document since the last time this function was called.
@@ -128,19 +579,351 @@ class DomsyncServer():
 
         :returns: None
         """
+        name = self.client_shared.get(client)
+        if name is not None:
+            await self.flush_shared(name)
+            return
+        doc = self.clients[client]
+        self._send_update(client, self._render_updates(doc, client))
+
+    async def send_full(self, client, chunk_size=None):
+        """
+        sends a full snapshot of the client's document to the client in messages of about ``chunk_size`` characters, see :meth:`domsync.Document.render_full_chunks`.
+        Useful when the client has lost its DOM state, for example after reloading the page. Updates that haven't been flushed yet are part of the snapshot.
+        Subtrees of the document that didn't change since the last snapshot are not rendered again.
+
+        The snapshot is generated in one go when it's the client's turn to receive it, so changes made to the document by other tasks while the messages are being sent
+        can't end up half in the snapshot, they are sent by the next :meth:`flush` instead. Updates queued for the client before that are dropped, the snapshot contains them.
+        Sending it in several messages keeps any single websocket message from blocking the connection for long.
+
+        :param client: the client to send the snapshot to
+        :type: client: ``WebSocketServerProtocol``
+
+        :param chunk_size: optional, approximate size of the messages in characters. default = ``snapshot_chunk_size`` of the server.
+        :type chunk_size: int
+
+        :returns: None
+        """
+        assert client in self.clients
+        self._resync(client, chunk_size)
+
+    def get_shared_document(self, name):
+        """
+        returns the shared document of the given name, creates it if it doesn't exist yet.
+        The shared document can be changed like any other document, the changes are sent to the subscribers by :meth:`flush_shared`.
+
+        :param name: name of the shared document
+        :type name: str
+
+        :returns: the shared document
+        :rtype: :class:`domsync.Document`
+        """
+        if name not in self.shared_documents:
+            self._add_shared_document(name, Document(self.root_id))
+        return self.shared_documents[name]
+
+    def load_shared_document(self, name, f, registry=None):
+        """
+        loads a shared document that was saved with :func:`domsync.storage.save`, for example a large prebuilt UI at startup.
+        Its clients get it with :meth:`subscribe` like any other shared document.
+
+        :param name: name of the shared document, there must not be a shared document of this name yet
+        :type name: str
+
+        :param f: file object opened for reading in binary mode
+        :type f: file-like
+
+        :param registry: optional, name -> callback of the event listener callbacks that were saved with the document, see :func:`domsync.storage.load`
+        :type registry: dict
+
+        :returns: the shared document
+        :rtype: :class:`domsync.Document`
+        """
+        from domsync.storage import load
+        assert name not in self.shared_documents
+        doc = load(f, registry)
+        assert doc['root_id'] == self.root_id
+        self._add_shared_document(name, doc)
+        return doc
+
+    def _add_shared_document(self, name, doc):
+        self.shared_documents[name] = doc
+        doc['profiler'] = self.profiler
+        self.subscribers[name] = set()
+        self._watch(doc, lambda doc: self._on_dirty(self.dirty_shared, name))
+
+    async def subscribe(self, client, name, chunk_size=None):
+        """
+        subscribes the client to the shared document of the given name, creating the document if it doesn't exist yet.
+        From then on the client shows the shared document instead of its own: :meth:`get_document` returns the shared document, the events of the client are
+        handled by the callbacks of the shared document and :meth:`flush` sends the updates of the shared document to all of its subscribers.
+        The client first gets a full snapshot of the shared document in messages of about ``chunk_size`` characters, which replaces whatever it showed before.
+
+        :param client: the client to subscribe
+        :type: client: ``WebSocketServerProtocol``
+
+        :param name: name of the shared document
+        :type name: str
+
+        :param chunk_size: optional, approximate size of the snapshot messages in characters. default = ``snapshot_chunk_size`` of the server.
+        :type chunk_size: int
+
+        :returns: None
+        """
+        assert client in self.clients
+        doc = self.get_shared_document(name)
+        self._unsubscribe(client)
+        self.subscribers[name].add(client)
+        self.client_shared[client] = name
+        self.clients[client]['on_dirty'] = None  # the own document of the client is not shown anymore
+        self.clients[client] = doc
+        self._resync(client, chunk_size)
+
+    def _unsubscribe(self, client):
+        name = self.client_shared.pop(client, None)
+        if name is not None:
+            self.subscribers[name].discard(client)
+
+    def get_subscribers(self, name):
+        """
+        :param name: name of the shared document
+        :type name: str
+
+        :returns: list of the clients subscribed to the shared document
+        :rtype: list of ``WebSocketServerProtocol``
+        """
+        return list(self.subscribers.get(name, ()))
+
+    async def flush_shared(self, name):
+        """
+        renders the updates of the shared document of the given name once and sends the same message to all of its subscribers.
+        The cost of rendering doesn't depend on the number of subscribers.
+
+        :param name: name of the shared document
+        :type name: str
+
+        :returns: None
+        """
+        doc = self.shared_documents[name]
+        msg = self._render_updates(doc)
+        self._broadcast(self.subscribers[name], msg)
+
+    async def flush_all(self):
+        """
+        similar to :meth:`domsync.domsync_server.DomsyncServer.flush`, but sends the updates of all documents to all connected clients,
+        the updates of each shared document are rendered once for all of its subscribers.
+
+        :returns: None
+        """
+        for name in list(self.shared_documents):
+            await self.flush_shared(name)
+        own = [client for client in self.clients if client not in self.client_shared and
+               (client not in self.client_sessions or self.client_sessions[client].aliases[0] is client)]  # the document of a session once
+        await asyncio.gather(*[self.flush(client) for client in own])
+
+    def _watch(self, doc, on_dirty):
+        if self.flush_rate is not None:
+            doc['on_dirty'] = on_dirty
+            if doc['ops']:
+                on_dirty(doc)
+
+    def _on_dirty(self, dirty, key):
+        dirty.add(key)
+        if self._auto_flush_handle is None:
+            loop = asyncio.get_event_loop()
+            if self.flush_rate == 0:
+                self._auto_flush_handle = loop.call_soon(self._auto_flush)
+            else:
+                self._auto_flush_handle = loop.call_at(max(loop.time(), self._last_auto_flush + 1 / self.flush_rate), self._auto_flush)
+
+    def _auto_flush(self):
+        """
+        flushes the documents that changed since the last automatic flush
+        """
+        self._auto_flush_handle = None
+        self._last_auto_flush = asyncio.get_event_loop().time()
+        dirty_shared, self.dirty_shared = self.dirty_shared, set()
+        dirty_clients, self.dirty_clients = self.dirty_clients, set()
+        for name in dirty_shared:
+            self._broadcast(self.subscribers[name], self._render_updates(self.shared_documents[name]))
+        for client in dirty_clients:
+            if client in self.clients and client not in self.client_shared:
+                self._send_update(client, self._render_updates(self.clients[client], client))
+
+    def _render_updates(self, doc, client=None):
+        """
+        renders the updates of the document and records the flush in the metrics of the server and of the client whose own document it is
+        """
+        if doc.is_hibernated():
+            return ''  # nothing changed since it was hibernated, no need to wake it up
+        ops = len(doc['ops'])
+        t0 = time.perf_counter()
+        msg = doc.render_updates(self.protocol)
+        seconds = time.perf_counter() - t0
+        if ops == 0:
+            return msg
+        session = self.client_sessions.get(client)
+        if session is not None:
+            client = session.aliases[-1]  # the metrics and the activity of a session are tracked for its latest connection
+        self.metrics.add_flush(seconds, len(msg), ops)
+        metrics = self.client_metrics.get(client)
+        if metrics is not None:
+            metrics.add_flush(seconds, len(msg), ops)
+        if client in self.last_active:
+            self.last_active[client] = asyncio.get_event_loop().time()
+        return msg
+
+    def _hibernate_idle(self):
+        """
+        hibernates the own documents of the connected clients that have been idle for longer than ``hibernate_after``, reschedules itself
+        """
+        loop = asyncio.get_event_loop()
+        self._hibernate_handle = loop.call_later(self.hibernate_after / 2, self._hibernate_idle)
+        idle_since = loop.time() - self.hibernate_after
+        for client, last_active in self.last_active.items():
+            if last_active > idle_since or client in self.client_shared or client in self.outboxes:
+                continue
+            doc = self.clients.get(client)
+            if doc is not None and not doc.is_hibernated() and doc.hibernate():
+                self.hibernate_count += 1
+
+    def _send_update(self, client, msg):
+        """
+        sends an update of the own document of the client, numbered and kept for resuming if the client has a session
+        """
+        if len(msg) == 0:
+            return
+        session = self.client_sessions.get(client)
+        if session is not None:
+            msg = self._number(session, msg)
+            client = session.client
+            if client is None:
+                return  # disconnected, the message is sent if the client resumes
+        self._broadcast([client], msg)
+
+    def _number(self, session, msg):
+        """
+        adds the next sequence number of the session to the message and keeps it for resuming
+        """
+        session.seq += 1
+        protocol = get_protocol(self.protocol)
+        msg = protocol.prepend(protocol.render_sequence(session.seq), msg)
+        session.frames.append((session.seq, msg))
+        return msg
+
+    def _broadcast(self, clients, msg):
+        """
+        sends the same message to all clients. clients that are keeping up get the message written to their connection right away,
+        encoded only once for all of them, the rest get it queued behind the messages they are sending
+        """
+        if len(msg) == 0:
+            return
+        idle = []
+        for client in clients:
+            if client in self.outboxes or client.transport is None or client.transport.get_write_buffer_size() > self.write_limit:
+                self._enqueue(client, [msg])
+            else:
+                idle.append(client)
+        if idle:
+            import websockets
+            t0 = time.perf_counter()
+            websockets.broadcast(idle, msg)
+            seconds = (time.perf_counter() - t0) / len(idle)  # the message is encoded once, each client is accounted for its share
+            for client in idle:
+                self.metrics.add_sent(len(msg))
+                self.metrics.send_seconds.observe(seconds)
+                metrics = self.client_metrics[client]
+                metrics.add_sent(len(msg))
+                metrics.send_seconds.observe(seconds)
+
+    def _outbox(self, client):
+        box = self.outboxes.get(client)
+        if box is None:
+            box = self.outboxes[client] = _Outbox()
+            box.task = asyncio.ensure_future(self._write(client, box))
+        return box
+
+    def _enqueue(self, client, messages):
+        """
+        queues messages for the client, or replaces everything queued with a snapshot if that makes the queue too long
+        """
+        box = self._outbox(client)
+        if box.resync is not None:
+            return  # the snapshot is rendered when it gets sent, it will contain these updates
+        box.messages.extend(messages)
+        box.size += sum(len(msg) for msg in messages)
+        if box.size > self.outbox_max_bytes or len(box.messages) > self.outbox_max_messages:
+            self.resync_count += 1
+            self._resync(client, None)
+
+    def _resync(self, client, chunk_size):
+        """
+        drops the updates queued for the client and schedules a full snapshot instead
+        """
+        box = self._outbox(client)
+        box.messages.clear()
+        box.size = 0
+        box.resync = self.snapshot_chunk_size if chunk_size is None else chunk_size
+
+    def _render_snapshot(self, client, chunk_size):
+        """
+        returns the messages of a full snapshot of the document of the client as an iterator. they are rendered one by one from a copy of the document
+        taken now, so the event loop keeps running while they are sent and the snapshot stays consistent while the document keeps changing.
+        the updates from now on are sent after the snapshot.
+        """
         doc = self.clients[client]
-        js = doc.render_js_updates()
-        if len(js) > 0:
-            await client.send(js)
-
-    # async def flush_all(self):
-    #     """
-    #     similar to :meth:`domsync.domsync_server.DomsyncServer.flush`, but sends updates to all connected clients
-
-    #     :returns: None
-    #     """
-    #     for client in self.clients:
-    #         doc = self.clients[client]
-    #         js = doc.render_js_updates()
-    #         if len(js) > 0:
-    #             await client.send(js)
+        name = self.client_shared.get(client)
+        if name is not None:
+            # the other subscribers still need the pending updates of the shared document
+            self._broadcast(self.subscribers[name] - {client}, doc.render_updates(self.protocol))
+            return doc._detached_full_chunks(self.protocol, chunk_size)
+        session = self.client_sessions.get(client)
+        msg = doc.render_updates(self.protocol)  # the pending updates are contained in the snapshot
+        chunks = doc._detached_full_chunks(self.protocol, chunk_size)
+        if session is not None:
+            # the pending updates are still numbered and kept so that a later resume from before the snapshot doesn't miss them
+            if len(msg) > 0:
+                self._number(session, msg)
+            # the sequence number is cleared at the start and set at the end, a client that resumes with only part of the snapshot gets a new one
+            protocol = get_protocol(self.protocol)
+            first = protocol.prepend(protocol.render_session(session.id), protocol.prepend(protocol.render_sequence(-1), next(chunks)))
+            chunks = itertools.chain([first], chunks, [protocol.frame([protocol.render_sequence(session.seq)])])
+        return chunks
+
+    async def _send_message(self, client, msg):
+        t0 = time.perf_counter()
+        await client.send(msg)
+        seconds = time.perf_counter() - t0
+        self.metrics.add_sent(len(msg))
+        self.metrics.send_seconds.observe(seconds)
+        metrics = self.client_metrics.get(client)
+        if metrics is not None:
+            metrics.add_sent(len(msg))
+            metrics.send_seconds.observe(seconds)
+
+    async def _write(self, client, box):
+        """
+        the writer task of a client, sends the queued messages and snapshots to the client in order until there is nothing left to send
+        """
+        import websockets
+        try:
+            while client in self.clients:
+                if box.resync is not None:
+                    chunk_size = box.resync
+                    box.resync = None
+                    for msg in self._render_snapshot(client, chunk_size):
+                        await self._send_message(client, msg)
+                        await asyncio.sleep(0)  # lets the event loop run between the messages even if they are sent without waiting
+                        if box.resync is not None:
+                            break  # the client fell behind again during the snapshot, start over with a fresh one
+                elif box.messages:
+                    msg = box.messages.popleft()
+                    box.size -= len(msg)
+                    await self._send_message(client, msg)
+                else:
+                    break
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if self.outboxes.get(client) is box:
+                del self.outboxes[client]
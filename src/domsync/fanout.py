@@ -0,0 +1,441 @@
+"""
+Multi-process fan-out of shared documents: one publisher process owns the documents and runs the callbacks, any number of worker processes
+accept the websocket connections of the Browsers. This spreads the websocket I/O, framing and compression of many clients over several cores
+while the documents are still changed in one place.
+
+The publisher renders the updates of a document once and sends them over a unix socket to the workers that have subscribers to it,
+each worker sends them on to its own clients. Events of the clients are forwarded by the workers to the publisher where the callbacks
+of the document are called. A client that connects to a worker gets a snapshot of the document from the publisher first.
+
+All workers can listen on the same port (``SO_REUSEPORT``), the kernel spreads the incoming connections between them:
+
+.. code-block:: python
+
+  # the publisher process
+  publisher = FanoutPublisher('/tmp/domsync.sock')
+  await publisher.serve()
+  start_workers(4, '/tmp/domsync.sock', 'localhost', 8888)
+  doc = publisher.get_shared_document('default')
+  ...
+  await publisher.flush_all()
+
+Messages between the publisher and the workers are JSON objects, each prefixed with its length as a 4 byte big-endian integer.
+The publisher waits for each worker to take what was sent to it, for all workers at once. A worker that falls too far behind stops getting updates
+and gets fresh snapshots for all of its clients once it caught up, like a lagging client of a worker.
+"""
+import asyncio
+import inspect
+import json
+import struct
+from domsync import Document
+from domsync.domsync_server import _default_json_loads, _is_event
+
+_header = struct.Struct('>I')
+
+
+def _write_frame(writer, obj):
+    data = json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    writer.write(_header.pack(len(data)) + data)
+
+
+async def _read_frame(reader, loads):
+    """
+    :returns: the next message or None at the end of the stream
+    """
+    try:
+        header = await reader.readexactly(_header.size)
+        return loads(await reader.readexactly(_header.unpack(header)[0]))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class FanoutPublisher():
+    """
+    owns the shared documents, serves their updates to :class:`FanoutWorker` processes over a unix socket and handles the events of their clients
+
+    :param path: path of the unix socket to listen on
+    :type path: str
+
+    :param root_id: optional, id of the element in the client-side HTML where domsync should be rendered. default = 'domsync_root_id'.
+    :type root_id: str
+
+    :param protocol: optional, the wire protocol of the updates sent to the clients, see :mod:`domsync.protocol`. default = 'js'.
+    :type protocol: str
+
+    :param verbose: optional, should we print status messages to stdout? default = True.
+    :type verbose: bool
+
+    :param snapshot_chunk_size: optional, approximate size of the messages of full snapshots in characters. default = 65536.
+    :type snapshot_chunk_size: int
+
+    :param lag_limit: optional, a worker with more than this many bytes waiting in the outgoing buffer of its connection stops getting updates,
+       it gets fresh snapshots for all of its clients instead once it caught up. default = 2**22.
+    :type lag_limit: int
+
+    :param json_loads: optional, the function that decodes the messages of the workers and the events of their clients, see the ``json_loads`` parameter of
+       :class:`domsync.domsync_server.DomsyncServer`. default = None which means ``orjson.loads`` if orjson is installed, ``json.loads`` otherwise.
+    :type json_loads: Callable(str)
+    """
+
+    def __init__(self, path, root_id='domsync_root_id', protocol='js', verbose=True, snapshot_chunk_size=65536, lag_limit=2**22, json_loads=None):
+        from domsync.protocol import get_protocol
+        get_protocol(protocol)
+        self.path = path
+        self.root_id = root_id
+        self.protocol = protocol
+        self.verbose = verbose
+        self.snapshot_chunk_size = snapshot_chunk_size
+        self.lag_limit = lag_limit
+        self.json_loads = _default_json_loads() if json_loads is None else json_loads
+        self.shared_documents = {}  # name -> shared domsync Document
+        self.workers = {}  # writer of a worker connection -> dict of document name -> number of its clients subscribed to it
+        self.client_names = {}  # (writer of a worker connection, client id) -> name of the document the client is subscribed to
+        self.lagging = set()  # writers of the worker connections that don't get updates until they caught up
+        self.resync_count = 0  # number of times a lagging worker was sent fresh snapshots
+        self.handlers = set()  # tasks handling the worker connections
+
+    async def serve(self):
+        """
+        starts listening for workers
+
+        :returns: None
+        """
+        self.server = await asyncio.start_unix_server(self._on_worker_connect, self.path)
+        if self.verbose:
+            print(f'domsync publisher started on {self.path}')
+
+    async def close(self):
+        """
+        stops listening and disconnects the workers
+
+        :returns: None
+        """
+        self.server.close()
+        for writer in list(self.workers):
+            writer.close()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def get_shared_document(self, name='default'):
+        """
+        returns the shared document of the given name, creates it on first use
+
+        :param name: name of the shared document, the workers subscribe their clients to it by this name
+        :type name: str
+
+        :returns: the shared document
+        :rtype: :class:`domsync.Document`
+        """
+        if name not in self.shared_documents:
+            self.shared_documents[name] = Document(self.root_id)
+        return self.shared_documents[name]
+
+    def get_subscriber_count(self, name='default'):
+        """
+        :returns: the number of clients subscribed to the shared document on all workers
+        :rtype: int
+        """
+        return sum(names.get(name, 0) for names in self.workers.values())
+
+    async def flush(self, name='default'):
+        """
+        renders the updates of the shared document once and sends them to the workers that have clients subscribed to it
+
+        :returns: None
+        """
+        msg = self.shared_documents[name].render_updates(self.protocol)
+        if len(msg) > 0:
+            writers = [writer for writer, names in self.workers.items() if names.get(name) and writer not in self.lagging]
+            for writer in writers:
+                _write_frame(writer, {'type': 'update', 'name': name, 'msg': msg})
+            await asyncio.gather(*[self._drain(writer) for writer in writers])
+
+    async def flush_all(self):
+        """
+        flushes all shared documents
+
+        :returns: None
+        """
+        for name in self.shared_documents:
+            await self.flush(name)
+
+    async def _drain(self, writer):
+        """
+        waits until the worker took enough of what was sent to it, or lets it catch up with a resync if it fell too far behind
+        """
+        if writer not in self.workers or writer in self.lagging:
+            return
+        if writer.transport.get_write_buffer_size() > self.lag_limit:
+            self.resync_count += 1
+            self.lagging.add(writer)
+            asyncio.ensure_future(self._resync(writer))
+            return
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass  # the worker is gone, _on_worker_connect cleans up after it
+
+    async def _resync(self, writer):
+        """
+        sends a fresh snapshot to every client of a lagging worker once it took everything that was sent to it before
+        """
+        transport = writer.transport
+        transport.set_write_buffer_limits(0)  # drain waits until everything was sent
+        try:
+            await writer.drain()
+        except ConnectionError:
+            return
+        if writer not in self.workers:
+            return
+        transport.set_write_buffer_limits()
+        # the other workers get the pending updates, the snapshots must not contain updates that the worker gets afterwards
+        while True:
+            names = set(name for (key_writer, _), name in self.client_names.items() if key_writer is writer)
+            pending = [name for name in names if self.shared_documents[name]['ops']]
+            if not pending:
+                break
+            for name in pending:
+                await self.flush(name)
+        # no awaits from here on, so the worker gets updates again right after the snapshots
+        snapshots = {name: list(self.shared_documents[name].render_full_chunks(self.protocol, self.snapshot_chunk_size)) for name in names}
+        for (key_writer, client_id), name in self.client_names.items():
+            if key_writer is writer:
+                _write_frame(writer, {'type': 'snapshot', 'client': client_id, 'name': name, 'chunks': snapshots[name]})
+        self.lagging.discard(writer)
+
+    async def _on_worker_connect(self, reader, writer):
+        self.workers[writer] = {}
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                msg = await _read_frame(reader, self.json_loads)
+                if msg is None:
+                    break
+                await self._on_worker_message(writer, msg)
+        finally:
+            for key in [key for key in self.client_names if key[0] is writer]:
+                del self.client_names[key]
+            del self.workers[writer]
+            self.lagging.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def _on_worker_message(self, writer, msg):
+        names = self.workers[writer]
+        key = (writer, msg['client'])
+        if msg['type'] == 'subscribe':
+            # the other subscribers get the pending updates and the new one a snapshot that already contains them
+            name = msg['name']
+            doc = self.get_shared_document(name)
+            while doc['ops']:
+                await self.flush(name)
+            # no awaits until the client is registered, the updates after the snapshot reach the worker
+            chunks = list(doc.render_full_chunks(self.protocol, self.snapshot_chunk_size))
+            if key not in self.client_names:
+                self.client_names[key] = name
+                names[name] = names.get(name, 0) + 1
+            if writer not in self.lagging:  # a lagging worker gets the snapshots of all of its clients when it caught up
+                _write_frame(writer, {'type': 'snapshot', 'client': msg['client'], 'name': name, 'chunks': chunks})
+                await self._drain(writer)
+        elif msg['type'] == 'unsubscribe':
+            name = self.client_names.pop(key, None)
+            if name is not None:
+                names[name] -= 1
+        elif msg['type'] == 'event':
+            name = self.client_names.get(key)
+            if name is None:
+                return
+            try:
+                event = self.json_loads(msg['event'])
+            except ValueError:
+                return
+            batch = [event for event in (event if type(event) is list else [event]) if _is_event(event)]
+            for event in batch:
+                result = self.shared_documents[name].handle_event(event)
+                if inspect.isawaitable(result):
+                    await result
+            if batch:
+                await self.flush(name)
+        else:
+            raise Exception('unknown message: ' + str(msg['type']))
+
+
+class FanoutWorker():
+    """
+    accepts websocket connections, subscribes every client to a shared document of a :class:`FanoutPublisher` and forwards the events of the clients to it
+
+    :param path: path of the unix socket of the publisher
+    :type path: str
+
+    :param host: host name to listen on
+    :type host: str
+
+    :param port: port number to listen on, several workers can listen on the same port
+    :type port: int
+
+    :param name: optional, name of the shared document that the clients are subscribed to, or a function that takes the path of the websocket request
+       and returns the name. default = 'default'.
+    :type name: str or Callable(str)
+
+    :param verbose: optional, should we print status messages to stdout? default = True.
+    :type verbose: bool
+
+    :param compression: optional, whether to compress the messages with the permessage-deflate websocket extension, see :mod:`domsync.compression`. default = True.
+    :type compression: bool
+
+    :param max_size: optional, maximum size of incoming messages in bytes, None for no limit. default = 2**20.
+    :type max_size: int
+
+    :param write_limit: optional, high-water mark of the outgoing buffer in bytes. default = 2**16.
+    :type write_limit: int
+
+    :param lag_limit: optional, a client with more than this many bytes waiting in its outgoing buffer stops getting updates,
+       it gets a fresh snapshot from the publisher instead. default = 2**22.
+    :type lag_limit: int
+
+    :param json_loads: optional, the function that decodes the messages of the publisher. default = None which means ``orjson.loads`` if orjson is installed,
+       ``json.loads`` otherwise.
+    :type json_loads: Callable(str)
+    """
+
+    def __init__(self, path, host, port, name='default', verbose=True, compression=True, max_size=2**20, write_limit=2**16, lag_limit=2**22, json_loads=None):
+        self.path = path
+        self.host = host
+        self.port = port
+        self.name = name
+        self.verbose = verbose
+        self.compression = compression
+        self.max_size = max_size
+        self.write_limit = write_limit
+        self.lag_limit = lag_limit
+        self.json_loads = _default_json_loads() if json_loads is None else json_loads
+        self.clients = {}  # client id -> websocket connection
+        self.subscribers = {}  # name of a shared document -> set of client ids that receive its updates
+        self.resync_count = 0  # number of times a lagging client was sent a fresh snapshot
+        self._next_client_id = 0
+
+    async def serve(self):
+        """
+        connects to the publisher and starts accepting websocket connections
+
+        :returns: None
+        """
+        import websockets
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        extensions = None
+        if self.compression:
+            from domsync.compression import server_extensions
+            extensions = server_extensions()
+        self.server = await websockets.serve(self._on_ws_client_connect, self.host, self.port, compression=None, extensions=extensions,
+                                             max_size=self.max_size, write_limit=self.write_limit, reuse_port=True)
+        self.receiver = asyncio.create_task(self._receive_from_publisher())
+        if self.verbose:
+            print(f'domsync worker started on ws://{self.host}:{self.port}')
+
+    async def close(self):
+        """
+        stops the worker
+
+        :returns: None
+        """
+        self.receiver.cancel()
+        try:
+            await self.receiver
+        except asyncio.CancelledError:
+            pass
+        self.server.close()
+        await self.server.wait_closed()
+        self.writer.close()
+
+    async def _on_ws_client_connect(self, client, path):
+        import websockets
+        client_id = self._next_client_id
+        self._next_client_id += 1
+        self.clients[client_id] = client
+        name = self.name(path) if callable(self.name) else self.name
+        _write_frame(self.writer, {'type': 'subscribe', 'client': client_id, 'name': name})
+        try:
+            while True:
+                try:
+                    msg = await client.recv()
+                except websockets.exceptions.ConnectionClosed:
+                    break
+                if type(msg) is bytes:
+                    # binary frames are forwarded as text like the JSON decoder of the publisher would read them
+                    try:
+                        msg = msg.decode('utf-8')
+                    except UnicodeDecodeError:
+                        continue
+                _write_frame(self.writer, {'type': 'event', 'client': client_id, 'event': msg})
+                await self.writer.drain()
+        finally:
+            del self.clients[client_id]
+            for subscribers in self.subscribers.values():
+                subscribers.discard(client_id)
+            _write_frame(self.writer, {'type': 'unsubscribe', 'client': client_id})
+
+    async def _receive_from_publisher(self):
+        import websockets
+        while True:
+            msg = await _read_frame(self.reader, self.json_loads)
+            if msg is None:
+                break
+            if msg['type'] == 'update':
+                subscribers = self.subscribers.get(msg['name'], ())
+                clients = [self.clients[client_id] for client_id in subscribers]
+                websockets.broadcast(clients, msg['msg'])
+                for client_id, client in zip(list(subscribers), clients):
+                    if client.transport is not None and client.transport.get_write_buffer_size() > self.lag_limit:
+                        # the client can't keep up, it gets a snapshot instead of the updates it missed once it caught up
+                        self.resync_count += 1
+                        subscribers.discard(client_id)
+                        asyncio.ensure_future(self._resync(client_id, msg['name']))
+            elif msg['type'] == 'snapshot':
+                client = self.clients.get(msg['client'])
+                if client is not None:
+                    for chunk in msg['chunks']:
+                        websockets.broadcast([client], chunk)
+                    self.subscribers.setdefault(msg['name'], set()).add(msg['client'])
+        if self.verbose:
+            print('domsync worker lost the connection to the publisher')
+        self.server.close()
+
+    async def _resync(self, client_id, name):
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        await client.drain()
+        if client_id in self.clients:
+            _write_frame(self.writer, {'type': 'subscribe', 'client': client_id, 'name': name})
+
+
+def _run_worker(path, host, port, kwargs):
+    async def main():
+        worker = FanoutWorker(path, host, port, **kwargs)
+        await worker.serve()
+        await worker.server.wait_closed()
+    asyncio.run(main())
+
+
+def start_workers(n, path, host, port, **kwargs):
+    """
+    starts worker processes that all listen on the same port
+
+    :param n: number of worker processes, typically the number of cores
+    :type n: int
+
+    :param path: path of the unix socket of the publisher, which has to be serving already
+    :type path: str
+
+    :param kwargs: optional, further arguments of :class:`FanoutWorker`
+
+    :returns: the started processes
+    :rtype: list of ``multiprocessing.Process``
+    """
+    import multiprocessing
+    processes = []
+    for _ in range(n):
+        process = multiprocessing.Process(target=_run_worker, args=(path, host, port, kwargs), daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
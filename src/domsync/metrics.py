@@ -0,0 +1,167 @@
+"""
+Runtime metrics of :class:`domsync.domsync_server.DomsyncServer`: counters and histograms of the flushes, the messages sent and the events handled,
+for the whole server and for each client. Recording a value costs a few additions and a binary search, so the metrics are always on.
+
+The metrics can be read from Python with :meth:`domsync.domsync_server.DomsyncServer.get_metrics` or scraped in the Prometheus text format
+from a local HTTP endpoint, see the ``metrics_port`` parameter of :class:`domsync.domsync_server.DomsyncServer`.
+"""
+import asyncio
+from bisect import bisect_left
+
+# upper bounds of the buckets of the histograms
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096, 16384)
+
+
+class Histogram():
+    """
+    counts observed values in buckets of fixed upper bounds, along with their number and sum
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is for the values above the largest bound
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        :returns: the upper bound of the bucket that contains the q-quantile of the observed values, None if there are none,
+                  infinity if it's above the largest bound
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Metrics():
+    """
+    the metrics of a server or of one of its clients
+    """
+
+    def __init__(self):
+        self.flushes = 0  # flushes that rendered updates
+        self.flush_seconds = Histogram(LATENCY_BUCKETS)  # time spent rendering the updates of a flush
+        self.flush_bytes = Histogram(SIZE_BUCKETS)  # size of the rendered updates of a flush
+        self.flush_ops = Histogram(COUNT_BUCKETS)  # operations recorded by the document for a flush
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        # time until a message was written to the connection. a queued message includes waiting for the client to keep up,
+        # a message written right away to the clients that keep up is accounted for its share of writing it to all of them
+        self.send_seconds = Histogram(LATENCY_BUCKETS)
+        self.events = 0  # events handled
+        self.event_seconds = Histogram(LATENCY_BUCKETS)  # time spent handling an event, including awaiting a coroutine callback
+
+    def add_flush(self, seconds, size, ops):
+        self.flushes += 1
+        self.flush_seconds.observe(seconds)
+        self.flush_bytes.observe(size)
+        self.flush_ops.observe(ops)
+
+    def add_sent(self, size):
+        self.messages_sent += 1
+        self.bytes_sent += size
+
+    def add_event(self, seconds):
+        self.events += 1
+        self.event_seconds.observe(seconds)
+
+    def as_dict(self):
+        """
+        :returns: the counters and a summary of each histogram with its count, sum and the bucket bounds of the median and the 99th percentile
+        :rtype: dict
+        """
+        res = {}
+        for name, value in vars(self).items():
+            res[name] = value.as_dict() if type(value) is Histogram else value
+        return res
+
+
+def _render_metric(lines, name, value, labels):
+    if type(value) is Histogram:
+        for bound, count in zip(value.bounds + (float('inf'),), _cumulative(value.counts)):
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {count}')
+        braces = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{braces} {value.sum}')
+        lines.append(f'{name}_count{braces} {value.count}')
+    else:
+        lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+
+def _cumulative(counts):
+    total = 0
+    for count in counts:
+        total += count
+        yield total
+
+
+def render_prometheus(server_metrics, client_metrics, prefix='domsync'):
+    """
+    renders metrics in the Prometheus text exposition format
+
+    :param server_metrics: the metrics of the server
+    :type server_metrics: :class:`Metrics`
+
+    :param client_metrics: label of the client -> the metrics of the client, rendered with a ``client`` label
+    :type client_metrics: dict
+
+    :returns: the text to serve
+    :rtype: str
+    """
+    lines = []
+    for attr, value in vars(server_metrics).items():
+        name = prefix + '_' + attr + ('_total' if type(value) is int else '')
+        lines.append(f'# TYPE {name} {"histogram" if type(value) is Histogram else "counter"}')
+        _render_metric(lines, name, value, '')
+        for label, metrics in client_metrics.items():
+            _render_metric(lines, name, getattr(metrics, attr), 'client="' + label.replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_http(render, host='127.0.0.1', port=9100):
+    """
+    starts a minimal HTTP server that responds to every GET request with the text returned by ``render``
+
+    :param render: function that returns the metrics text
+    :type render: Callable()
+
+    :returns: the ``asyncio.Server``
+    """
+    async def on_connect(reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            if request.startswith(b'GET '):
+                body = render().encode('utf-8')
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' + str(len(body)).encode() +
+                             b'\r\nConnection: close\r\n\r\n' + body)
+            else:
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(on_connect, host, port)
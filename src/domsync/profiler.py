@@ -0,0 +1,150 @@
+"""
+Profiling of the event listener callbacks of a :class:`domsync.Document`.
+
+When a profiler is set on a document (``DomsyncServer(..., profiler=CallbackProfiler())`` sets it on every document of the server), every callback
+called by :meth:`domsync.Document.handle_event` is timed. The wall time, the CPU time of the event loop thread and the number of DOM operations
+the callback recorded are aggregated per (element id, event, callback). Callbacks slower than the threshold are logged one by one,
+:meth:`CallbackProfiler.report` returns the callbacks that took the most time overall.
+
+Coroutine callbacks are timed until they finish. Their CPU time only counts the steps they run themselves, not the time spent awaiting,
+and their operations also count the ones recorded by other tasks in the meantime.
+"""
+import logging
+import time
+
+logger = logging.getLogger('domsync.profiler')
+
+
+class _CallbackStats():
+
+    __slots__ = ('calls', 'wall', 'cpu', 'ops', 'max_wall', 'slow')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.ops = 0
+        self.max_wall = 0.0
+        self.slow = 0  # calls above the threshold
+
+
+class CallbackProfiler():
+    """
+    :param threshold: optional, callbacks that take longer than this many seconds of wall time are logged. default = 0.05.
+    :type threshold: float
+
+    :param logger: optional, the logger to log the slow callbacks with at WARNING level. default = the ``domsync.profiler`` logger.
+    :type logger: ``logging.Logger``
+    """
+
+    def __init__(self, threshold=0.05, logger=logger):
+        self.threshold = threshold
+        self.logger = logger
+        self.stats = {}  # (element id, event, callback qualname) -> _CallbackStats
+
+    def call(self, doc, msg, callback):
+        """
+        calls the callback with the event message and records its timing, used by :meth:`domsync.Document.handle_event`
+
+        :returns: what the callback returns, for a coroutine function callback an awaitable that records the timing when it finishes
+        """
+        ops0 = doc._op_total()
+        wall0 = time.perf_counter()
+        cpu0 = time.thread_time()
+        result = callback(msg)
+        cpu = time.thread_time() - cpu0
+        if hasattr(result, '__await__'):
+            return _ProfiledAwaitable(self, doc, msg, callback, result, wall0, cpu, ops0)
+        self.record(msg['id'], msg['event'], callback, time.perf_counter() - wall0, cpu, doc._op_total() - ops0)
+        return result
+
+    def record(self, id, event, callback, wall, cpu, ops):
+        """
+        adds a call of a callback to the statistics and logs it if it was slow
+        """
+        key = (id, event, getattr(callback, '__qualname__', repr(callback)))
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = _CallbackStats()
+        stats.calls += 1
+        stats.wall += wall
+        stats.cpu += cpu
+        stats.ops += ops
+        stats.max_wall = max(stats.max_wall, wall)
+        if wall > self.threshold:
+            stats.slow += 1
+            if self.logger is not None:
+                self.logger.warning('slow callback %s for %r on #%s: %.1f ms wall, %.1f ms cpu, %d ops', key[2], event, id, wall * 1e3, cpu * 1e3, ops)
+
+    def report(self, n=10, sort_by='wall'):
+        """
+        :param n: optional, the number of callbacks to return. default = 10.
+        :type n: int
+
+        :param sort_by: optional, ``'wall'``, ``'cpu'``, ``'ops'``, ``'calls'``, ``'max_wall'`` or ``'slow'``, the total to sort the callbacks by. default = 'wall'.
+        :type sort_by: str
+
+        :returns: the top ``n`` callbacks with their 'id', 'event', 'callback', 'calls', 'wall', 'cpu', 'ops', 'max_wall' and 'slow' totals
+        :rtype: list of dict
+        """
+        assert sort_by in _CallbackStats.__slots__
+        top = sorted(self.stats.items(), key=lambda item: getattr(item[1], sort_by), reverse=True)[:n]
+        return [dict(id=id, event=event, callback=callback, **{attr: getattr(stats, attr) for attr in _CallbackStats.__slots__})
+                for (id, event, callback), stats in top]
+
+    def format_report(self, n=10, sort_by='wall'):
+        """
+        :returns: the report of :meth:`report` as a text table
+        :rtype: str
+        """
+        lines = [f'{"wall ms":>10} {"cpu ms":>10} {"max ms":>9} {"calls":>7} {"slow":>5} {"ops":>8}  callback']
+        for row in self.report(n, sort_by):
+            lines.append(f'{row["wall"] * 1e3:10.1f} {row["cpu"] * 1e3:10.1f} {row["max_wall"] * 1e3:9.1f} {row["calls"]:7d} {row["slow"]:5d} {row["ops"]:8d}  '
+                         f'{row["callback"]} for {row["event"]!r} on #{row["id"]}')
+        return '\n'.join(lines)
+
+    def reset(self):
+        """
+        clears the statistics, to start a new profiling session
+        """
+        self.stats = {}
+
+
+class _ProfiledAwaitable():
+    """
+    awaits the coroutine of a callback and adds up the CPU time of its steps
+    """
+
+    def __init__(self, profiler, doc, msg, callback, awaitable, wall0, cpu, ops0):
+        self.profiler = profiler
+        self.doc = doc
+        self.msg = msg
+        self.callback = callback
+        self.awaitable = awaitable
+        self.wall0 = wall0
+        self.cpu = cpu
+        self.ops0 = ops0
+
+    def _done(self):
+        self.profiler.record(self.msg['id'], self.msg['event'], self.callback, time.perf_counter() - self.wall0, self.cpu, self.doc._op_total() - self.ops0)
+
+    def __await__(self):
+        it = self.awaitable.__await__()
+        value, exc = None, None
+        while True:
+            cpu0 = time.thread_time()
+            try:
+                future = it.send(value) if exc is None else it.throw(exc)
+            except StopIteration as e:
+                self.cpu += time.thread_time() - cpu0
+                self._done()
+                return e.value
+            except BaseException:
+                self.cpu += time.thread_time() - cpu0
+                self._done()
+                raise
+            self.cpu += time.thread_time() - cpu0
+            try:
+                value, exc = (yield future), None
+            except BaseException as e:
+                value, exc = None, e
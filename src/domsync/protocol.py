@@ -0,0 +1,273 @@
+"""
+Wire protocols that turn the operations recorded by a :class:`domsync.Document` into messages for the Browser client.
+
+* ``'js'`` (default): every operation is rendered as a line of Javascript code that the client evaluates with ``eval``, see ``examples/client.html``.
+* ``'compact'``: the operations are encoded as one flat JSON array of opcodes and their arguments. The client applies them with the small
+  runtime in ``domsync.js`` (see :func:`client_runtime_js`) without evaluating any code, which keeps both the message size and the client-side
+  parsing cost down. :func:`decode_compact` decodes such a message in Python.
+
+A compact message looks like this:
+
+.. code-block:: javascript
+
+    [1,5,"div","el0", 9,5,"hello", 2,0,5]
+
+which is a create of a div with the id ``el0`` as handle 5, setting its innerText and appending it to the root element which always has the handle 0.
+
+Both protocols address elements by the integer handles assigned by the :class:`domsync.Document` instead of their ids.
+"""
+import json
+
+# opcodes of the operations recorded by the Document. operations are kept as tuples of (opcode, element, *args),
+# in the compact protocol they are sent as opcode followed by the element reference and the arguments.
+OP_INIT = 0  # (OP_INIT, root_el) -> compact: 0, root_el, root_id
+OP_CREATE = 1  # (OP_CREATE, el) -> compact: 1, el, tagName, id
+OP_APPEND_CHILD = 2  # (OP_APPEND_CHILD, parent_el, child_el)
+OP_INSERT_BEFORE = 3  # (OP_INSERT_BEFORE, parent_el, child_el, before_el)
+OP_REMOVE = 4  # (OP_REMOVE, el)
+OP_REPLACE_CHILDREN = 5  # (OP_REPLACE_CHILDREN, parent_el, tuple of child elements) -> compact: 5, parent_el, [child_el, ...]
+OP_SET_ATTRIBUTE = 6  # (OP_SET_ATTRIBUTE, el, attrib, value)
+OP_REMOVE_ATTRIBUTE = 7  # (OP_REMOVE_ATTRIBUTE, el, attrib)
+OP_ADD_EVENT_LISTENER = 8  # (OP_ADD_EVENT_LISTENER, el, event, js_value_getter, rate) where rate is None or ('throttle' or 'debounce' or 'frame', milliseconds)
+#                             -> compact: 8, el, event, js_value_getter, null or [kind, milliseconds]
+OP_SET_INNER_TEXT = 9  # (OP_SET_INNER_TEXT, el, text)
+OP_SET_VALUE = 10  # (OP_SET_VALUE, el, value)
+OP_INSERT_FRAGMENT = 11  # (OP_INSERT_FRAGMENT, parent_el, before_el or None, html, tuple of the elements in the html in document order)
+#                          -> compact: 11, parent_el, before_el or null, html, [el, ...]
+
+# opcodes that are added by the server to the messages, they are not recorded by the Document, see render_sequence and render_session
+OP_SEQUENCE = 12  # compact: 12, sequence number of the message
+OP_SESSION = 13  # compact: 13, session id of the client
+
+# number of items following the opcode in the compact protocol
+_compact_arity = [2, 3, 2, 3, 1, 2, 3, 2, 4, 2, 2, 4, 1, 1]
+
+# client-side wrappers of event listener functions that limit the rate of the events, called with the listener function and the milliseconds
+_rate_limiters = {
+    'throttle': "function(f,ms){var t=null,last=0;return function(){var self=this,wait=ms-(Date.now()-last);if(t!==null)return;"
+                "if(wait<=0){last=Date.now();f.call(self);}else{t=setTimeout(function(){t=null;last=Date.now();f.call(self);},wait);}};}",
+    'debounce': "function(f,ms){var t=null;return function(){var self=this;clearTimeout(t);t=setTimeout(function(){t=null;f.call(self);},ms);};}",
+    'frame': "function(f){var p=false;return function(){var self=this;if(p)return;p=true;(document.hidden?setTimeout:requestAnimationFrame)(function(){p=false;f.call(self);});};}",
+}
+
+
+def str_is_safe(s):
+    return '"' not in s and "'" not in s and "`" not in s
+
+
+def str_escape_for_js(s):
+    return s.replace("'", r"\x27").replace('"', r"\x22")
+
+
+class JsProtocol():
+    """
+    renders operations as Javascript code, one line per operation
+    """
+
+    name = 'js'
+
+    def ref(self, el):
+        return f"""__domsync__[{el._handle}]"""
+
+    def render_event_listener(self, el, event, js_value_getter, rate=None):
+        event_msg = {
+            'domsync': True,
+            'event': event,
+            'id': el._id,
+            'value': js_value_getter,
+        }
+        event_msg = json.dumps(event_msg)
+        if js_value_getter is not None:
+            event_msg = event_msg.replace('"'+js_value_getter+'"', js_value_getter)
+        listener = r"function(){ws_send("+event_msg+r")}"
+        if rate is not None:
+            listener = f"""({_rate_limiters[rate[0]]})({listener},{rate[1]})"""
+        return listener
+
+    def render_op(self, op):
+        code = op[0]
+        ref = self.ref(op[1])
+        if code == OP_SET_INNER_TEXT:
+            return f"""{ref}.innerText = `{op[2]}`;\n"""
+        elif code == OP_SET_VALUE:
+            return f"""{ref}.value = `{op[2]}`;\n"""
+        elif code == OP_SET_ATTRIBUTE:
+            value = op[3]
+            if op[2].startswith('on'):
+                # https://stackoverflow.com/questions/97578/how-do-i-escape-a-string-inside-javascript-code-inside-an-onclick-handler
+                # need to escape quotes in code string
+                value = str_escape_for_js(value)
+            return f"""{ref}.setAttribute("{op[2]}","{value}");\n"""
+        elif code == OP_REMOVE_ATTRIBUTE:
+            return f"""{ref}.removeAttribute("{op[2]}");\n"""
+        elif code == OP_CREATE:
+            el = op[1]
+            return f"""{ref} = document.createElement("{el._tag}");{ref}.setAttribute("id","{el._id}");\n"""
+        elif code == OP_APPEND_CHILD:
+            return f"""{ref}.appendChild({self.ref(op[2])});\n"""
+        elif code == OP_INSERT_BEFORE:
+            return f"""{ref}.insertBefore({self.ref(op[2])}, {self.ref(op[3])});\n"""
+        elif code == OP_REMOVE:
+            return f"""{ref}.remove();\n"""
+        elif code == OP_REPLACE_CHILDREN:
+            args = ', '.join(self.ref(child) for child in op[2])
+            return f"""{ref}.replaceChildren({args});\n"""
+        elif code == OP_ADD_EVENT_LISTENER:
+            return f"""{ref}.addEventListener("{op[2]}",{self.render_event_listener(op[1], op[2], op[3], op[4])});\n"""
+        elif code == OP_INSERT_FRAGMENT:
+            # the html is parsed by a <template> which allows any elements like <tr> or <option> at the top level,
+            # elements of the parsed html are matched with their handles in document order
+            before = 'null' if op[2] is None else self.ref(op[2])
+            handles = ','.join([str(el._handle) for el in op[4]])
+            html = json.dumps(op[3], ensure_ascii=False)
+            return (f"""(function(t){{t.innerHTML={html};var e=t.content.querySelectorAll("[id]"),h=[{handles}];"""
+                    f"""for(var i=0;i<e.length;i++){{__domsync__[h[i]]=e[i];}}{ref}.insertBefore(t.content,{before});}})(document.createElement("template"));\n""")
+        elif code == OP_INIT:
+            return f"""var __domsync__ = [];\n{ref} = document.getElementById("{op[1]._id}");\n"""
+        raise Exception('unknown operation: ' + str(code))
+
+    def render_sequence(self, seq):
+        return f"""__domsync_seq__ = {seq};\n"""
+
+    def render_session(self, session_id):
+        return f"""__domsync_session__ = {json.dumps(session_id)};\n"""
+
+    def prepend(self, piece, message):
+        """
+        adds a rendered operation to the front of a message
+        """
+        return piece + message
+
+    def join(self, pieces):
+        """
+        joins rendered operations into one piece that can be framed together with other pieces
+        """
+        return ''.join(pieces)
+
+    def frame(self, pieces):
+        """
+        joins rendered operations into one message
+        """
+        return ''.join(pieces)
+
+
+class CompactProtocol():
+    """
+    renders operations as a flat JSON array of opcodes and arguments, applied on the client side by ``domsync.js``
+    """
+
+    name = 'compact'
+
+    def ref(self, el):
+        return el._handle
+
+    def render_op(self, op):
+        code = op[0]
+        ref = self.ref(op[1])
+        if code == OP_CREATE:
+            items = [code, ref, op[1]._tag, op[1]._id]
+        elif code == OP_APPEND_CHILD:
+            items = [code, ref, self.ref(op[2])]
+        elif code == OP_INSERT_BEFORE:
+            items = [code, ref, self.ref(op[2]), self.ref(op[3])]
+        elif code == OP_REPLACE_CHILDREN:
+            items = [code, ref, [self.ref(child) for child in op[2]]]
+        elif code == OP_INSERT_FRAGMENT:
+            items = [code, ref, None if op[2] is None else self.ref(op[2]), op[3], [self.ref(el) for el in op[4]]]
+        elif code == OP_INIT:
+            items = [code, ref, op[1]._id]
+        elif code == OP_REMOVE:
+            items = [code, ref]
+        elif 0 <= code < len(_compact_arity):
+            items = [code, ref] + list(op[2:])
+        else:
+            raise Exception('unknown operation: ' + str(code))
+        return json.dumps(items, separators=(',', ':'), ensure_ascii=False)[1:-1]
+
+    def render_sequence(self, seq):
+        return f"""{OP_SEQUENCE},{seq}"""
+
+    def render_session(self, session_id):
+        return f"""{OP_SESSION},{json.dumps(session_id)}"""
+
+    def prepend(self, piece, message):
+        """
+        adds a rendered operation to the front of a message
+        """
+        return '[' + piece + ',' + message[1:]
+
+    def join(self, pieces):
+        """
+        joins rendered operations into one piece that can be framed together with other pieces
+        """
+        return ','.join(pieces)
+
+    def frame(self, pieces):
+        """
+        joins rendered operations into one message
+        """
+        return '[' + ','.join(pieces) + ']' if pieces else ''
+
+
+protocols = {
+    'js': JsProtocol(),
+    'compact': CompactProtocol(),
+}
+
+
+def get_protocol(protocol):
+    """
+    :param protocol: name of the protocol, ``'js'`` or ``'compact'``
+    :type protocol: str
+
+    :returns: the protocol instance of the given name
+    """
+    assert protocol in protocols, "unknown protocol: " + str(protocol)
+    return protocols[protocol]
+
+
+def render(ops, protocol='js'):
+    """
+    renders a list of operations into one message of the given protocol
+
+    :returns: the message, an empty string if there are no operations
+    :rtype: str
+    """
+    protocol = get_protocol(protocol)
+    return protocol.frame([protocol.render_op(op) for op in ops])
+
+
+def decode_compact(message):
+    """
+    decodes a message of the compact protocol, mainly useful for testing and debugging
+
+    :param message: a message rendered with the compact protocol
+    :type message: str
+
+    :returns: the operations in the message as tuples of (opcode, element reference, *args)
+    :rtype: list of tuple
+    """
+    if message == '':
+        return []
+    items = json.loads(message)
+    assert type(items) is list
+    ops = []
+    i = 0
+    while i < len(items):
+        code = items[i]
+        assert type(code) is int and 0 <= code < len(_compact_arity), "unknown operation: " + repr(code)
+        n = _compact_arity[code]
+        assert i + 1 + n <= len(items), "truncated operation: " + repr(items[i:])
+        ops.append(tuple(items[i:i + 1 + n]))
+        i += 1 + n
+    return ops
+
+
+def client_runtime_js():
+    """
+    :returns: the source code of ``domsync.js``, the client-side runtime of the compact protocol. It can be served to the Browser or inlined in a ``<script>`` tag.
+    :rtype: str
+    """
+    import os
+    with open(os.path.join(os.path.dirname(__file__), 'domsync.js'), encoding='utf-8') as f:
+        return f.read()
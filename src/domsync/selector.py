@@ -0,0 +1,290 @@
+"""
+CSS selector engine behind :meth:`domsync.Document.querySelector`, :meth:`domsync.Document.querySelectorAll`,
+:meth:`domsync.core._Element.querySelector` and :meth:`domsync.core._Element.querySelectorAll`.
+
+Supported syntax:
+
+* type selectors ``div`` and the universal selector ``*``
+* id selectors ``#id``, class selectors ``.class``. ids containing characters like ``.`` can be matched with ``[id="a.b"]``
+* attribute selectors ``[attr]``, ``[attr=value]``, ``[attr~=value]``, ``[attr|=value]``, ``[attr^=value]``, ``[attr$=value]``, ``[attr*=value]``,
+  values can be quoted. ``[id^=prefix]`` matches the domsync id of elements.
+* pseudo-classes ``:first-child``, ``:last-child``, ``:only-child``, ``:empty``
+* combinators: descendant (whitespace), child ``>``, next sibling ``+``, subsequent sibling ``~``
+* selector lists separated by ``,``
+
+Selectors are compiled once and cached. Matching goes from right to left: candidates for the rightmost compound selector are taken from
+the id, class or tag index of the document, and only the remaining combinators are checked by walking up the tree from each candidate.
+"""
+import re
+
+_cache = {}  # selector string -> compiled selector list
+_cache_max_size = 1024
+_anchor_weight = 32  # an ancestor compound is used to narrow down candidates if it has this many times fewer candidates than the rightmost one
+
+_re_ident = r'-?[_a-zA-Z][_a-zA-Z0-9-]*'
+_re_token = re.compile(r'''
+    (?P<comb>\s*[>+~,]\s*)
+  | (?P<ws>\s+)
+  | \#(?P<id>[_a-zA-Z0-9-]+)
+  | \.(?P<cls>''' + _re_ident + r''')
+  | \[\s*(?P<attr>''' + _re_ident + r''')\s*(?:(?P<op>[~|^$*]?=)\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[^\]\s]+))\s*)?\]
+  | :(?P<pseudo>[a-z-]+)
+  | (?P<tag>\*|''' + _re_ident + r''')
+''', re.VERBOSE)
+
+_attr_ops = {
+    None: lambda v, x: v is not None,
+    '=': lambda v, x: v == x,
+    '~=': lambda v, x: v is not None and x in v.split(),
+    '|=': lambda v, x: v is not None and (v == x or v.startswith(x + '-')),
+    '^=': lambda v, x: v is not None and x != '' and v.startswith(x),
+    '$=': lambda v, x: v is not None and x != '' and v.endswith(x),
+    '*=': lambda v, x: v is not None and x != '' and x in v,
+}
+
+_pseudos = {
+    'first-child': lambda el: el._prev is None,
+    'last-child': lambda el: el._next is None,
+    'only-child': lambda el: el._prev is None and el._next is None,
+    'empty': lambda el: el._first is None and not el._innerText,
+}
+
+
+class _Compound():
+    """
+    a compound selector like ``div#id.a.b[x=y]:first-child``
+    """
+
+    __slots__ = ('universal', 'tag', 'id', 'classes', 'attrs', 'pseudos')
+
+    def __init__(self):
+        self.universal = False
+        self.tag = None
+        self.id = None
+        self.classes = []
+        self.attrs = []  # list of (name, op, value)
+        self.pseudos = []
+
+    def is_empty(self):
+        return not self.universal and self.tag is None and self.id is None and not self.classes and not self.attrs and not self.pseudos
+
+    def matches(self, el):
+        if self.tag is not None and el._tag != self.tag:
+            return False
+        if self.id is not None and el._id != self.id:
+            return False
+        attributes = el._attributes
+        if self.classes:
+            if attributes is None or not attributes.get('class'):
+                return False
+            names = attributes['class'].split()
+            for name in self.classes:
+                if name not in names:
+                    return False
+        for name, op, value in self.attrs:
+            v = el._id if name == 'id' else None if attributes is None else attributes.get(name)
+            if not _attr_ops[op](v, value):
+                return False
+        for pseudo in self.pseudos:
+            if not _pseudos[pseudo](el):
+                return False
+        return True
+
+
+def _invalid(selectors):
+    return Exception('invalid selector: ' + repr(selectors))
+
+
+def compile_selector(selectors):
+    """
+    parses a selector list into a list of complex selectors. each complex selector is a list of ``(compound, combinator)`` pairs
+    from right to left, where combinator is the combinator connecting the compound to the next one on its left (None for the leftmost).
+    compiled selectors are cached.
+    """
+    if type(selectors) is not str:
+        raise _invalid(selectors)
+    compiled = _cache.get(selectors)
+    if compiled is not None:
+        return compiled
+    result = []
+    parts = []  # compounds and combinators of the current complex selector, left to right
+    compound = _Compound()
+    pos = 0
+    s = selectors.strip()
+    while pos < len(s):
+        m = _re_token.match(s, pos)
+        if m is None:
+            raise _invalid(selectors)
+        pos = m.end()
+        kind = m.lastgroup
+        if kind in ('ws', 'comb'):
+            comb = m.group().strip() or ' '
+            if compound.is_empty():
+                raise _invalid(selectors)
+            parts.append(compound)
+            compound = _Compound()
+            if comb == ',':
+                result.append(parts)
+                parts = []
+            else:
+                parts.append(comb)
+        elif m.group('attr') is not None:
+            value = m.group('dq') if m.group('dq') is not None else m.group('sq') if m.group('sq') is not None else m.group('bare')
+            compound.attrs.append((m.group('attr'), m.group('op'), value))
+            if m.group('attr') == 'id' and m.group('op') == '=' and compound.id is None:
+                compound.id = value  # allows using the id index for ids that can't be written with #
+        elif kind == 'tag':
+            if not compound.is_empty():
+                raise _invalid(selectors)
+            if m.group('tag') == '*':
+                compound.universal = True
+            else:
+                compound.tag = m.group('tag').lower()
+        elif kind == 'id':
+            compound.id = m.group('id')
+        elif kind == 'cls':
+            compound.classes.append(m.group('cls'))
+        elif kind == 'pseudo':
+            if m.group('pseudo') not in _pseudos:
+                raise Exception('unsupported pseudo-class: ' + m.group('pseudo'))
+            compound.pseudos.append(m.group('pseudo'))
+        else:
+            raise _invalid(selectors)
+    if compound.is_empty():
+        raise _invalid(selectors)
+    parts.append(compound)
+    result.append(parts)
+
+    compiled = []
+    for parts in result:
+        # parts alternate between compounds and combinators: [compound, combinator, compound, ...]
+        compounds = parts[0::2]
+        combinators = [None] + parts[1::2]
+        compiled.append([(compounds[i], combinators[i]) for i in reversed(range(len(compounds)))])
+    if len(_cache) >= _cache_max_size:
+        _cache.clear()
+    _cache[selectors] = compiled
+    return compiled
+
+
+def _matches_chain(el, chain, i):
+    compound, combinator = chain[i]
+    if not compound.matches(el):
+        return False
+    if combinator is None:
+        return True
+    if combinator == '>':
+        return el._parent is not None and _matches_chain(el._parent, chain, i + 1)
+    if combinator == '+':
+        return el._prev is not None and _matches_chain(el._prev, chain, i + 1)
+    step = '_parent' if combinator == ' ' else '_prev'
+    other = getattr(el, step)
+    while other is not None:
+        if _matches_chain(other, chain, i + 1):
+            return True
+        other = getattr(other, step)
+    return False
+
+
+def _order_key(el, scope):
+    """
+    returns the document order key of el, which is the tuple of sibling position keys on the path from scope down to el,
+    or None if el is not a descendant of scope
+    """
+    if el is scope:
+        return None
+    key = []
+    while el is not scope:
+        if el is None:
+            return None
+        key.append(el._pos)
+        el = el._parent
+    key.reverse()
+    return tuple(key)
+
+
+def _iter_descendants(scope):
+    """
+    yields the descendants of scope in document order
+    """
+    stack = []
+    child = scope._last
+    while child is not None:
+        stack.append(child)
+        child = child._prev
+    while stack:
+        el = stack.pop()
+        yield el
+        child = el._last
+        while child is not None:
+            stack.append(child)
+            child = child._prev
+
+
+def _candidates(document, compound):
+    """
+    returns the candidate elements for the rightmost compound selector using the document indexes, or None if none of the indexes apply
+    """
+    if compound.id is not None:
+        el = document['elements_by_id'].get(compound.id)
+        return [] if el is None else [el]
+    if compound.classes:
+        index = document['elements_by_class']
+        sets = [index.get(name) for name in compound.classes]
+        if None in sets:
+            return []
+        return min(sets, key=len).values()
+    if compound.tag is not None:
+        return document['elements_by_tag'].get(compound.tag, {}).values()
+    return None
+
+
+def _chain_candidates(document, chain):
+    """
+    returns the candidate elements for a complex selector, or None if the whole subtree needs to be walked.
+    a compound further left that is connected to the rightmost one by descendant or child combinators only is used as an anchor if it is
+    much more selective than the rightmost one, in which case the candidates are the descendants of the anchor elements.
+    """
+    candidates = _candidates(document, chain[0][0])
+    i = 0
+    while chain[i][1] in (' ', '>'):
+        i += 1
+        anchors = _candidates(document, chain[i][0])
+        if anchors is not None and (candidates is None or len(anchors) * _anchor_weight < len(candidates)):
+            return (el for anchor in anchors for el in _iter_descendants(anchor))
+    return candidates
+
+
+def select(scope, selectors, first=False):
+    """
+    returns the list of descendants of the scope element matching selectors in document order.
+    if first is True, returns at most one element.
+    """
+    compiled = compile_selector(selectors)
+    document = scope._document
+    found = {}  # id(el) -> (order key, el)
+    walk = False
+    for chain in compiled:
+        candidates = _chain_candidates(document, chain)
+        if candidates is None:
+            walk = True
+            break
+        for el in candidates:
+            if id(el) not in found and _matches_chain(el, chain, 0):
+                key = _order_key(el, scope)
+                if key is not None:
+                    found[id(el)] = (key, el)
+    if walk:
+        # at least one of the selectors can't be narrowed down by an index, walk the subtree once in document order for all of them
+        res = []
+        for el in _iter_descendants(scope):
+            for chain in compiled:
+                if _matches_chain(el, chain, 0):
+                    if first:
+                        return [el]
+                    res.append(el)
+                    break
+        return res
+    if first:
+        return [min(found.values(), key=lambda x: x[0])[1]] if found else []
+    return [el for key, el in sorted(found.values(), key=lambda x: x[0])]
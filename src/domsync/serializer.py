@@ -0,0 +1,194 @@
+"""
+Serialization of element subtrees into HTML, used to send a subtree that was built in a :class:`domsync.core.DocumentFragment` to the Browser
+in a single operation instead of one operation per element and property.
+
+The HTML is parsed on the client side with a ``<template>`` element. The HTML parser silently restructures some markup, for example it inserts
+a ``<tbody>`` between a ``<table>`` and a ``<tr>``, closes a ``<p>`` when it meets a ``<div>`` or drops an ``<a>`` nested in another ``<a>``.
+Subtrees that would not survive the round trip through the parser unchanged are not serialized, :func:`serialize` returns None for them
+and the caller falls back to sending one operation per element, see :func:`replay_ops`.
+"""
+from html import escape
+from domsync.protocol import OP_CREATE, OP_APPEND_CHILD, OP_INSERT_BEFORE, OP_SET_ATTRIBUTE, OP_ADD_EVENT_LISTENER, OP_SET_INNER_TEXT, OP_SET_VALUE
+
+_void_tags = frozenset(['area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'param'])
+
+# elements whose content is not parsed as markup, or can't have child elements
+_leaf_tags = _void_tags | frozenset(['script', 'style', 'noscript', 'iframe', 'textarea', 'title', 'option'])
+
+# elements whose text is not parsed as plain text, their innerText is set with a separate operation
+_text_by_op_tags = frozenset(['script', 'style', 'noscript', 'iframe', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'colgroup', 'select', 'optgroup'])
+
+# elements that only keep the given child elements when parsed
+_allowed_children = {
+    'table': frozenset(['caption', 'colgroup', 'thead', 'tbody', 'tfoot']),  # a <tr> directly under a <table> would get an implied <tbody>
+    'thead': frozenset(['tr']),
+    'tbody': frozenset(['tr']),
+    'tfoot': frozenset(['tr']),
+    'tr': frozenset(['td', 'th']),
+    'colgroup': frozenset(['col']),
+    'select': frozenset(['option', 'optgroup']),
+    'optgroup': frozenset(['option']),
+}
+
+# elements that are dropped by the parser outside of their table parent
+_table_parts = frozenset(['caption', 'colgroup', 'col', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th'])
+
+# elements that are ignored by the parser inside of a <template>
+_ignored_tags = frozenset(['html', 'head', 'body'])
+
+# elements that close an open <p>
+_closes_p = frozenset(['address', 'blockquote', 'div', 'dl', 'fieldset', 'menu', 'ol', 'p', 'ul', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'form', 'li', 'dd', 'dt', 'table', 'hr'])
+
+# elements that close an open element of the same tag anywhere above them
+_no_nesting = frozenset(['a', 'button', 'form'])
+
+_headings = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+
+# the special elements of the HTML parser, they limit how far up an <li>, <dd> or <dt> looks for an open element of the same kind to close
+_special_tags = frozenset(['address', 'area', 'base', 'blockquote', 'body', 'br', 'button', 'caption', 'col', 'colgroup', 'dd', 'div', 'dl', 'dt', 'fieldset',
+                           'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'head', 'hr', 'html', 'iframe', 'img', 'input', 'li', 'link', 'menu', 'meta',
+                           'noscript', 'object', 'ol', 'p', 'param', 'pre', 'script', 'select', 'style', 'table', 'tbody', 'td', 'textarea', 'tfoot',
+                           'th', 'thead', 'title', 'tr', 'ul'])
+
+# the first top-level element of a <template> decides how the rest of the top-level elements are parsed, they all need to be of the same kind
+_top_level_kinds = {'caption': 'table', 'colgroup': 'table', 'thead': 'table', 'tbody': 'table', 'tfoot': 'table', 'col': 'col', 'tr': 'tr', 'td': 'cell', 'th': 'cell'}
+
+
+def _closes_list_item(tag, open_tags):
+    """
+    returns True if a start tag of tag (li, dd or dt) would close an open element above it
+    """
+    kinds = ('li',) if tag == 'li' else ('dd', 'dt')
+    for open_tag in reversed(open_tags):
+        if open_tag in kinds:
+            return True
+        if open_tag in _special_tags and open_tag not in ('address', 'div', 'p'):
+            return False
+    return False
+
+
+def _can_nest(tag, open_tags):
+    """
+    returns True if an element of tag can be parsed as the child of the last element in open_tags
+    """
+    if tag in _ignored_tags:
+        return False
+    if not open_tags:
+        return True
+    parent_tag = open_tags[-1]
+    if parent_tag in _leaf_tags:
+        return False
+    if parent_tag in _allowed_children:
+        return tag in _allowed_children[parent_tag]
+    if tag in _table_parts:
+        return False
+    if tag in _closes_p and 'p' in open_tags:
+        return False
+    if tag in _no_nesting and tag in open_tags:
+        return False
+    if tag in _headings and parent_tag in _headings:
+        return False
+    if tag in ('li', 'dd', 'dt') and _closes_list_item(tag, open_tags):
+        return False
+    return True
+
+
+def _element_ops(el, callbacks):
+    """
+    returns the operations that set the properties of el which can't be expressed in the HTML
+    """
+    ops = []
+    text = el._innerText
+    if text and ('\n' in text or el._tag in _text_by_op_tags):
+        ops.append((OP_SET_INNER_TEXT, el, text))  # innerText turns line breaks into <br>, the HTML parser doesn't
+    if el._value is not None:
+        ops.append((OP_SET_VALUE, el, el._value))
+    for event, (callback, js_value_getter, rate) in callbacks.get(el._id, {}).items():
+        ops.append((OP_ADD_EVENT_LISTENER, el, event, js_value_getter, rate))
+    return ops
+
+
+def serialize(elements, callbacks):
+    """
+    serializes the subtrees of elements into HTML
+
+    :param elements: the top-level elements of the subtrees in order
+    :param callbacks: the event listener callbacks of the document, ``Document['callbacks']``
+
+    :returns: a tuple of (html, elements of the subtrees in document order, operations that need to follow the html) or None
+              if the subtrees can't be represented as HTML that parses back into the same structure
+    """
+    if len(set(_top_level_kinds.get(el._tag, 'body') for el in elements)) > 1:
+        return None
+    parts = []
+    subtree = []
+    ops = []
+    open_tags = []
+    stack = list(reversed(elements))
+    while stack:
+        el = stack.pop()
+        if el is None:  # end of the children of the last open element
+            parts.append('</' + open_tags.pop() + '>')
+            continue
+        tag = el._tag
+        if not _can_nest(tag, open_tags):
+            return None
+        subtree.append(el)
+        parts.append('<' + tag + ' id="' + escape(el._id) + '"')
+        if el._attributes is not None:
+            for attrib, value in el._attributes.items():
+                parts.append(' ' + attrib + '="' + escape(value) + '"')
+        parts.append('>')
+        ops.extend(_element_ops(el, callbacks))
+        if tag in _void_tags:
+            if el._first is not None:
+                return None
+            continue
+        text = el._innerText
+        if text and '\n' not in text and tag not in _text_by_op_tags:
+            parts.append(escape(text, quote=False))
+        open_tags.append(tag)
+        stack.append(None)
+        child = el._last
+        while child is not None:
+            stack.append(child)
+            child = child._prev
+    return ''.join(parts), subtree, ops
+
+
+def state_ops(el, callbacks):
+    """
+    yields the operations that create el with its current attributes, innerText, value and event listeners, without attaching it anywhere
+    """
+    yield (OP_CREATE, el)
+    if el._attributes is not None:
+        for attrib, value in el._attributes.items():
+            yield (OP_SET_ATTRIBUTE, el, attrib, value)
+    if el._innerText is not None:
+        yield (OP_SET_INNER_TEXT, el, el._innerText)
+    if el._value is not None:
+        yield (OP_SET_VALUE, el, el._value)
+    for event, (callback, js_value_getter, rate) in callbacks.get(el._id, {}).items():
+        yield (OP_ADD_EVENT_LISTENER, el, event, js_value_getter, rate)
+
+
+def replay_ops(parent, elements, el_before, callbacks):
+    """
+    yields the operations that create the subtrees of elements from scratch one element at a time and insert them under parent
+    before el_before, or append them if el_before is None. The subtrees are walked lazily in document order.
+    """
+    for top in elements:
+        stack = [top]
+        while stack:
+            el = stack.pop()
+            yield from state_ops(el, callbacks)
+            if el is not top:
+                yield (OP_APPEND_CHILD, el._parent, el)
+            elif el_before is None:
+                yield (OP_APPEND_CHILD, parent, el)
+            else:
+                yield (OP_INSERT_BEFORE, parent, el, el_before)
+            child = el._last
+            while child is not None:
+                stack.append(child)
+                child = child._prev
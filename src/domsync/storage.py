@@ -0,0 +1,204 @@
+"""
+Saving a :class:`domsync.Document` to a binary file and loading it back, so that a large prebuilt UI can be loaded at startup instead of being
+built again by Python code:
+
+.. code-block:: python
+
+  registry = {'add_row': add_row, 'sort': sort_table}  # name -> event listener callback
+  with open('ui.domsync', 'wb') as f:
+      save(doc, f, registry)
+  ...
+  with open('ui.domsync', 'rb') as f:
+      doc = load(f, registry)
+
+The element tree is saved with the attributes, innerText, value and event listeners of each element. Callbacks can't be serialized,
+they are saved by their name in the registry and looked up by it again when loading. Both functions stream: ``save`` writes the elements
+in batches while it walks the tree and ``load`` builds the elements batch by batch, so any file-like object works, including ``gzip.open``
+for a smaller file.
+
+The file starts with the ``DOMSYNC`` magic and the version of the format, followed by batches of elements in depth-first order. Each batch
+is a pickle prefixed with its length as a 4 byte big-endian integer. The pickles are loaded with an unpickler that only accepts builtin types.
+"""
+import io
+import pickle
+import struct
+from domsync.core import Document, _Element, _POS_GAP
+
+MAGIC = b'DOMSYNC\x00'
+VERSION = 1
+
+_header = struct.Struct('>8sH')
+_length = struct.Struct('>I')
+
+
+class _Unpickler(pickle.Unpickler):
+    """
+    unpickles builtin types only, the saved batches don't contain anything else
+    """
+
+    def find_class(self, module, name):
+        raise Exception(f'unexpected object in domsync file: {module}.{name}')
+
+
+def _write_batch(f, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    f.write(_length.pack(len(data)))
+    f.write(data)
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise Exception('truncated domsync file')
+    return data
+
+
+def _read_batch(f):
+    return _Unpickler(io.BytesIO(_read_exactly(f, _length.unpack(_read_exactly(f, _length.size))[0]))).load()
+
+
+def save(doc, f, registry=None, batch_size=4096):
+    """
+    writes the current state of the document to a binary file, including the changes that haven't been rendered yet
+
+    :param doc: the document to save, it must not contain elements of a :class:`domsync.core.DocumentFragment` that haven't been attached yet
+    :type doc: :class:`domsync.Document`
+
+    :param f: file object opened for writing in binary mode
+    :type f: file-like
+
+    :param registry: optional, name -> callback of every event listener callback of the document. default = None which means the document can't have event listeners.
+    :type registry: dict
+
+    :param batch_size: optional, the number of elements per batch. default = 4096.
+    :type batch_size: int
+
+    :returns: the number of saved elements
+    :rtype: int
+    """
+    names = {callback: name for name, callback in (registry or {}).items()}
+    callbacks = doc['callbacks']
+    root_el = doc.getRootElement()
+    f.write(_header.pack(MAGIC, VERSION))
+    _write_batch(f, {'root_id': doc['root_id'], 'id_autoinc': doc['id_autoinc']})
+    # the tree of the root comes first, then the elements that aren't attached to it
+    tops = [root_el] + [el for el in doc['elements_by_id'].values() if el._parent is None and el is not root_el]
+    count = 0
+    batch = []
+    for top in tops:
+        stack = [top]
+        while stack:
+            el = stack.pop()
+            if el._fragment is not None:
+                raise Exception('elements of a DocumentFragment can not be saved, append the fragment first: ' + el._id)
+            listeners = None
+            if el._id in callbacks:
+                listeners = []
+                for event, (callback, js_value_getter, rate) in callbacks[el._id].items():
+                    if callback not in names:
+                        raise Exception(f'the callback of the {event} event listener of {el._id} is not in the registry: {callback!r}')
+                    listeners.append((event, names[callback], js_value_getter, rate))
+            batch.append((el._id, el._tag, el._attributes, el._innerText, el._value, el._nchildren, listeners))
+            if len(batch) == batch_size:
+                _write_batch(f, batch)
+                count += len(batch)
+                batch = []
+            child = el._last
+            while child is not None:
+                stack.append(child)
+                child = child._prev
+    if batch:
+        _write_batch(f, batch)
+    _write_batch(f, None)
+    return count + len(batch)
+
+
+def load(f, registry=None):
+    """
+    reads a document written by :func:`save`
+
+    The loaded document doesn't have any updates to render, clients get its content from a full snapshot,
+    see :meth:`domsync.Document.render_full_chunks` and :meth:`domsync.domsync_server.DomsyncServer.load_shared_document`.
+
+    :param f: file object opened for reading in binary mode
+    :type f: file-like
+
+    :param registry: optional, name -> callback of every event listener callback that was saved with the document. default = None.
+    :type registry: dict
+
+    :returns: the loaded document
+    :rtype: :class:`domsync.Document`
+    """
+    magic, version = _header.unpack(_read_exactly(f, _header.size))
+    if magic != MAGIC:
+        raise Exception('not a domsync file')
+    if version != VERSION:
+        raise Exception(f'unsupported domsync file version: {version}')
+    registry = registry or {}
+    info = _read_batch(f)
+    doc = Document(info['root_id'])
+    doc['id_autoinc'] = info['id_autoinc']
+    doc['ops'] = []
+    root_el = doc.getRootElement()
+    elements_by_id = doc['elements_by_id']
+    elements_by_tag = doc['elements_by_tag']
+    elements_by_tag.clear()
+    callbacks = doc['callbacks']
+    handle = 0
+    stack = []  # [element, number of its children still to come]
+    while True:
+        batch = _read_batch(f)
+        if batch is None:
+            break
+        for id, tag, attributes, innerText, value, nchildren, listeners in batch:
+            if handle == 0:
+                if id != root_el._id:
+                    raise Exception('the first element in the domsync file is not the root element: ' + id)
+                el = root_el
+            else:
+                if id in elements_by_id:
+                    raise Exception('duplicate id in domsync file: ' + id)
+                el = _Element.__new__(_Element)
+                el._document = doc
+                el._fragment = None
+                el._id = id
+                el._handle = handle
+                el._tag = tag
+                el._first = el._last = el._snapshot = None
+                el._nchildren = 0
+            el._attributes = attributes
+            el._innerText = innerText
+            el._value = value
+            el._pos = 0
+            el._prev = el._next = None
+            handle += 1
+            while stack and stack[-1][1] == 0:
+                stack.pop()
+            if stack:
+                parent = stack[-1][0]
+                stack[-1][1] -= 1
+                el._parent = parent
+                el._prev = parent._last
+                if parent._last is None:
+                    parent._first = el
+                else:
+                    el._pos = parent._last._pos + _POS_GAP
+                    parent._last._next = el
+                parent._last = el
+                parent._nchildren += 1
+            else:
+                el._parent = None
+            if nchildren:
+                stack.append([el, nchildren])
+            elements_by_id[id] = el
+            elements_by_tag.setdefault(tag, {})[id] = el
+            if attributes is not None and 'class' in attributes:
+                doc._index_classes(el, None, attributes['class'])
+            if listeners is not None:
+                callbacks[id] = {}
+                for event, name, js_value_getter, rate in listeners:
+                    if name not in registry:
+                        raise Exception(f'the callback of the {event} event listener of {id} is not in the registry: {name}')
+                    callbacks[id][event] = (registry[name], js_value_getter, rate)
+    doc['handle_autoinc'] = handle
+    return doc
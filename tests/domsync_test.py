@@ -52,8 +52,1203 @@ class Tests(unittest.TestCase):
 
         table.updateCell('row0','bid','11')
         js = doc.render_js_updates()
-        assert js == """__domsync__["__domsync_el_0.td.row0.bid"].innerText = `11`;\n""", js
+        handle = table.getCellElement('row0', 'bid')._handle
+        assert js == f"""__domsync__[{handle}].innerText = `11`;\n""", js
         js = doc.render_js_full()
 
+    def test_element_slots(self):
+        doc = Document('domsync_root_id')
+        el = doc.createElement('div', id='el0')
+        assert not hasattr(el, '__dict__')
+        assert el._attributes is None
+        assert len(el.attributes) == 0 and len(el.children) == 0
+        assert el.firstElementChild is None and el.lastElementChild is None
+        el.setAttribute('class', 'a')
+        el.appendChild(doc.createElement('span', id='el00', innerText='x'))
+        assert el.attributes == {'class': 'a'}
+        assert el.firstElementChild.id == 'el00' and el.firstElementChild.parentElement is el
+        el.value = 'v'
+        assert el.value == 'v' and el.tagName == 'div'
+        with self.assertRaises(AttributeError):
+            el.foo = 'bar'
+
+    def test_children_links(self):
+        doc = Document('domsync_root_id')
+        parent = doc.getRootElement()
+        els = [doc.createElement('div', id='el'+str(i)) for i in range(5)]
+        parent.appendChild(els[4])
+        for el in els[:4]:
+            # always insert right before the last one to exhaust the room between position keys
+            parent.insertBefore(el, els[4])
+        xs = []
+        for i in range(100):
+            xs.append(doc.createElement('div', id='x'+str(i)))
+            parent.insertBefore(xs[-1], els[4])
+            assert xs[-1].previousElementSibling._pos < xs[-1]._pos < els[4]._pos
+        for el in xs:
+            el.remove()
+        assert [el.id for el in parent.children] == ['el0', 'el1', 'el2', 'el3', 'el4']
+        assert [el.id for el in reversed(parent.children)] == ['el4', 'el3', 'el2', 'el1', 'el0']
+        assert len(parent.children) == 5 and parent.children[1] is els[1] and parent.children[-2] is els[3]
+        assert parent.firstElementChild is els[0] and parent.lastElementChild is els[4]
+        assert els[2].nextElementSibling is els[3] and els[2].previousElementSibling is els[1]
+        els[0].remove()
+        els[4].remove()
+        els[2].remove()
+        assert [el.id for el in parent.children] == ['el1', 'el3']
+        assert parent.firstElementChild is els[1] and parent.lastElementChild is els[3]
+        assert els[1].nextElementSibling is els[3] and els[3].previousElementSibling is els[1]
+        assert els[1]._pos < els[3]._pos
+
+    def test_replace_children(self):
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        ul = doc.createElement('ul', id='ul')
+        root.appendChild(ul)
+        for i in range(3):
+            li = doc.createElement('li', id='li'+str(i))
+            li.addEventListener('click', lambda e: None)
+            ul.appendChild(li)
+            li.appendChild(doc.createElement('span', id='span'+str(i)))
+        doc.render_js_updates()
+
+        new_li = doc.createElement('li', id='new')
+        doc.render_js_updates()
+        ul.replaceChildren(new_li, doc.getElementById('li1'))
+        h = lambda _id: doc.getElementById(_id)._handle
+        assert doc.render_js_updates() == f"""__domsync__[{h('ul')}].replaceChildren(__domsync__[{h('new')}], __domsync__[{h('li1')}]);\n"""
+        assert [el.id for el in ul.children] == ['new', 'li1']
+        for _id in ['li0', 'span0', 'li2', 'span2']:
+            assert doc.getElementById(_id, strict=False) is None
+            assert _id not in doc['callbacks']
+        assert doc.getElementById('span1').parentElement.id == 'li1'
+
+        ul.clearChildren()
+        assert doc.render_js_updates() == f"""__domsync__[{h('ul')}].replaceChildren();\n"""
+        assert len(ul.children) == 0 and ul.firstElementChild is None
+        assert set(doc['elements_by_id']) == {'domsync_root_id', 'ul'}
+        assert doc['callbacks'] == {}
+
+        # tearing down a deep subtree is linear
+        parent = ul
+        for i in range(5000):
+            el = doc.createElement('div')
+            parent.appendChild(el)
+            parent = el
+        ul.firstElementChild.remove()
+        assert set(doc['elements_by_id']) == {'domsync_root_id', 'ul'}
+
+    def test_class_and_tag_index(self):
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        a = doc.createElement('div', id='a', attributes={'class': 'red big'})
+        b = doc.createElement('span', id='b', attributes={'class': 'red'})
+        c = doc.createElement('div', id='c')
+        for el in [a, b, c]:
+            root.appendChild(el)
+        c.appendChild(doc.createElement('span', id='d', attributes={'class': 'big'}))
+        ids = lambda els: sorted(el.id for el in els)
+        assert ids(doc.getElementsByClassName('red')) == ['a', 'b']
+        assert ids(doc.getElementsByClassName('big')) == ['a', 'd']
+        assert ids(doc.getElementsByClassName('big red')) == ['a']
+        assert ids(doc.getElementsByClassName('green')) == []
+        assert ids(doc.getElementsByTagName('span')) == ['b', 'd']
+        assert len(doc.getElementsByTagName('*')) == 5
+
+        a.setAttribute('class', 'big')
+        b.removeAttribute('class')
+        assert ids(doc.getElementsByClassName('red')) == []
+        assert ids(doc.getElementsByClassName('big')) == ['a', 'd']
+        c.remove()
+        assert ids(doc.getElementsByClassName('big')) == ['a']
+        assert ids(doc.getElementsByTagName('span')) == ['b']
+        assert ids(doc.getElementsByTagName('div')) == ['a', 'domsync_root_id']
+        assert 'red' not in doc['elements_by_class']
+
+    def test_query_selector(self):
+        doc = Document('domsync_root_id')
+        table = TableComponent(doc.getRootElement(), ['cp', 'symbol', 'bid', 'ask'])
+        table.addRow('row1', ['ftx', 'FTT/USD', '3', '4'])
+        table.addRow('row0', ['ftx', 'FTT-PERP', '1', '2'])
+        table.getRowElement('row1').setAttribute('class', 'selected row')
+        table.getCellElement('row0', 'bid').setAttribute('class', 'num')
+        table.getCellElement('row1', 'bid').setAttribute('class', 'num')
+        doc.getRootElement().appendChild(doc.createElement('div', id='x', attributes={'data-k': 'a-b c'}))
+        detached = doc.createElement('td', attributes={'class': 'num'})
+        ids = lambda els: [el.id for el in els]
+        t = table.getTableElement().id
+        assert ids(doc.querySelectorAll('td.num')) == [t+'.td.row0.bid', t+'.td.row1.bid']
+        assert ids(doc.querySelectorAll('tr.selected > .num')) == [t+'.td.row1.bid']
+        assert ids(doc.querySelectorAll('table .selected td:first-child')) == [t+'.td.row1.cp']
+        assert ids(doc.querySelectorAll('[id^="' + t + '.td.row0"]')) == [t+'.td.row0.'+c for c in ['cp', 'symbol', 'bid', 'ask']]
+        assert ids(doc.querySelectorAll('th + th ~ th:last-child')) == [t+'.td.header.ask']
+        assert ids(doc.querySelectorAll('#x, tr.selected')) == [t+'.tr.row1', 'x']
+        assert ids(doc.querySelectorAll('[data-k~=c], [data-k|=a]')) == ['x']
+        assert ids(doc.querySelectorAll('div')) == ['x']
+        # the root element doesn't match itself but it matches on the left of combinators
+        assert ids(doc.querySelectorAll('#domsync_root_id > div')) == ['x']
+        assert ids(doc.querySelectorAll('div > table, div div')) == [t, 'x']
+        assert ids(doc.querySelectorAll('#domsync_root_id')) == []
+        assert doc.querySelector('td').id == t+'.td.row0.cp'
+        assert doc.querySelector('td.num').id == t+'.td.row0.bid'
+        assert doc.querySelector('span') is None
+        row1 = table.getRowElement('row1')
+        assert ids(row1.querySelectorAll('*')) == [t+'.td.row1.'+c for c in ['cp', 'symbol', 'bid', 'ask']]
+        assert ids(row1.querySelectorAll('table td.num')) == [t+'.td.row1.bid']
+        assert ids(row1.querySelectorAll('tr')) == []
+        assert detached.id not in ids(doc.querySelectorAll('.num'))
+        with self.assertRaises(Exception):
+            doc.querySelectorAll('td >')
+        with self.assertRaisesRegex(Exception, 'invalid selector'):
+            doc.querySelectorAll(['td'])
+
+    def test_coalesce_ops(self):
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        root.appendChild(doc.createElement('div', id='a'))
+        doc.render_js_updates()
+
+        a = doc.getElementById('a')
+        for i in range(10):
+            a.innerText = str(i)
+            a.setAttribute('style', 'color:' + str(i))
+        a.setAttribute('class', 'x')
+        a.removeAttribute('class')
+        # created and removed within the same frame, including children and callbacks
+        b = doc.createElement('div', id='b', innerText='b')
+        b.addEventListener('click', lambda e: None)
+        root.appendChild(b)
+        b.appendChild(doc.createElement('span', id='c', innerText='c'))
+        b.remove()
+        js = doc.render_js_updates()
+        assert js == (
+            f"""__domsync__[{a._handle}].innerText = `9`;\n"""
+            f"""__domsync__[{a._handle}].setAttribute("style","color:9");\n"""
+            f"""__domsync__[{a._handle}].removeAttribute("class");\n"""
+        ), js
+
+        # changes of removed elements are dropped, the removal is kept
+        a.innerText = 'gone'
+        a.remove()
+        assert doc.render_js_updates() == f"""__domsync__[{a._handle}].remove();\n"""
+
+        # an element that was used as a reference for insertBefore has to exist on the client side even if it is removed later
+        d = doc.createElement('div', id='d')
+        root.appendChild(d)
+        e = doc.createElement('div', id='e')
+        root.insertBefore(e, d)
+        d.remove()
+        js = doc.render_js_updates()
+        d, e = d._handle, e._handle
+        assert js == (
+            f"""__domsync__[{d}] = document.createElement("div");__domsync__[{d}].setAttribute("id","d");\n"""
+            f"""__domsync__[0].appendChild(__domsync__[{d}]);\n"""
+            f"""__domsync__[{e}] = document.createElement("div");__domsync__[{e}].setAttribute("id","e");\n"""
+            f"""__domsync__[0].insertBefore(__domsync__[{e}], __domsync__[{d}]);\n"""
+            f"""__domsync__[{d}].remove();\n"""
+        ), js
+
+        f = doc.createElement('div', id='f')
+        root.replaceChildren(doc.getElementById('e'), f)
+        f.remove()
+        assert doc.render_js_updates() == f"""__domsync__[0].replaceChildren(__domsync__[{e}]);\n"""
+
+    def test_compact_protocol(self):
+        from domsync.protocol import decode_compact, OP_INIT, OP_CREATE, OP_APPEND_CHILD, OP_SET_INNER_TEXT, OP_SET_ATTRIBUTE, OP_ADD_EVENT_LISTENER, OP_REPLACE_CHILDREN
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        el = doc.createElement('div', id='a', innerText='hi "there"', attributes={'onpointerover': "f('x')"})
+        el.addEventListener('input', lambda e: None, js_value_getter='this.value')
+        root.appendChild(el)
+        msg = doc.render_updates('compact')
+        assert decode_compact(msg) == [
+            (OP_INIT, 0, 'domsync_root_id'),
+            (OP_CREATE, 1, 'div', 'a'),
+            (OP_SET_INNER_TEXT, 1, 'hi "there"'),
+            (OP_SET_ATTRIBUTE, 1, 'onpointerover', "f('x')"),
+            (OP_ADD_EVENT_LISTENER, 1, 'input', 'this.value', None),
+            (OP_APPEND_CHILD, 0, 1),
+        ], msg
+        assert doc.render_updates('compact') == ''
+        root.replaceChildren()
+        assert decode_compact(doc.render_updates('compact')) == [(OP_REPLACE_CHILDREN, 0, [])]
+
+        # the attribute is stored as it is, it is only escaped in the generated Javascript code
+        el = doc.createElement('div', id='b', attributes={'onpointerover': "f('x')"})
+        assert el.getAttribute('onpointerover') == "f('x')"
+        assert """setAttribute("onpointerover","f(\\x27x\\x27)");""" in doc.render_js_updates()
+
+        with self.assertRaises(Exception):
+            decode_compact('[99,"a"]')
+
+    def test_handles(self):
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        a = doc.createElement('div', id='a.very.long.id')
+        root.appendChild(a)
+        assert doc.render_js_updates().endswith(f"""__domsync__[0].appendChild(__domsync__[{a._handle}]);\n""")
+        # handles of removed elements are not reused before the removal has been rendered
+        a.remove()
+        b = doc.createElement('div', id='b')
+        assert b._handle != a._handle
+        js = doc.render_js_updates()
+        assert f"""__domsync__[{a._handle}].remove();""" in js
+        c = doc.createElement('div', id='c')
+        assert c._handle == a._handle
+        assert doc.getElementById('c') is c and doc.getElementById('a.very.long.id', strict=False) is None
+        assert doc.render_js_updates() == f"""__domsync__[{c._handle}] = document.createElement("div");__domsync__[{c._handle}].setAttribute("id","c");\n"""
+
+    def test_document_fragment(self):
+        from domsync.protocol import decode_compact
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        first = doc.createElement('div', id='first')
+        root.appendChild(first)
+        doc.render_js_updates()
+        fragment = doc.createDocumentFragment()
+        ul = fragment.createElement('ul', id='ul', attributes={'class': 'list'})
+        fragment.appendChild(ul)
+        for i in range(3):
+            ul.appendChild(fragment.createElement('li', id=f'li{i}', innerText=f'<item {i}>'))
+        ul.addEventListener('click', lambda msg: None)
+        fragment.appendChild(fragment.createElement('input', id='input', value='x'))
+        assert doc['ops'] == []
+        root.insertBefore(fragment, first)
+        assert fragment.children == [] and [el.id for el in root.children] == ['ul', 'input', 'first']
+        assert [el.id for el in doc.getElementsByClassName('list')] == ['ul']
+        ops = decode_compact(doc.render_updates('compact'))
+        assert [op[0] for op in ops] == [11, 8, 10]
+        assert ops[0][:3] == (11, 0, first._handle)
+        assert ops[0][3] == '<ul id="ul" class="list"><li id="li0">&lt;item 0&gt;</li><li id="li1">&lt;item 1&gt;</li><li id="li2">&lt;item 2&gt;</li></ul><input id="input">'
+        assert ops[0][4] == [doc.getElementById(id)._handle for id in ['ul', 'li0', 'li1', 'li2', 'input']]
+        # attached elements generate operations like any other element
+        doc.getElementById('li1').innerText = 'changed'
+        assert doc.render_js_updates() == f"""__domsync__[{doc.getElementById('li1')._handle}].innerText = `changed`;\n"""
+        # a <tr> under a <table> would be restructured by the HTML parser, such subtrees are sent element by element
+        fragment = doc.createDocumentFragment()
+        table = fragment.createElement('table', id='table')
+        table.appendChild(fragment.createElement('tr', id='tr'))
+        root.appendChild(table)
+        ops = decode_compact(doc.render_updates('compact'))
+        assert [op[0] for op in ops] == [1, 2, 1, 2]
+        # a fragment attached to an element that was removed before rendering is dropped
+        parent = doc.createElement('div', id='parent')
+        root.appendChild(parent)
+        fragment = doc.createDocumentFragment()
+        parent.appendChild(fragment.createElement('span', id='span'))
+        parent.remove()
+        assert doc.render_js_updates() == ''
+
+    def test_table_component_fragment(self):
+        doc = Document('domsync_root_id')
+        table = TableComponent(doc.getRootElement(), ['a', 'b'])
+        doc.render_js_updates()
+        table.addRow('r1', ['1', '2'])
+        table.addRow('r0', ['3', '4'])
+        assert table.getRowIds() == ['r0', 'r1']
+        js = doc.render_js_updates()
+        assert js.count('\n') == 2 and 'createElement("template")' in js
+        table.updateCell('r0', 'b', '5')
+        assert doc.render_js_updates() == f"""__domsync__[{table.getCellElement('r0', 'b')._handle}].innerText = `5`;\n"""
+
+    def test_render_full_chunks(self):
+        from domsync.protocol import decode_compact
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        for i in range(50):
+            div = doc.createElement('div', id=f'div{i}', innerText=f'text {i}', attributes={'class': 'c'})
+            root.appendChild(div)
+            div.appendChild(doc.createElement('input', id=f'input{i}', value=str(i)))
+        doc.getElementById('div3').addEventListener('click', lambda msg: None)
+        doc.getElementById('div7').remove()
+        updates = doc.render_js_updates()
+        full = doc.render_js_full()
+        assert full.startswith('var __domsync__ = [];') and 'div7' not in full and full.count('addEventListener') == 1
+        # the snapshot of an unchanged document is the same as the coalesced updates that built it, up to the order of operations
+        assert sorted(full.splitlines()) == sorted(updates.splitlines() + ['__domsync__[0].replaceChildren();'])
+        chunks = list(doc.render_full_chunks('js', chunk_size=1000))
+        assert len(chunks) > 1 and ''.join(chunks) == full
+        assert all(len(chunk) <= 2 * 1000 for chunk in chunks)
+        chunks = list(doc.render_full_chunks('compact', chunk_size=1000))
+        ops = [op for chunk in chunks for op in decode_compact(chunk)]
+        assert ops[:2] == [(0, 0, 'domsync_root_id'), (5, 0, [])] and len([op for op in ops if op[0] == 1]) == 98
+
+    def test_snapshot_cache(self):
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        table = TableComponent(root, ['a', 'b'])
+        for i in range(20):
+            table.addRow(f'r{i:02}', [str(i), str(-i)])
+        full = doc.render_js_full()
+        table_el = table.getTableElement()
+        row = table.getRowElement('r05')
+        assert table_el._snapshot is not None and row._snapshot is not None
+        assert doc.render_js_full() == full
+        # the snapshot is available with pending updates and reflects them
+        table.updateCell('r05', 'b', 'changed')
+        assert table_el._snapshot is None and row._snapshot is None and table.getRowElement('r06')._snapshot is not None
+        full2 = doc.render_js_full()
+        assert full2 == full.replace('`-5`', '`changed`')
+        table.removeRow('r06')
+        full3 = doc.render_js_full()
+        assert 'r06' not in full3
+        doc.render_js_updates()
+        assert doc.render_js_full() == full3
+        # cached subtrees are reused by every protocol separately and match the uncached rendering
+        compact = ''.join(doc.render_full_chunks('compact'))
+        table_el._invalidate()
+        assert ''.join(doc.render_full_chunks('compact')) == compact
+        for el in doc.getElementsByTagName('*'):
+            el._snapshot = None
+        assert doc.render_js_full() == full3
+        # only the largest subtrees that fit in a message keep their rendered snapshot, the elements within them don't
+        from domsync.core import _COVERED
+        assert 'r05' in table_el._snapshot['js'] and row._snapshot is _COVERED
+
+        # the memory retained by the cache stays close to the size of the snapshot
+        import gc
+        import tracemalloc
+        doc = Document('domsync_root_id')
+        for i in range(5000):
+            tr = doc.createElement('tr', attributes={'class': 'row'})
+            for j in range(4):
+                tr.appendChild(doc.createElement('td', innerText=f'cell {i} {j}'))
+            doc.getRootElement().appendChild(tr)
+        doc.render_updates()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            size = len(doc.render_js_full())
+            gc.collect()
+            retained = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        assert retained < 1.5 * size, (retained, size)
+
+    def test_detached_snapshot(self):
+        doc = Document('domsync_root_id')
+        root = doc.getRootElement()
+        table = TableComponent(root, ['a', 'b'])
+        for i in range(200):
+            table.addRow(f'r{i:03}', [str(i), str(-i)])
+        doc.render_updates()
+        full = doc.render_js_full()
+        for el in doc.getElementsByTagName('*'):
+            el._snapshot = None
+        # the snapshot is taken when the messages are requested, the changes made while they are generated don't tear it
+        chunks = doc._detached_full_chunks('js', 8192)
+        first = next(chunks)
+        table.updateCell('r150', 'b', 'changed')
+        table.removeRow('r010')
+        assert first + ''.join(chunks) == full
+        # the snapshots cached on the copy are moved to the unchanged subtrees of the document only
+        cached = [i for i in range(200) if i != 10 and type(table.getRowElement(f'r{i:03}')._snapshot) is dict]
+        assert len(cached) > 150 and 150 not in cached
+        doc.render_updates()
+        full2 = doc.render_js_full()
+        assert '`changed`' in full2 and 'r010' not in full2
+        assert ''.join(doc._detached_full_chunks('js', 8192)) == full2
+        # the cached subtrees are not copied
+        copied = []
+        doc._copy([root], 'js', None, copied)
+        assert len(copied) < 10
+
+    def test_compression(self):
+        from websockets.frames import Frame, OP_TEXT
+        from websockets.extensions.permessage_deflate import PerMessageDeflate
+        from domsync.compression import CompressionStats, server_extensions
+        stats = CompressionStats()
+        factory = server_extensions(window_bits=10, memory_level=8, min_size=100, stats=stats)[0]
+        _params, encoder = factory.process_request_params([], [])
+        decoder = PerMessageDeflate(False, False, 10, 10)
+        doc = Document('domsync_root_id')
+        for i in range(100):
+            doc.getRootElement().appendChild(doc.createElement('div', id=f'div{i}', innerText=str(i)))
+        messages = [doc.render_js_updates().encode()]
+        doc.getElementById('div5').innerText = 'x'
+        messages.append(doc.render_js_updates().encode())
+        sent = [encoder.encode(Frame(OP_TEXT, data)) for data in messages]
+        assert sent[0].rsv1 and len(sent[0].data) < len(messages[0]) / 4
+        assert not sent[1].rsv1 and sent[1].data == messages[1]  # below min_size
+        assert [decoder.decode(frame).data for frame in sent] == messages
+        res = stats.as_dict()
+        assert res['frames'] == 2 and res['compressed_frames'] == 1 and res['ratio'] < 0.25 and res['us_per_frame'] > 0
+
+    def test_shared_document(self):
+        import asyncio
+        import websockets
+        from domsync.domsync_server import DomsyncServer
+
+        async def connection_handler(server, client):
+            await server.subscribe(client, 'dashboard')
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            doc = server.get_shared_document('dashboard')
+            div = doc.createElement('div', id='div', innerText='a')
+            doc.getRootElement().appendChild(div)
+            async with websockets.connect(url) as ws1, websockets.connect(url) as ws2:
+                snapshot1 = await ws1.recv()
+                snapshot2 = await ws2.recv()
+                assert snapshot1 == snapshot2 and 'innerText = `a`' in snapshot1
+                assert len(server.get_subscribers('dashboard')) == 2
+                assert server.get_document(server.get_subscribers('dashboard')[0]) is doc
+                div.innerText = 'b'
+                await server.flush_all()
+                assert await ws1.recv() == await ws2.recv() == f"""__domsync__[{div._handle}].innerText = `b`;\n"""
+                # a late subscriber gets the current state without the earlier updates
+                div.innerText = 'c'
+                async with websockets.connect(url) as ws3:
+                    snapshot3 = await ws3.recv()
+                    assert 'innerText = `c`' in snapshot3 and 'innerText = `b`' not in snapshot3
+                    assert await ws1.recv() == f"""__domsync__[{div._handle}].innerText = `c`;\n"""
+                await asyncio.sleep(0.05)
+                assert len(server.get_subscribers('dashboard')) == 2
+            await server.close()
+
+        asyncio.run(main())
+
+    def test_auto_flush(self):
+        import asyncio
+        import json
+        import time
+        import websockets
+        from domsync.domsync_server import DomsyncServer
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+
+            def on_click(msg):
+                div.innerText = str(int(div.innerText) + 1)
+            div.addEventListener('click', on_click)
+            if server.flush_rate is None:
+                await server.flush(client)
+
+        async def run(flush_rate):
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, flush_rate=flush_rate)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                while 'innerText = `0`' not in await ws.recv():
+                    pass
+                t0 = time.monotonic()
+                for _ in range(5):
+                    await ws.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'div', 'value': None}))
+                msgs = [await ws.recv()]
+                while not msgs[-1].endswith('`5`;\n'):
+                    msgs.append(await ws.recv())
+                elapsed = time.monotonic() - t0
+            await server.close()
+            return msgs, elapsed
+
+        msgs, _ = asyncio.run(run(None))
+        assert len(msgs) == 5  # one message per event
+        msgs, elapsed = asyncio.run(run(5))
+        assert len(msgs) <= 2 and elapsed < 1
+        msgs, _ = asyncio.run(run(0))
+        assert len(msgs) <= 5
+
+    def test_backpressure(self):
+        import asyncio
+        from domsync.domsync_server import DomsyncServer
+
+        class SlowClient():
+            transport = None
+
+            def __init__(self):
+                self.received = []
+                self.unblocked = asyncio.Event()
+
+            async def send(self, msg):
+                await self.unblocked.wait()
+                self.received.append(msg)
+
+        async def main():
+            server = DomsyncServer(None, 'localhost', 0, verbose=False, outbox_max_messages=10)
+            slow, fast = SlowClient(), SlowClient()
+            fast.unblocked.set()
+            for client in [slow, fast]:
+                server.clients[client] = Document(server.root_id)
+                await server.subscribe(client, 'dashboard')
+            doc = server.get_shared_document('dashboard')
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+            for i in range(1, 51):
+                div.innerText = str(i)
+                await server.flush_shared('dashboard')
+                await asyncio.sleep(0)
+            # the fast client got every update, the slow one has a bounded queue that was dropped for a snapshot
+            assert fast.received[-1] == f"""__domsync__[{div._handle}].innerText = `50`;\n"""
+            assert all(msg.endswith('`%d`;\n' % i) for msg, i in zip(fast.received[::-1], range(50, 40, -1)))
+            assert server.resync_count > 0
+            assert len(server.outboxes[slow].messages) <= 10
+            slow.unblocked.set()
+            await asyncio.sleep(0.01)
+            assert slow not in server.outboxes
+            assert len(slow.received) <= 12
+            assert 'innerText = `50`' in slow.received[-1]
+            assert doc['ops'] == []
+
+        asyncio.run(main())
+
+    def test_async_callbacks(self):
+        import asyncio
+        import json
+        import threading
+        import websockets
+        from concurrent.futures import ThreadPoolExecutor
+        from domsync.domsync_server import DomsyncServer
+
+        handled = []
+        loop_thread = threading.get_ident()
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            div = doc.createElement('div', id='div', innerText='')
+            doc.getRootElement().appendChild(div)
+
+            async def on_click(msg):
+                await asyncio.sleep(0.05 if msg['value'] == 0 else 0)  # the first event is the slowest
+                handled.append(msg['value'])
+
+            def work(msg):
+                assert 'doc' not in msg and threading.get_ident() != loop_thread
+                return msg['value'] * 2
+
+            def then(msg, result):
+                assert threading.get_ident() == loop_thread
+                handled.append(result)
+                msg['doc'].getElementById('div').innerText = str(result)
+            div.addEventListener('click', on_click, js_value_getter='0')
+            div.addEventListener('input', server.offload(work, then), js_value_getter='this.value')
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, executor=ThreadPoolExecutor(2))
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                await ws.recv()
+                for event, value in [('click', 0), ('input', 10), ('click', 1)]:
+                    await ws.send(json.dumps({'domsync': True, 'event': event, 'id': 'div', 'value': value}))
+                msg = await ws.recv()
+                await asyncio.sleep(0.01)
+            await server.close()
+            server.executor.shutdown()
+            return msg
+
+        msg = asyncio.run(main())
+        assert handled == [0, 20, 1]  # in the order the events were sent
+        assert msg.endswith('innerText = `20`;\n')
+
+    def test_rate_limited_events(self):
+        import asyncio
+        import json
+        import websockets
+        from domsync.protocol import decode_compact, OP_ADD_EVENT_LISTENER
+        from domsync.domsync_server import DomsyncServer
+
+        doc = Document('domsync_root_id')
+        el = doc.createElement('input', id='a')
+        doc.getRootElement().appendChild(el)
+        el.addEventListener('input', lambda e: None, js_value_getter='this.value', throttle_ms=100)
+        el.addEventListener('mousemove', lambda e: None, latest_only=True)
+        with self.assertRaises(AssertionError):
+            el.addEventListener('scroll', lambda e: None, throttle_ms=100, debounce_ms=100)
+        js = doc.render_js_full()
+        assert 'setTimeout' in js and 'requestAnimationFrame' in js and ',100)' in js
+        listeners = [op for op in decode_compact(''.join(doc.render_full_chunks('compact'))) if op[0] == OP_ADD_EVENT_LISTENER]
+        assert listeners == [(OP_ADD_EVENT_LISTENER, 1, 'input', 'this.value', ['throttle', 100]), (OP_ADD_EVENT_LISTENER, 1, 'mousemove', None, ['frame', 0])]
+
+        handled = []
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            el = doc.createElement('input', id='a')
+            doc.getRootElement().appendChild(el)
+
+            async def on_input(msg):
+                handled.append(msg['value'])
+                await asyncio.sleep(0.05 if msg['value'] == 0 else 0)
+            el.addEventListener('input', on_input, js_value_getter='this.value', debounce_ms=10)
+            el.addEventListener('click', lambda msg: handled.append('click'))
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                await ws.recv()
+                await ws.send(json.dumps({'domsync': True, 'event': 'input', 'id': 'a', 'value': 0}))
+                await asyncio.sleep(0.01)  # the rest arrives while the first one is being handled
+                for event, value in [('input', 1), ('click', None), ('click', None), ('input', 2), ('input', 3)]:
+                    await ws.send(json.dumps({'domsync': True, 'event': event, 'id': 'a', 'value': value}))
+                await asyncio.sleep(0.1)
+            await server.close()
+            return server.coalesced_count
+
+        assert asyncio.run(main()) == 2
+        assert handled == [0, 'click', 'click', 3]  # only the newest of the waiting input events is handled, clicks are never dropped
+
+    def test_malformed_events(self):
+        import asyncio
+        import json
+        import websockets
+        from domsync.domsync_server import DomsyncServer
+
+        def json_loads(msg):
+            if msg == 'fail':
+                raise RuntimeError('decoder failed')
+            return json.loads(msg)
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+            div.addEventListener('click', lambda msg: setattr(div, 'innerText', str(msg['value'])), throttle_ms=10)
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, json_loads=json_loads)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                await ws.recv()
+                # events whose id or event name can't be looked up are dropped
+                await ws.send(json.dumps([{'domsync': True, 'event': 'click', 'id': ['div'], 'value': 1}, {'domsync': True, 'event': {}, 'id': 'div', 'value': 2}]))
+                await ws.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'div', 'value': 3}))
+                assert await asyncio.wait_for(ws.recv(), 1) == '__domsync__[1].innerText = `3`;\n'
+                # an error while receiving closes the connection instead of leaving it hanging
+                await ws.send('fail')
+                with self.assertRaises(websockets.exceptions.ConnectionClosedError):
+                    await asyncio.wait_for(ws.recv(), 1)
+                assert ws.close_code == 1011
+            await asyncio.sleep(0.01)
+            assert server.get_clients() == []
+            await asyncio.wait_for(server.close(), 1)
+
+        asyncio.run(main())
+
+    def test_fanout(self):
+        import asyncio
+        import json
+        import os
+        import tempfile
+        import websockets
+        from domsync.fanout import FanoutPublisher, FanoutWorker
+
+        async def main(path):
+            publisher = FanoutPublisher(path, verbose=False)
+            await publisher.serve()
+            doc = publisher.get_shared_document()
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+            div.addEventListener('click', lambda msg: setattr(div, 'innerText', str(int(div.innerText) + 1)))
+            workers = [FanoutWorker(path, 'localhost', 0, verbose=False) for _ in range(2)]
+            for worker in workers:
+                await worker.serve()
+            urls = ['ws://localhost:%d' % worker.server.sockets[0].getsockname()[1] for worker in workers]
+            async with websockets.connect(urls[0]) as ws1, websockets.connect(urls[1]) as ws2:
+                assert 'innerText = `0`' in await ws1.recv() and 'innerText = `0`' in await ws2.recv()
+                assert publisher.get_subscriber_count() == 2
+                div.innerText = '5'
+                await publisher.flush_all()
+                assert await ws1.recv() == await ws2.recv() == f"""__domsync__[{div._handle}].innerText = `5`;\n"""
+                # an event on one worker is handled by the publisher and the update reaches the clients of every worker
+                await ws2.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'div', 'value': None}))
+                assert await ws1.recv() == await ws2.recv() == f"""__domsync__[{div._handle}].innerText = `6`;\n"""
+                # binary frames are read as text, the ones that aren't text are dropped without closing the connection
+                await ws1.send(b'\xff\xfe')
+                await ws1.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'div', 'value': None}).encode('utf-8'))
+                assert await ws1.recv() == await ws2.recv() == f"""__domsync__[{div._handle}].innerText = `7`;\n"""
+            await asyncio.sleep(0.05)
+            assert publisher.get_subscriber_count() == 0
+            for worker in workers:
+                await worker.close()
+            await publisher.close()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main(os.path.join(tmp, 'domsync.sock')))
+
+    def test_fanout_lagging_worker(self):
+        import asyncio
+        import json
+        import os
+        import tempfile
+        from domsync.fanout import FanoutPublisher, _write_frame, _read_frame
+
+        async def main(path):
+            publisher = FanoutPublisher(path, verbose=False, lag_limit=4096)
+            await publisher.serve()
+            doc = publisher.get_shared_document()
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+            # two workers that subscribe a client each, the first one stops reading after the snapshot
+            connections = [await asyncio.open_unix_connection(path) for _ in range(2)]
+            for reader, writer in connections:
+                _write_frame(writer, {'type': 'subscribe', 'client': 0, 'name': 'default'})
+                assert (await _read_frame(reader, json.loads))['type'] == 'snapshot'
+            (stuck_reader, _), (reader, _) = connections
+            for i in range(200):
+                div.innerText = str(i) * 100000
+                await asyncio.wait_for(publisher.flush('default'), 1)  # the stuck worker doesn't hold up the flush
+                assert (await _read_frame(reader, json.loads))['type'] == 'update'
+                if publisher.resync_count:
+                    break
+            assert publisher.resync_count == 1 and len(publisher.lagging) == 1
+            assert next(iter(publisher.lagging)).transport.get_write_buffer_size() < 4096 + 200000
+            div.innerText = 'last'
+            await publisher.flush('default')
+            # once the worker reads again it gets a snapshot with the current state
+            while True:
+                msg = await asyncio.wait_for(_read_frame(stuck_reader, json.loads), 1)
+                if msg['type'] == 'snapshot':
+                    break
+            assert msg['client'] == 0 and 'innerText = `last`' in ''.join(msg['chunks'])
+            assert len(publisher.lagging) == 0
+            div.innerText = 'after'
+            await publisher.flush('default')
+            assert (await asyncio.wait_for(_read_frame(stuck_reader, json.loads), 1))['msg'].endswith('innerText = `after`;\n')
+            for _, writer in connections:
+                writer.close()
+            await publisher.close()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main(os.path.join(tmp, 'domsync.sock')))
+
+    def test_resume(self):
+        import asyncio
+        import websockets
+        from domsync.protocol import decode_compact, OP_SEQUENCE, OP_SESSION, OP_INIT, OP_SET_INNER_TEXT
+        from domsync.domsync_server import DomsyncServer
+
+        clients = []
+
+        async def connection_handler(server, client):
+            clients.append(client)
+            doc = server.get_document(client)
+            doc.getRootElement().appendChild(doc.createElement('div', id='div', innerText='0'))
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, protocol='compact', resume_grace=0.2, resume_frames=2)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+
+            async def update(text):
+                server.get_document(clients[0]).getElementById('div').innerText = text
+                await server.flush(clients[0])
+
+            async with websockets.connect(url) as ws:
+                [(code, session_id)] = decode_compact(await ws.recv())
+                assert code == OP_SESSION
+                assert decode_compact(await ws.recv())[0] == (OP_SEQUENCE, 1)
+                await update('1')
+                assert decode_compact(await ws.recv())[0] == (OP_SEQUENCE, 2)
+            await asyncio.sleep(0.01)
+            # the document is kept and updated while the client is away
+            assert server.is_connected(clients[0])
+            await update('2')
+            await update('3')
+            async with websockets.connect(url + f'/?session={session_id}&seq=2') as ws:
+                # only the missed messages
+                assert decode_compact(await ws.recv()) == [(OP_SEQUENCE, 3), (OP_SET_INNER_TEXT, 1, '2')]
+                assert decode_compact(await ws.recv()) == [(OP_SEQUENCE, 4), (OP_SET_INNER_TEXT, 1, '3')]
+                await update('4')
+                assert decode_compact(await ws.recv()) == [(OP_SEQUENCE, 5), (OP_SET_INNER_TEXT, 1, '4')]
+            await asyncio.sleep(0.01)
+            async with websockets.connect(url + f'/?session={session_id}&seq=1') as ws:
+                # the missed messages are not kept anymore
+                ops = decode_compact(await ws.recv())
+                assert ops[:3] == [(OP_SESSION, session_id), (OP_SEQUENCE, -1), (OP_INIT, 0, 'domsync_root_id')] and (OP_SET_INNER_TEXT, 1, '4') in ops
+                assert decode_compact(await ws.recv()) == [(OP_SEQUENCE, 5)]
+                # the connections in between are dropped, the client is listed by the connection given to the connection_handler
+                assert server.get_clients() == [clients[0]] and len(server.clients) == 2
+            await asyncio.sleep(0.01)
+            assert server.get_clients() == [] and server.is_connected(clients[0])
+            assert len(clients) == 1 and len(server.sessions) == 1
+            await asyncio.sleep(0.3)
+            assert not server.is_connected(clients[0]) and len(server.sessions) == 0
+            async with websockets.connect(url + f'/?session={session_id}&seq=5') as ws:
+                # an expired session starts over with a snapshot
+                ops = decode_compact(await ws.recv())
+                assert ops[0][0] == OP_SESSION and ops[0][1] != session_id and ops[1:3] == [(OP_SEQUENCE, -1), (OP_INIT, 0, 'domsync_root_id')]
+                assert decode_compact(await ws.recv()) == [(OP_SEQUENCE, 1)]
+                assert len(clients) == 2
+            await server.close()
+
+        asyncio.run(main())
+
+    def test_resume_interrupted(self):
+        import asyncio
+        import websockets
+        from domsync.protocol import decode_compact, OP_SEQUENCE, OP_SESSION, OP_INIT
+        from domsync.domsync_server import DomsyncServer
+
+        clients = []
+        template = Document('domsync_root_id')
+        for i in range(50):
+            template.getRootElement().appendChild(template.createElement('div', innerText=f'row {i}'))
+
+        async def connection_handler(server, client):
+            clients.append(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, protocol='compact', resume_grace=5,
+                                   snapshot_chunk_size=500, template=template)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            # the connection is lost after the first message of the snapshot, the sequence number is cleared until the last one
+            async with websockets.connect(url) as ws:
+                ops = decode_compact(await ws.recv())
+                session_id = ops[0][1]
+                assert ops[:3] == [(OP_SESSION, session_id), (OP_SEQUENCE, -1), (OP_INIT, 0, 'domsync_root_id')]
+            await asyncio.sleep(0.01)
+            async with websockets.connect(url + f'/?session={session_id}&seq=-1') as ws:
+                # the client resuming with a partial snapshot gets a new one
+                messages = [decode_compact(await ws.recv())]
+                while messages[-1][0][0] != OP_SEQUENCE or messages[-1][0][1] < 0:
+                    messages.append(decode_compact(await ws.recv()))
+                assert len(messages) > 2 and messages[0][:3] == [(OP_SESSION, session_id), (OP_SEQUENCE, -1), (OP_INIT, 0, 'domsync_root_id')]
+                assert messages[-1] == [(OP_SEQUENCE, 0)]
+                # a reconnect before the previous connection is noticed to be gone takes over the session
+                async with websockets.connect(url + f'/?session={session_id}&seq=0') as ws2:
+                    await asyncio.sleep(0.05)
+                    with self.assertRaises(websockets.exceptions.ConnectionClosed):
+                        await ws.recv()
+                    assert len(clients) == 1 and server.get_clients() == clients and len(server.sessions) == 1
+                    server.get_document(clients[0]).getRootElement().firstElementChild.innerText = 'changed'
+                    await server.flush(clients[0])
+                    assert decode_compact(await ws2.recv())[0] == (OP_SEQUENCE, 1)
+                await asyncio.sleep(0.01)
+                assert server.get_clients() == [] and server.is_connected(clients[0])
+            await server.close()
+
+        asyncio.run(main())
+
+    def test_batched_events(self):
+        import asyncio
+        import json
+        import websockets
+        from domsync.domsync_server import DomsyncServer
+
+        decoded = []
+
+        def json_loads(msg):
+            decoded.append(msg)
+            return json.loads(msg)
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+            div.addEventListener('click', lambda msg: setattr(div, 'innerText', div.innerText + str(msg['value'])))
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, json_loads=json_loads)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                await ws.recv()
+                await ws.send(json.dumps([{'domsync': True, 'event': 'click', 'id': 'div', 'value': i} for i in range(1, 4)]))
+                await ws.send('not json')
+                await ws.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'div', 'value': 4}))
+                # the events of a batch are handled in order and flushed once
+                assert await ws.recv() == '__domsync__[1].innerText = `0123`;\n'
+                assert await ws.recv() == '__domsync__[1].innerText = `01234`;\n'
+            await server.close()
+
+        asyncio.run(main())
+        assert len(decoded) == 3
+
+    def test_metrics(self):
+        import asyncio
+        import json
+        import websockets
+        from domsync.metrics import Histogram
+        from domsync.domsync_server import DomsyncServer
+
+        h = Histogram((1, 10, 100))
+        for value in [0.5, 5, 5, 50, 500]:
+            h.observe(value)
+        assert h.counts == [1, 2, 1, 1] and h.quantile(0.5) == 10 and h.quantile(1) == float('inf')
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+            div.addEventListener('click', lambda msg: setattr(div, 'innerText', str(int(div.innerText) + 1)))
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, metrics_port=0)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                first = await ws.recv()
+                for _ in range(3):
+                    await ws.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'div', 'value': None}))
+                    await ws.recv()
+                client = server.get_clients()[0]
+                metrics = server.get_metrics(client)
+                assert metrics['events'] == 3 and metrics['event_seconds']['count'] == 3
+                assert metrics['flushes'] == 4 and metrics['flush_ops']['sum'] >= 7
+                assert metrics['messages_sent'] == 4 and metrics['bytes_sent'] == len(first) + 3 * len('__domsync__[1].innerText = `1`;\n')
+                assert metrics['send_seconds']['count'] == 4  # also the messages that were written right away
+                assert server.get_metrics()['events'] == 3
+                # scrape the endpoint
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.metrics_server.sockets[0].getsockname()[1])
+                writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                response = (await reader.read()).decode()
+                writer.close()
+                assert response.startswith('HTTP/1.1 200 OK')
+                assert '\ndomsync_events_total 3\n' in response
+                assert 'domsync_events_total{client="127.0.0.1:' in response
+                assert 'domsync_event_seconds_bucket{le="+Inf"} 3\n' in response
+            await asyncio.sleep(0.01)
+            assert server.client_metrics == {}
+            await server.close()
+
+        asyncio.run(main())
+
+    def test_callback_profiler(self):
+        import asyncio
+        import time
+        from domsync.profiler import CallbackProfiler
+
+        doc = Document('domsync_root_id')
+        profiler = CallbackProfiler(threshold=0.01)
+        doc['profiler'] = profiler
+        div = doc.createElement('div', id='div', innerText='0')
+        doc.getRootElement().appendChild(div)
+
+        def slow_click(msg):
+            time.sleep(0.02)
+            div.innerText = '1'
+            div.setAttribute('class', 'clicked')
+
+        async def async_input(msg):
+            div.innerText = msg['value']
+            await asyncio.sleep(0.02)
+
+        div.addEventListener('click', slow_click)
+        div.addEventListener('input', async_input)
+        doc.render_updates()
+        with self.assertLogs('domsync.profiler', 'WARNING') as logs:
+            doc.handle_event({'domsync': True, 'event': 'click', 'id': 'div', 'value': None})
+            doc.handle_event({'domsync': True, 'event': 'click', 'id': 'div', 'value': None})
+        assert len(logs.output) == 2 and 'slow_click' in logs.output[0] and '2 ops' in logs.output[0]
+
+        async def main():
+            await doc.handle_event({'domsync': True, 'event': 'input', 'id': 'div', 'value': 'x'})
+        asyncio.run(main())
+
+        click, input = profiler.report()
+        assert click['callback'].endswith('slow_click') and click['calls'] == 2 and click['ops'] == 2 and click['slow'] == 2
+        assert click['cpu'] < click['wall']  # sleeping is not CPU time, the second click didn't change anything
+        assert input['callback'].endswith('async_input') and input['calls'] == 1 and input['ops'] == 1 and input['wall'] >= 0.02 and input['cpu'] < 0.02
+        assert profiler.report(1, sort_by='ops')[0]['event'] == 'click'
+        assert 'slow_click' in profiler.format_report()
+        profiler.reset()
+        assert profiler.report() == []
+
+    def test_hibernate(self):
+        import asyncio
+        import json
+        import websockets
+        from domsync.domsync_server import DomsyncServer
+
+        def build():
+            doc = Document('domsync_root_id')
+            ul = doc.createElement('ul', id='list', attributes={'class': 'list'})
+            doc.getRootElement().appendChild(ul)
+            for i in range(5):
+                ul.appendChild(doc.createElement('li', innerText=str(i), attributes={'class': 'item odd' if i % 2 else 'item'}))
+            button = doc.createElement('button', innerText='add')
+            doc.getRootElement().appendChild(button)
+            button.addEventListener('click', lambda msg: ul.appendChild(doc.createElement('li', innerText='new', attributes={'class': 'item'})))
+            doc.render_updates()
+            return doc, ul, button
+
+        doc, ul, button = build()
+        awake, _, _ = build()
+        full = doc.render_js_full()
+        assert doc.hibernate() and doc.is_hibernated() and not doc.hibernate()
+        # the closure of the callback keeps ul alive, it's reused along with the handles of all elements
+        for d in (doc, awake):
+            d.handle_event({'domsync': True, 'event': 'click', 'id': button.id, 'value': None})
+        assert not doc.is_hibernated()
+        assert doc.render_js_updates() == awake.render_js_updates()
+        assert len(doc.getElementsByClassName('odd')) == 2 and len(doc.getElementsByClassName('item')) == 6
+        assert doc.getElementById('list') is ul and ul.children[-1].innerText == 'new'
+        ul.children[-1].remove()
+        doc.render_updates()
+        assert doc.render_js_full() == full
+        doc.createElement('span')
+        assert not doc.hibernate()  # pending updates
+
+        # the cleared fields of a hibernated document are never visible, and components can be built on its elements
+        doc, ul, button = build()
+        fields = dict(doc)
+        assert doc.hibernate() and len(doc) == len(fields) and not doc.is_hibernated()
+        assert doc.hibernate() and dict(doc.items())['elements_by_id'] is not None and not doc.is_hibernated()
+        assert doc.hibernate() and list(doc.values()).count(None) == list(fields.values()).count(None)
+        assert doc.hibernate() and sorted(doc) == sorted(fields)
+        assert doc.hibernate()
+        table = TableComponent(ul, ['a'])
+        assert not doc.is_hibernated() and table.getTableElement().parentElement is ul
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            div = doc.createElement('div', id='div', innerText='0')
+            doc.getRootElement().appendChild(div)
+            div.addEventListener('click', lambda msg: setattr(div, 'innerText', str(int(div.innerText) + 1)))
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, hibernate_after=0.05)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                await ws.recv()
+                await asyncio.sleep(0.2)
+                [client] = server.get_clients()
+                assert server.clients[client].is_hibernated() and server.hibernate_count == 1
+                await server.flush_all()  # doesn't wake it up
+                assert server.clients[client].is_hibernated()
+                await ws.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'div', 'value': None}))
+                assert await ws.recv() == '__domsync__[1].innerText = `1`;\n'
+                assert not server.clients[client].is_hibernated()
+            await server.close()
+
+            # the documents of disconnected clients that can still resume are hibernated too
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, protocol='compact', hibernate_after=0.05, resume_grace=1)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            async with websockets.connect(url) as ws:
+                await ws.recv()
+            await asyncio.sleep(0.2)
+            [doc] = [session.doc for session in server.sessions.values()]
+            assert doc.is_hibernated()
+            await server.close()
+
+        asyncio.run(main())
+
+    def test_storage(self):
+        import gzip
+        import io
+        from domsync.storage import save, load
+
+        def add_row(msg):
+            tbody = doc.getElementById('rows')
+            tr = doc.createElement('tr')
+            tr.appendChild(doc.createElement('td', innerText=msg['value']))
+            tbody.appendChild(tr)
+
+        def build():
+            doc = Document('domsync_root_id')
+            table = doc.createElement('table', attributes={'class': 'grid wide'})
+            tbody = doc.createElement('tbody', id='rows')
+            table.appendChild(tbody)
+            for i in range(10):
+                tr = doc.createElement('tr', attributes={'class': 'row'})
+                for j in range(3):
+                    tr.appendChild(doc.createElement('td', innerText=f'{i},{j}'))
+                tbody.appendChild(tr)
+            input = doc.createElement('input', id='input', value='x')
+            input.addEventListener('change', add_row, js_value_getter='this.value', debounce_ms=100)
+            doc.getRootElement().appendChild(table)
+            doc.getRootElement().appendChild(input)
+            doc.createElement('p', innerText='detached')
+            return doc
+
+        doc = build()
+        registry = {'add_row': add_row}
+        f = io.BytesIO()
+        assert save(doc, f, registry, batch_size=7) == len(doc['elements_by_id'])
+        f.seek(0)
+        loaded = load(f, registry)
+        assert loaded.render_js_full() == doc.render_js_full()
+        assert loaded['ops'] == [] and len(loaded.getElementsByClassName('row')) == 10
+        assert loaded.getElementById('__domsync_el_41').innerText == 'detached' and loaded.getElementById('__domsync_el_41').parentElement is None
+        # the loaded document changes the same way as the original one, new elements don't clash with the loaded ones
+        doc.render_updates()
+        doc.handle_event({'domsync': True, 'event': 'change', 'id': 'input', 'value': 'new'})
+        updates, full = doc.render_js_updates(), doc.render_js_full()
+        doc = loaded  # the document of add_row
+        loaded.handle_event({'domsync': True, 'event': 'change', 'id': 'input', 'value': 'new'})
+        assert loaded.render_js_updates() == updates and loaded.render_js_full() == full
+
+        with gzip.open(io.BytesIO(), 'wb') as gz:
+            save(loaded, gz, registry)
+        f.seek(0)
+        with self.assertRaises(Exception):
+            load(f, {})  # the callback is missing
+        with self.assertRaises(Exception):
+            save(doc, io.BytesIO())
+        with self.assertRaises(Exception):
+            load(io.BytesIO(b'<html></html>'))
+        # a corrupt file whose first element isn't the root element
+        data = f.getvalue()
+        i = data.index(b'domsync_root_id', data.index(b'domsync_root_id') + 1)
+        with self.assertRaisesRegex(Exception, 'not the root element'):
+            load(io.BytesIO(data[:i] + b'domsync_root_xx' + data[i + 15:]), registry)
+
+    def test_clone(self):
+        import asyncio
+        import json
+        import websockets
+        from domsync.domsync_server import DomsyncServer
+
+        template = Document('domsync_root_id')
+        ul = template.createElement('ul', id='list', attributes={'class': 'list'})
+        template.getRootElement().appendChild(ul)
+        for i in range(100):
+            ul.appendChild(template.createElement('li', innerText=str(i), attributes={'class': 'item'}))
+        template.getRootElement().appendChild(template.createElement('button', id='button', innerText='0'))
+        template.createElement('p', id='detached')
+        template.render_updates()
+        full = template.render_js_full()
+
+        doc = template.clone()
+        assert doc.render_js_full() == full and doc['ops'] == []
+        doc.getElementById('list').children[2].remove()
+        doc.getElementById('list').setAttribute('class', 'other')
+        doc.getElementById('list').appendChild(doc.createElement('li', innerText='new'))
+        assert '__domsync__[104] = document.createElement("li")' in doc.render_js_updates()  # new handles don't clash with the copied ones
+        assert template.render_js_full() == full and template.getElementById('list').children[2].innerText == '2'
+        assert len(template.getElementsByClassName('list')) == 1 and len(doc.getElementsByClassName('list')) == 0
+        assert len(doc.getElementsByClassName('item')) == 99 and doc.getElementById('list').children[-1].innerText == 'new'
+        assert doc.getElementById('detached').parentElement is None
+
+        async def connection_handler(server, client):
+            doc = server.get_document(client)
+            button = doc.getElementById('button')
+            button.addEventListener('click', lambda msg: setattr(button, 'innerText', str(int(button.innerText) + 1)))
+            await server.flush(client)
+
+        async def main():
+            server = DomsyncServer(connection_handler, 'localhost', 0, verbose=False, template=template)
+            await server.serve()
+            url = 'ws://localhost:%d' % server.server.sockets[0].getsockname()[1]
+            for _ in range(2):
+                async with websockets.connect(url) as ws:
+                    messages = [await ws.recv()]
+                    while 'addEventListener("click"' not in messages[-1]:  # the listener is part of the snapshot or of an update that follows it
+                        messages.append(await ws.recv())
+                    assert len(messages) <= 2 and messages[0].count('createElement("li")') == 100
+                    await ws.send(json.dumps({'domsync': True, 'event': 'click', 'id': 'button', 'value': None}))
+                    assert await ws.recv() == '__domsync__[102].innerText = `1`;\n'
+            await server.close()
+
+        asyncio.run(main())
+        assert template.render_js_full() == full and template['callbacks'] == {}
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file